@@ -0,0 +1,70 @@
+"""
+Benchmark of computing IoU of all level9 entities pair by pair (as measure_quality.py did before) vs in vectorized
+chunks. Run it on full dataset: input .csv (from serbia2input.py) and snapshot of OSM level9 entities (from
+measure_quality.py run in snapshot mode, or downloaded with snapshot.download_snapshot).
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import yaml
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+import iou
+from common import load_level9_features
+from snapshot import load_snapshot_polygons
+
+
+def main(input_csv_file, snapshot_file):
+    with open(os.path.join(parent, 'config.yml'), 'r') as config_yml_file:
+        config = yaml.safe_load(config_yml_file)
+
+    level9_features = load_level9_features(input_csv_file)
+    snapshot_polygons = load_snapshot_polygons(snapshot_file, config['level9_ref_key'])
+    cadastre_polygons, osm_polygons = [], []
+    for level9_feature in level9_features:
+        osm_polygon = snapshot_polygons.get(level9_feature['level9_id'], (None,))[0]
+        if osm_polygon is not None:
+            cadastre_polygons.append(level9_feature.geometry)
+            osm_polygons.append(osm_polygon)
+    print(f'{len(cadastre_polygons)} pairs of polygons')
+
+    start = time.perf_counter()
+    per_pair_area_diff, per_pair_i_o_u = [], []
+    for cadastre_polygon, osm_polygon in zip(cadastre_polygons, osm_polygons):
+        # Exactly as it was done in measure_quality.py
+        intersection = cadastre_polygon.intersection(osm_polygon)
+        union = cadastre_polygon.union(osm_polygon)
+        per_pair_area_diff.append(intersection.area / cadastre_polygon.area)
+        per_pair_i_o_u.append(intersection.area / union.area)
+    per_pair_time = time.perf_counter() - start
+    print(f'Per pair (intersection and union): {per_pair_time:.2f}s')
+
+    start = time.perf_counter()
+    area_diff, i_o_u = iou.compute_iou_batch(cadastre_polygons, osm_polygons, chunk_size=config['iou_chunk_size'],
+                                             vectorized=False)
+    print(f'Per pair (intersection only): {time.perf_counter() - start:.2f}s')
+
+    if iou.pygeos is None:
+        print('pygeos is not installed, skipping vectorized benchmark')
+    else:
+        start = time.perf_counter()
+        area_diff, i_o_u = iou.compute_iou_batch(cadastre_polygons, osm_polygons,
+                                                 chunk_size=config['iou_chunk_size'])
+        batch_time = time.perf_counter() - start
+        print(f'Vectorized: {batch_time:.2f}s ({per_pair_time / batch_time:.1f}x faster)')
+
+    print(f'Max difference of IoU: {np.max(np.abs(i_o_u - np.array(per_pair_i_o_u))):.2e}, '
+          f'area_diff: {np.max(np.abs(area_diff - np.array(per_pair_area_diff))):.2e}')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: ./benchmarks/batch_iou.py <input_csv_file> <snapshot_file>")
+        exit()
+    main(sys.argv[1], sys.argv[2])
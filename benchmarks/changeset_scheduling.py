@@ -0,0 +1,67 @@
+"""
+Compares changesets made by uploading conflated ways in processing order (by way id, as conflate.py does) with
+changesets packed by changeset_scheduler. It runs on synthetic ways, scattered over area of Serbia, with ids not
+related to where ways are (as it is in OSM). Reported are number of changesets and sizes of their bounding boxes.
+"""
+
+import os
+import random
+import sys
+
+import numpy as np
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+from changeset_scheduler import get_change_bounds, schedule_changesets
+from osm_change import MAX_CHANGESET_ELEMENTS, OsmChange
+
+
+def synthetic_change(rnd, way_id, node_count):
+    osm_change = OsmChange()
+    lon, lat = rnd.uniform(19.0, 23.0), rnd.uniform(42.2, 46.2)
+    node_ids = []
+    for i in range(node_count):
+        node = {'id': way_id * 10000 + i, 'version': 1, 'tag': {}, 'lon': lon + 0.0002 * i, 'lat': lat - 0.0001}
+        osm_change.move_node(node, lon + 0.0002 * i, lat + 0.0001 * rnd.random())
+        node_ids.append(node['id'])
+    osm_change.modify_way({'id': way_id, 'version': 1, 'tag': {}, 'nd': node_ids})
+    return osm_change
+
+
+def in_processing_order(osm_changes, max_elements):
+    changesets, current, element_count = [], [], 0
+    for osm_change in sorted(osm_changes, key=lambda c: c.way_id, reverse=True):
+        if element_count + len(osm_change) > max_elements:
+            changesets.append(current)
+            current, element_count = [], 0
+        current.append(osm_change)
+        element_count = element_count + len(osm_change)
+    changesets.append(current)
+    return changesets
+
+
+def describe(name, changesets):
+    sizes = []
+    for changeset in changesets:
+        bounds = np.array([get_change_bounds(osm_change) for osm_change in changeset])
+        sizes.append(max(bounds[:, 2].max() - bounds[:, 0].min(), bounds[:, 3].max() - bounds[:, 1].min()))
+    print(f'{name}: {len(changesets)} changesets, bbox size median {np.median(sizes):.3f}°, max {max(sizes):.3f}°')
+
+
+def main(way_count):
+    rnd = random.Random(42)
+    osm_changes = [synthetic_change(rnd, rnd.randrange(1, 10 ** 9), rnd.randint(10, 300)) for _ in range(way_count)]
+    print(f'{way_count} ways, {sum(len(c) for c in osm_changes)} elements')
+    print(f'One changeset per way: {way_count} changesets')
+    describe('Processing order', in_processing_order(osm_changes, MAX_CHANGESET_ELEMENTS))
+    describe('Hilbert order, max 10000 elements', schedule_changesets(osm_changes, max_extent=1000))
+    describe('Hilbert order, max 10000 elements and 0.5°', schedule_changesets(osm_changes, max_extent=0.5))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print("Usage: ./benchmarks/changeset_scheduling.py <way_count>")
+        exit()
+    main(int(sys.argv[1]))
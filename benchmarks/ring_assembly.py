@@ -0,0 +1,80 @@
+"""
+Benchmark of building relation polygons by stitching rings from ways vs noding and polygonizing all ways (as
+common.create_geometry_from_way_coords did before). It runs on synthetic multipolygons shaped like large
+municipalities: long outer ring and islands split into many ways (shuffled and some reversed), with inner rings
+(enclaves).
+"""
+
+import math
+import os
+import random
+import sys
+import time
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+from common import _create_geometry_from_rings, _create_geometry_from_way_coords_by_polygonizing
+
+
+def ring_coords(center_x, center_y, radius, node_count, rnd):
+    coords = []
+    for i in range(node_count):
+        angle = 2 * math.pi * i / node_count
+        r = radius * (1 + 0.05 * math.sin(angle * 37) + 0.01 * rnd.random())
+        coords.append((center_x + r * math.cos(angle), center_y + r * math.sin(angle)))
+    coords.append(coords[0])
+    return coords
+
+
+def split_into_ways(coords, way_count, rnd):
+    step = max(1, (len(coords) - 1) // way_count)
+    ways = []
+    for start in range(0, len(coords) - 1, step):
+        way = coords[start:start + step + 1]
+        ways.append(way[::-1] if rnd.random() < 0.5 else way)
+    rnd.shuffle(ways)
+    return ways
+
+
+def synthetic_multipolygon(rnd, node_count, way_count, island_count, enclave_count):
+    outer = split_into_ways(ring_coords(20.0, 44.0, 0.3, node_count, rnd), way_count, rnd)
+    inner = []
+    for i in range(island_count):
+        angle = 2 * math.pi * i / island_count
+        outer.extend(split_into_ways(ring_coords(20.0 + 0.5 * math.cos(angle), 44.0 + 0.5 * math.sin(angle), 0.02,
+                                                 node_count // 20, rnd), 4, rnd))
+    for i in range(enclave_count):
+        angle = 2 * math.pi * i / enclave_count
+        inner.extend(split_into_ways(ring_coords(20.0 + 0.15 * math.cos(angle), 44.0 + 0.15 * math.sin(angle), 0.02,
+                                                 node_count // 20, rnd), 4, rnd))
+    rnd.shuffle(outer)
+    return outer, inner
+
+
+def main(relation_count, node_count):
+    rnd = random.Random(42)
+    relations = [synthetic_multipolygon(rnd, node_count, way_count=200, island_count=5, enclave_count=3)
+                 for _ in range(relation_count)]
+    print(f'{relation_count} relations, {node_count} nodes in main outer ring')
+
+    start = time.perf_counter()
+    polygonized = [_create_geometry_from_way_coords_by_polygonizing(outer, inner) for outer, inner in relations]
+    polygonize_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stitched = [_create_geometry_from_rings(outer, inner) for outer, inner in relations]
+    stitch_time = time.perf_counter() - start
+
+    print(f'Noding and polygonizing: {polygonize_time:.2f}s')
+    print(f'Stitching rings: {stitch_time:.2f}s ({polygonize_time / stitch_time:.1f}x faster)')
+    print('Max area of difference: {0:.2e}'.format(max(p.symmetric_difference(s).area
+                                                       for p, s in zip(polygonized, stitched))))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: ./benchmarks/ring_assembly.py <relation_count> <nodes_in_outer_ring>")
+        exit()
+    main(int(sys.argv[1]), int(sys.argv[2]))
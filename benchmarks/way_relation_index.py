@@ -0,0 +1,104 @@
+"""
+Benchmark of finding relations of each way in conflate.py, scanning all relations (as it was done before) vs
+using way->relations index. Synthetic .osm file is a grid of settlements, where each cell is a relation and each
+cell edge is a way, so interior ways are shared between two relations, like in real cadastre data.
+"""
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+current = os.path.dirname(os.path.realpath(__file__))
+parent = os.path.dirname(current)
+sys.path.append(parent)
+
+from conflate import load_osm
+
+# 223x223 cells give 99904 ways and 49729 relations
+GRID_SIZE = 223
+# Scanning is way too slow to be done for all ways, so it is measured on a sample and extrapolated
+SCAN_SAMPLE_SIZE = 100
+
+
+def write_synthetic_osm(path, grid_size):
+    def node_id(x, y):
+        return -(1 + y * (grid_size + 1) + x)
+
+    way_count = 0
+    with open(path, 'w') as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n<osm version="0.6" generator="benchmark">\n')
+        for y in range(grid_size + 1):
+            for x in range(grid_size + 1):
+                f.write(f'<node id="{node_id(x, y)}" lat="{44 + y * 0.01}" lon="{20 + x * 0.01}"/>\n')
+        horizontal_ways, vertical_ways = {}, {}
+        next_id = -(grid_size + 2) ** 2
+        for y in range(grid_size + 1):
+            for x in range(grid_size + 1):
+                if x < grid_size:
+                    horizontal_ways[(x, y)] = next_id
+                    f.write(f'<way id="{next_id}"><nd ref="{node_id(x, y)}"/><nd ref="{node_id(x + 1, y)}"/></way>\n')
+                    next_id, way_count = next_id - 1, way_count + 1
+                if y < grid_size:
+                    vertical_ways[(x, y)] = next_id
+                    f.write(f'<way id="{next_id}"><nd ref="{node_id(x, y)}"/><nd ref="{node_id(x, y + 1)}"/></way>\n')
+                    next_id, way_count = next_id - 1, way_count + 1
+        for y in range(grid_size):
+            for x in range(grid_size):
+                members = [horizontal_ways[(x, y)], vertical_ways[(x + 1, y)],
+                           horizontal_ways[(x, y + 1)], vertical_ways[(x, y)]]
+                f.write(f'<relation id="{next_id}">')
+                for member in members:
+                    f.write(f'<member type="way" ref="{member}" role="outer"/>')
+                f.write(f'<tag k="name" v="{x}-{y}"/><tag k="level9_id" v="{y * grid_size + x}"/></relation>\n')
+                next_id = next_id - 1
+        f.write('</osm>\n')
+    return way_count
+
+
+def find_relations_by_scan(source_data, way_id):
+    relations = []
+    for relation_id, relation in source_data['relations'].items():
+        ways = [w for w in relation['ways'] if w['ref'] == way_id]
+        assert len(ways) <= 1
+        if len(ways) == 1:
+            relations.append(relation)
+    return relations
+
+
+def find_relations_by_index(source_data, way_id):
+    return [source_data['relations'][r] for r in source_data['way_relations'].get(way_id, [])]
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        osm_file = os.path.join(tmp_dir, 'synthetic.osm')
+        way_count = write_synthetic_osm(osm_file, GRID_SIZE)
+        start = time.perf_counter()
+        source_data = load_osm(osm_file)
+        load_time = time.perf_counter() - start
+    print(f'Synthetic file: {way_count} ways, {len(source_data["relations"])} relations, loaded in {load_time:.2f}s '
+          f'(including building index)')
+
+    way_ids = list(source_data['ways'])
+    sample = random.sample(way_ids, SCAN_SAMPLE_SIZE)
+    start = time.perf_counter()
+    for way_id in sample:
+        find_relations_by_scan(source_data, way_id)
+    scan_time = (time.perf_counter() - start) / SCAN_SAMPLE_SIZE * len(way_ids)
+    print(f'Scanning all relations: {scan_time:.1f}s for all ways (extrapolated from {SCAN_SAMPLE_SIZE} ways)')
+
+    start = time.perf_counter()
+    for way_id in way_ids:
+        relations = find_relations_by_index(source_data, way_id)
+        assert len(relations) > 0
+    index_time = time.perf_counter() - start
+    print(f'Using index: {index_time:.2f}s for all ways ({scan_time / index_time:.0f}x faster)')
+
+    for way_id in sample:
+        assert find_relations_by_scan(source_data, way_id) == find_relations_by_index(source_data, way_id)
+
+
+if __name__ == '__main__':
+    main()
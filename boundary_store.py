@@ -0,0 +1,258 @@
+"""
+Local, in-memory store of administrative boundary topology, built once from OSM extract (.osm or .osm.pbf).
+It answers same questions that conflate.py otherwise asks Overpass for (shared ways between two relations, ways
+belonging to a single relation, entities glued to a way), so whole country can be assessed without Overpass.
+"""
+
+import os
+import pickle
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import overpy
+
+from atomic_write import atomic_write
+
+_MEMBER_CLASSES = {'node': overpy.RelationNode, 'way': overpy.RelationWay, 'relation': overpy.RelationRelation}
+
+
+def _iter_osm_xml(path, kind):
+    """
+    Streams elements of a given kind from .osm file as tuples: ('node', id, lat, lon, tags),
+    ('way', id, node_ids, tags) or ('relation', id, members, tags), where members are (type, ref, role) tuples
+    """
+    context = ET.iterparse(path, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event != 'end' or elem.tag not in ('node', 'way', 'relation'):
+            continue
+        if elem.tag == kind:
+            tags = {child.attrib['k']: child.attrib['v'] for child in elem.iter('tag')}
+            if kind == 'node':
+                yield 'node', int(elem.attrib['id']), float(elem.attrib['lat']), float(elem.attrib['lon']), tags
+            elif kind == 'way':
+                yield 'way', int(elem.attrib['id']), [int(nd.attrib['ref']) for nd in elem.iter('nd')], tags
+            else:
+                members = [(m.attrib['type'], int(m.attrib['ref']), m.attrib['role']) for m in elem.iter('member')]
+                yield 'relation', int(elem.attrib['id']), members, tags
+        root.clear()
+
+
+def _read_osm_pbf(path, kind, callback):
+    """
+    Same as _iter_osm_xml, but for .osm.pbf files, and elements are passed to callback as they are read (nothing is
+    collected, so whole extract is never in memory). Requires pyosmium.
+    """
+    try:
+        import osmium
+    except ImportError:
+        raise Exception('pyosmium is needed to read .pbf files, install it with "pip install osmium" '
+                        'or convert extract to .osm first')
+
+    member_types = {'n': 'node', 'w': 'way', 'r': 'relation'}
+
+    class NodeHandler(osmium.SimpleHandler):
+        def node(self, n):
+            callback('node', n.id, n.location.lat, n.location.lon, {t.k: t.v for t in n.tags})
+
+    class WayHandler(osmium.SimpleHandler):
+        def way(self, w):
+            callback('way', w.id, [nd.ref for nd in w.nodes], {t.k: t.v for t in w.tags})
+
+    class RelationHandler(osmium.SimpleHandler):
+        def relation(self, r):
+            members = [(member_types[m.type], m.ref, m.role) for m in r.members]
+            callback('relation', r.id, members, {t.k: t.v for t in r.tags})
+
+    handlers = {'node': NodeHandler, 'way': WayHandler, 'relation': RelationHandler}
+    handlers[kind]().apply_file(path)
+
+
+def _read_osm_file(path, kind, callback):
+    """
+    Calls callback with each element of a given kind from .osm or .osm.pbf file (with same arguments as elements
+    _iter_osm_xml yields)
+    """
+    if path.endswith('.pbf'):
+        _read_osm_pbf(path, kind, callback)
+        return
+    for element in _iter_osm_xml(path, kind):
+        callback(*element)
+
+
+class BoundaryStore(object):
+    """
+    Keeps relation->way->node membership of all administrative boundaries, and reverse node->way, node->relation and
+    way->relation indexes. Of non-boundary ways, only those glued to boundaries are kept.
+    """
+
+    def __init__(self):
+        self.relations = {}  # relation id => (members, tags)
+        self.ways = {}  # way id => (node ids, tags), for boundary ways
+        self.glued_ways = {}  # way id => (node ids, tags), for non-boundary ways sharing node with boundary
+        self.nodes = {}  # node id => (lat, lon, tags), for nodes of boundary ways
+        self.node_ways = {}  # node id => list(way ids)
+        self.node_relations = {}  # node id => list(relation ids)
+        self.way_relations = {}  # way id => list(relation ids)
+        self._relations_by_ref = {}  # id_key => (ref => list(level9 relation ids))
+
+    @classmethod
+    def build(cls, path):
+        store = cls()
+        # First pass - relations, to know which ways are boundaries
+        boundary_way_ids = set()
+
+        def add_relation(_, relation_id, members, tags):
+            store.relations[relation_id] = (members, tags)
+            for member_type, ref, _ in members:
+                if member_type == 'way':
+                    store.way_relations.setdefault(ref, []).append(relation_id)
+                    if tags.get('boundary') == 'administrative':
+                        boundary_way_ids.add(ref)
+                elif member_type == 'node':
+                    store.node_relations.setdefault(ref, []).append(relation_id)
+        _read_osm_file(path, 'relation', add_relation)
+
+        # Second pass - boundary ways, to know which nodes are on boundaries
+        def add_boundary_way(_, way_id, node_ids, tags):
+            if way_id not in boundary_way_ids:
+                return
+            store.ways[way_id] = (node_ids, tags)
+            for node_id in node_ids:
+                store.node_ways.setdefault(node_id, []).append(way_id)
+        _read_osm_file(path, 'way', add_boundary_way)
+
+        # Third and fourth pass - boundary nodes and all other ways glued to them
+        def add_boundary_node(_, node_id, lat, lon, tags):
+            if node_id in store.node_ways:
+                store.nodes[node_id] = (lat, lon, tags)
+        _read_osm_file(path, 'node', add_boundary_node)
+
+        def add_glued_way(_, way_id, node_ids, tags):
+            if way_id in store.ways:
+                return
+            glued_node_ids = [node_id for node_id in node_ids if node_id in store.node_ways]
+            if len(glued_node_ids) == 0:
+                return
+            store.glued_ways[way_id] = (node_ids, tags)
+            for node_id in glued_node_ids:
+                store.node_ways[node_id].append(way_id)
+        _read_osm_file(path, 'way', add_glued_way)
+        print('Boundary store built with {0} relations, {1} boundary ways, {2} glued ways and {3} nodes'.format(
+            len(store.relations), len(store.ways), len(store.glued_ways), len(store.nodes)))
+        return store
+
+    @classmethod
+    def from_overpass_result(cls, result, boundary_way_ids):
+        """
+        Builds store from Overpass response (in compact form, see overpass_json.py) with given boundary ways, all ways
+        sharing their nodes and all relations having those ways or nodes as members. Nodes are not needed, only their
+        membership.
+        """
+        store = cls()
+        for relation in result.relations:
+            members = [(member.type, member.ref, member.role) for member in relation.members]
+            store.relations[relation.id] = (members, relation.tags)
+            for member_type, ref, _ in members:
+                if member_type == 'way':
+                    store.way_relations.setdefault(ref, []).append(relation.id)
+                elif member_type == 'node':
+                    store.node_relations.setdefault(ref, []).append(relation.id)
+        for way in result.ways:
+            if way.id in boundary_way_ids:
+                store.ways[way.id] = (list(way.node_ids), way.tags)
+            else:
+                store.glued_ways[way.id] = (list(way.node_ids), way.tags)
+            for node_id in way.node_ids:
+                store.node_ways.setdefault(node_id, []).append(way.id)
+        return store
+
+    def _level9_relations_by_ref(self, id_key):
+        if id_key not in self._relations_by_ref:
+            relations_by_ref = {}
+            for relation_id, (_, tags) in self.relations.items():
+                if tags.get('boundary') == 'administrative' and tags.get('admin_level') == '9':
+                    relations_by_ref.setdefault(tags.get(id_key), []).append(relation_id)
+            self._relations_by_ref[id_key] = relations_by_ref
+        return self._relations_by_ref[id_key]
+
+    def _relation_way_ids(self, relation_ids):
+        way_ids = set()
+        for relation_id in relation_ids:
+            way_ids.update(ref for member_type, ref, _ in self.relations[relation_id][0] if member_type == 'way')
+        return way_ids & self.ways.keys()
+
+    def _to_result(self, way_ids, relation_ids=(), with_nodes=True):
+        """
+        Packs given elements to overpy.Result, so they look exactly like response from Overpass
+        """
+        result = overpy.Result()
+        if with_nodes:
+            node_ids = set(node_id for way_id in way_ids for node_id in self.ways[way_id][0])
+            for node_id in sorted(node_ids):
+                lat, lon, tags = self.nodes[node_id]
+                result.append(overpy.Node(node_id=node_id, lat=lat, lon=lon, tags=dict(tags), attributes={},
+                                          result=result))
+        for way_id in sorted(way_ids):
+            node_ids, tags = self.ways[way_id] if way_id in self.ways else self.glued_ways[way_id]
+            result.append(overpy.Way(way_id=way_id, node_ids=list(node_ids), tags=dict(tags), attributes={},
+                                     result=result))
+        for relation_id in sorted(relation_ids):
+            members, tags = self.relations[relation_id]
+            relation_members = [_MEMBER_CLASSES[member_type](ref=ref, role=role, result=result)
+                                for member_type, ref, role in members]
+            result.append(overpy.Relation(rel_id=relation_id, members=relation_members, tags=dict(tags),
+                                          attributes={}, result=result))
+        return result
+
+    def get_osm_shared_ways(self, r1, r2, id_key):
+        """
+        Ways (with their nodes) that are shared between level9 relations with refs r1 and r2
+        """
+        relations_by_ref = self._level9_relations_by_ref(id_key)
+        ways1 = self._relation_way_ids(relations_by_ref.get(str(r1), []))
+        ways2 = self._relation_way_ids(relations_by_ref.get(str(r2), []))
+        return self._to_result(ways1 & ways2)
+
+    def get_osm_single_way(self, r1, id_key):
+        """
+        Ways (with their nodes) of level9 relation with ref r1 that are not part of any other level9 relation
+        """
+        relations_by_ref = self._level9_relations_by_ref(id_key)
+        first_relation_ids = set(relations_by_ref.get(str(r1), []))
+        level9_relation_ids = set(r for relation_ids in relations_by_ref.values() for r in relation_ids)
+        single_ways = set()
+        for way_id in self._relation_way_ids(first_relation_ids):
+            other_relations = (level9_relation_ids & set(self.way_relations.get(way_id, []))) - first_relation_ids
+            if len(other_relations) == 0:
+                single_ways.add(way_id)
+        return self._to_result(single_ways)
+
+    def get_entities_shared_with_way(self, way_id):
+        """
+        All ways having a node of a given way and all relations having those ways or nodes as members (without nodes)
+        """
+        if way_id not in self.ways:
+            return self._to_result(set(), with_nodes=False)
+        node_ids = self.ways[way_id][0]
+        way_ids = set(w for node_id in node_ids for w in self.node_ways.get(node_id, []))
+        relation_ids = set(r for node_id in node_ids for r in self.node_relations.get(node_id, []))
+        relation_ids.update(r for w in way_ids for r in self.way_relations.get(w, []))
+        return self._to_result(way_ids, relation_ids & self.relations.keys(), with_nodes=False)
+
+
+def load_boundary_store(path):
+    """
+    Loads boundary store for a given OSM extract. Store is built only once and cached next to the extract, until
+    extract changes.
+    """
+    cache_file = path + '.boundary-store.pickle'
+    if os.path.isfile(cache_file) and os.path.getmtime(cache_file) >= os.path.getmtime(path):
+        with open(cache_file, 'rb') as p:
+            return pickle.load(p)
+    print('Building boundary store from {0}'.format(path))
+    store = BoundaryStore.build(path)
+    Path(cache_file).touch()  # need to touch file for atomic writes later
+    with atomic_write(cache_file, text=False, keep=False) as h:
+        pickle.dump(store, h, protocol=pickle.DEFAULT_PROTOCOL)
+    return store
@@ -0,0 +1,80 @@
+"""
+Packing of conflated ways into changesets. Ways are uploaded in order of their position along Hilbert curve, so ways
+which are next to each other on the map also end up next to each other in upload order, and each changeset is cut
+before it gets too many elements or too big bounding box. That way, every changeset covers one compact area which
+reviewers can check, instead of ways scattered all over the country (as processing order, by way id, would give).
+"""
+
+import numpy as np
+
+from osm_change import MAX_CHANGESET_ELEMENTS, get_changes_bounds
+
+
+def hilbert_distances(xs, ys, order=16):
+    """
+    Distance of each point along Hilbert curve which fills bounding box of all points, in grid of 2^order x 2^order
+    cells
+    """
+    xs, ys = np.asarray(xs, dtype=np.float64), np.asarray(ys, dtype=np.float64)
+    if len(xs) == 0:
+        return np.zeros(0, dtype=np.int64)
+    n = 1 << order
+    span = max(xs.max() - xs.min(), ys.max() - ys.min(), 1e-12)
+    x = ((xs - xs.min()) / span * (n - 1)).astype(np.int64)
+    y = ((ys - ys.min()) / span * (n - 1)).astype(np.int64)
+    distances = np.zeros(len(x), dtype=np.int64)
+    s = n // 2
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        distances = distances + s * s * ((3 * rx) ^ ry)
+        # Rotate quadrant, so that curve in it starts and ends where it should
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s = s // 2
+    return distances
+
+
+def get_change_bounds(osm_change):
+    """
+    :return: Bounding box (min_lon, min_lat, max_lon, max_lat) of all nodes change creates, moves or deletes
+    """
+    return get_changes_bounds(osm_change.to_changes())
+
+
+def schedule_changesets(osm_changes, max_elements=MAX_CHANGESET_ELEMENTS, max_extent=0.5):
+    """
+    Orders changes along Hilbert curve (by center of their bounding box) and splits them into changesets. New changeset
+    is started when current one would get more than max_elements elements, or when its bounding box would get wider or
+    higher than max_extent degrees.
+
+    :return: List of changesets, each one being list of changes
+    """
+    osm_changes = [osm_change for osm_change in osm_changes if len(osm_change) > 0]
+    if len(osm_changes) == 0:
+        return []
+    bounds = np.array([get_change_bounds(osm_change) for osm_change in osm_changes], dtype=np.float64)
+    order = np.argsort(hilbert_distances((bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2),
+                       kind='stable')
+
+    changesets = []
+    current, current_bounds, element_count = [], None, 0
+    for i in order:
+        osm_change = osm_changes[i]
+        if current_bounds is None:
+            merged_bounds = bounds[i]
+        else:
+            merged_bounds = np.concatenate([np.minimum(current_bounds[:2], bounds[i, :2]),
+                                            np.maximum(current_bounds[2:], bounds[i, 2:])])
+        too_big = element_count + len(osm_change) > max_elements or \
+            merged_bounds[2] - merged_bounds[0] > max_extent or merged_bounds[3] - merged_bounds[1] > max_extent
+        if len(current) > 0 and too_big:
+            changesets.append(current)
+            current, merged_bounds, element_count = [], bounds[i], 0
+        current.append(osm_change)
+        current_bounds = merged_bounds
+        element_count = element_count + len(osm_change)
+    changesets.append(current)
+    return changesets
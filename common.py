@@ -1,66 +1,189 @@
 import csv
 import functools
-import http.client
-import socket
+import hashlib
+import os
+import pickle
+import re
 import sys
-import time
+import tempfile
 import urllib.error
+import urllib.request
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
+import numpy as np
 import shapely.geometry as geometry
-from overpy.exception import OverpassTooManyRequests, OverpassGatewayTimeout, OverpassUnknownContentType
+from overpy import RelationWay
+from overpy.exception import OverpassBadRequest, OverpassTooManyRequests, OverpassGatewayTimeout, \
+    OverpassUnknownContentType, OverpassUnknownHTTPStatusCode
+from shapely.errors import TopologicalError
 from shapely.ops import linemerge, unary_union, polygonize
+from shapely.prepared import prep
+
+from atomic_write import atomic_write
+from concurrency import run_adaptive
+from geometry_store import close_geometry_store, load_geometry, write_geometry_store
+from overpass_json import CompactWay, parse_compact_json
+from retry_policy import RetryPolicy, get_endpoint
 
 csv.field_size_limit(sys.maxsize)
 
 
+_retry_policy = RetryPolicy()
+
+# Error messages in HTML page Overpass returns for bad request (as overpy extracts them)
+_OVERPASS_ERROR_MSG_RE = re.compile(rb'<p>(?P<msg><strong\s.*?)</p>')
+_OVERPASS_TAG_RE = re.compile(rb'<[^>]*?>')
+# Remark Overpass adds (next to partial data) when query fails midway, in JSON and in XML response
+_OVERPASS_RUNTIME_ERROR_RE = re.compile(rb'"remark"\s*:\s*"(runtime error(?:[^"\\]|\\.)*)|'
+                                        rb'<remark>\s*(runtime error[^<]*)')
+
+
+def configure_retry_policy(config):
+    """
+    Sets retry policy used by all functions decorated with retry_on_error, from "retry" section of config.yml
+    """
+    global _retry_policy
+    _retry_policy = RetryPolicy.from_config(config)
+    return _retry_policy
+
+
+def get_retry_policy():
+    return _retry_policy
+
+
 def retry_on_error(timeout_in_seconds=60):
+    """
+    Retries decorated function on Overpass and connection errors, as defined by current retry policy. Delay between
+    retries is never longer than timeout_in_seconds.
+    """
     def decorate(func):
+        @functools.wraps(func)
         def call(*args, **kwargs):
-            retries = 5
-            while retries > 0:
-                try:
-                    result = func(*args, **kwargs)
-                except (ConnectionRefusedError, ConnectionResetError,
-                        OverpassTooManyRequests, OverpassGatewayTimeout, OverpassUnknownContentType,
-                        socket.timeout, urllib.error.URLError, http.client.RemoteDisconnected):
-                    retries = retries - 1
-                    print('Connection refused, retrying')
-                    time.sleep(timeout_in_seconds)
-                    continue
-                return result
-            raise Exception('Exhausted retries for connection refused, quitting')
+            return _retry_policy.call(func, args, kwargs, endpoint=get_endpoint(args, kwargs),
+                                      max_delay=timeout_in_seconds)
         return call
     return decorate
 
 
-def create_geometry_from_osm_response(relation, response):
-    # Try to build shapely polygon out of this data
-    outer_ways = [way.ref for way in relation.members if way.role == 'outer']
-    inner_ways = [way.ref for way in relation.members if way.role == 'inner']
-    lss = []
-    for ii_w, way in enumerate(response.ways):
-        if way.id not in outer_ways:
+def is_way_member(member):
+    """
+    Checks if relation member (from overpy or from compact response) is a way
+    """
+    return isinstance(member, RelationWay) or getattr(member, 'type', None) == 'way'
+
+
+def get_relation_way_coords(relation, response):
+    """
+    Extracts coordinates of outer and inner ways of a relation from Overpass response, as plain lists of (lon, lat)
+    tuples, so they can be sent to other processes cheaply.
+    """
+    outer_coords = []
+    inner_coords = []
+    for member in relation.members:
+        if member.role not in ('outer', 'inner') or not is_way_member(member):
             continue
-        ls_coords = []
-        for node in way.nodes:
-            ls_coords.append((node.lon, node.lat))
-        lss.append(geometry.LineString(ls_coords))
+        for way in response.get_ways(member.ref):
+            if isinstance(way, CompactWay):
+                ls_coords = way.coords()
+            else:
+                ls_coords = [(float(node.lon), float(node.lat)) for node in way.nodes]
+            if member.role == 'outer':
+                outer_coords.append(ls_coords)
+            else:
+                inner_coords.append(ls_coords)
+    return outer_coords, inner_coords
 
+
+def assemble_rings(ways_coords):
+    """
+    Stitches ways into closed rings, by joining ways which share endpoint (ways can be in any order and direction).
+
+    :return: List of rings (each is list of (lon, lat) coordinates), or None if ways cannot be stitched unambiguously
+    into closed rings
+    """
+    ways_by_endpoint = {}
+    for i, coords in enumerate(ways_coords):
+        if len(coords) < 2:
+            return None
+        ways_by_endpoint.setdefault(coords[0], []).append(i)
+        ways_by_endpoint.setdefault(coords[-1], []).append(i)
+    if any(len(ways) != 2 for ways in ways_by_endpoint.values()):
+        # Dangling way, or more than two ways meeting in same point
+        return None
+
+    used = [False] * len(ways_coords)
+    rings = []
+    for first in range(len(ways_coords)):
+        if used[first]:
+            continue
+        used[first] = True
+        ring = list(ways_coords[first])
+        current = first
+        while ring[-1] != ring[0]:
+            current = next(w for w in ways_by_endpoint[ring[-1]] if w != current)
+            if used[current]:
+                return None
+            used[current] = True
+            coords = ways_coords[current]
+            ring.extend(coords[1:] if coords[0] == ring[-1] else coords[-2::-1])
+        rings.append(ring)
+    return rings
+
+
+def _polygon_with_holes(polygons, inner_polygons):
+    """
+    Puts each inner ring as a hole into smallest outer ring which contains it. This is the whole relation polygon when
+    rings do not overlap (which is checked by caller), without any overlaying. Returns None if some inner ring is not
+    inside of any outer ring.
+    """
+    prepared_polygons = [prep(p) for p in polygons]
+    holes = [[] for _ in polygons]
+    for inner_polygon in inner_polygons:
+        point = inner_polygon.representative_point()
+        containing = [i for i, p in enumerate(prepared_polygons) if p.contains(point)]
+        if len(containing) == 0:
+            return None
+        holes[min(containing, key=lambda i: polygons[i].area)].append(inner_polygon.exterior.coords)
+    parts = [geometry.Polygon(p.exterior.coords, h) for p, h in zip(polygons, holes)]
+    return parts[0] if len(parts) == 1 else geometry.MultiPolygon(parts)
+
+
+def _create_geometry_from_rings(outer_coords, inner_coords):
+    """
+    Builds polygon from stitched rings. If rings do not overlap, outer rings with inner rings as holes are already valid
+    polygon. Otherwise, all outer rings are unioned at once, and so are all inner rings.
+    Returns None if rings cannot be assembled, or if they are not valid.
+    """
+    outer_rings = assemble_rings(outer_coords)
+    inner_rings = assemble_rings(inner_coords)
+    if outer_rings is None or len(outer_rings) == 0 or inner_rings is None:
+        return None
+    polygons = [geometry.Polygon(ring) for ring in outer_rings]
+    inner_polygons = [geometry.Polygon(ring) for ring in inner_rings]
+    print('polygons found {0}'.format(len(polygons)))
+    polygon = _polygon_with_holes(polygons, inner_polygons)
+    if polygon is not None and polygon.is_valid:
+        return polygon
+    if not all(p.is_valid for p in polygons) or not all(p.is_valid for p in inner_polygons):
+        return None
+    polygon = unary_union(polygons)
+    if len(inner_polygons) > 0:
+        polygon = polygon.symmetric_difference(unary_union(inner_polygons))
+    return polygon
+
+
+def _create_geometry_from_way_coords_by_polygonizing(outer_coords, inner_coords):
+    # Try to build shapely polygon out of this data
+    lss = [geometry.LineString(ls_coords) for ls_coords in outer_coords]
     merged = linemerge([*lss])
     borders = unary_union(merged)
     polygons = list(polygonize(borders))
     print('polygons found {0}'.format(len(polygons)))
     polygon = functools.reduce(lambda p,x: p.union(x), polygons[1:], polygons[0])
-    if len(inner_ways) > 0:
-        lss_inner = []
-        for ii_w, way in enumerate(response.ways):
-            if way.id not in inner_ways:
-                continue
-            ls_coords = []
-            for node in way.nodes:
-                ls_coords.append((node.lon, node.lat))
-            lss_inner.append(geometry.LineString(ls_coords))
+    if len(inner_coords) > 0:
+        lss_inner = [geometry.LineString(ls_coords) for ls_coords in inner_coords]
         merged = linemerge([*lss_inner])
         borders = unary_union(merged)
         inner_polygons = list(polygonize(borders))
@@ -69,13 +192,95 @@ def create_geometry_from_osm_response(relation, response):
     return polygon
 
 
+def create_geometry_from_way_coords(outer_coords, inner_coords):
+    """
+    Builds polygon of a relation from coordinates of its outer and inner ways. Rings are stitched directly from ways,
+    and if that is not possible (unclosed rings, ways crossing each other...), it falls back to noding and
+    polygonizing all ways.
+    """
+    try:
+        polygon = _create_geometry_from_rings(outer_coords, inner_coords)
+    except (ValueError, TopologicalError):
+        polygon = None
+    if polygon is not None:
+        return polygon
+    return _create_geometry_from_way_coords_by_polygonizing(outer_coords, inner_coords)
+
+
+def create_geometry_from_osm_response(relation, response):
+    outer_coords, inner_coords = get_relation_way_coords(relation, response)
+    return create_geometry_from_way_coords(outer_coords, inner_coords)
+
+
+def is_national_border(relation, response):
+    """
+    Checks if any of the ways of a given relation is part of national border
+    """
+    for member in relation.members:
+        if not is_way_member(member):
+            continue
+        if any(way.tags.get('admin_level') == '2' for way in response.get_ways(member.ref)):
+            return True
+    return False
+
+
+def fetch_overpass_raw(url, query):
+    """
+    Executes Overpass query and returns raw response body, without parsing it. Raises same exceptions as overpy, so
+    only JSON or XML with OSM data is ever returned (and cached). Queries which failed midway are raised as timeouts,
+    to be retried, as partial data is not an answer.
+    """
+    try:
+        f = urllib.request.urlopen(url, query.encode('utf-8'))
+    except urllib.error.HTTPError as e:
+        f = e
+    with f:
+        response = f.read()
+    if f.code == 200:
+        # Overpass sometimes returns HTML error page with 200
+        content_type = f.headers.get('Content-Type', '')
+        if content_type.split(';')[0].strip() not in ('application/json', 'application/osm3s+xml'):
+            raise OverpassUnknownContentType(content_type)
+        runtime_error = _OVERPASS_RUNTIME_ERROR_RE.search(response)
+        if runtime_error is not None:
+            remark = runtime_error.group(1) or runtime_error.group(2)
+            print('Overpass query failed: {0}'.format(remark.decode('utf-8', errors='replace').strip()))
+            raise OverpassGatewayTimeout
+        return response
+    if f.code == 400:
+        msgs = [_OVERPASS_TAG_RE.sub(b'', m.group('msg')).decode('utf-8', errors='replace')
+                for m in _OVERPASS_ERROR_MSG_RE.finditer(response)]
+        raise OverpassBadRequest(query, msgs=msgs)
+    if f.code == 429:
+        e = OverpassTooManyRequests()
+        e.retry_after = f.headers.get('Retry-After')
+        raise e
+    if f.code == 504:
+        raise OverpassGatewayTimeout
+    raise OverpassUnknownHTTPStatusCode(f.code)
+
+
+def query_compact(api, query):
+    """
+    Same as api.query, but Overpass is asked for JSON, which is decoded into compact arrays (CompactResult) instead
+    of graph of overpy objects. Goes through on-disk cache, if api has it.
+    """
+    query = '[out:json];\n' + query
+    fetch_raw = getattr(api, 'fetch_raw', None)
+    response = fetch_raw(query) if fetch_raw is not None else fetch_overpass_raw(api.url, query)
+    return parse_compact_json(response)
+
+
 @retry_on_error(timeout_in_seconds=2*60)
 def get_polygon_by_cadastre_id(api, admin_level, cadastre_id, country, id_key):
-    response = api.query("""
+    response = query_compact(api, """
     area["name"="{0}"]["admin_level"=2]->.c;
     relation(area.c)["admin_level"={1}]["{2}"={3}];
-    (._;>;);
     out;
+    way(r);
+    out;
+    node(w);
+    out skel;
     // &contact=https://github.com/stalker314314/osm-admin-boundary-conflation/
     """.format(country, admin_level, id_key, cadastre_id))
     print('relations found for cadastre id {0}: {1}'.format(cadastre_id, len(response.relations)))
@@ -86,77 +291,382 @@ def get_polygon_by_cadastre_id(api, admin_level, cadastre_id, country, id_key):
     return polygon, response.relations[0].tags['name'], response.relations[0].id, national_border
 
 
-def load_level9_features(input_csv_file):
+def group_relations_by_tag(response, key):
+    """
+    :return: Map of tag value => list(relations having that tag value)
+    """
+    relations_by_value = {}
+    for relation in response.relations:
+        if key in relation.tags:
+            relations_by_value.setdefault(relation.tags[key], []).append(relation)
+    return relations_by_value
+
+
+def _escape_overpass_regex(value):
+    # Backslash needs to be doubled, as Overpass QL string will unescape it once before it gets to regex
+    return re.sub(r'([.^$*+?()\[\]{}|\\])', r'\\\\\1', str(value))
+
+
+@retry_on_error(timeout_in_seconds=2*60)
+def get_polygons_by_cadastre_ids(api, admin_level, cadastre_ids, country, id_key):
+    """
+    Batched variant of get_polygon_by_cadastre_id. Fetches all given cadastre ids in a single Overpass query.
+
+    :return: Map of cadastre_id => (polygon, name, relation id, national_border), same as what
+    get_polygon_by_cadastre_id returns for each of them
+    """
+    response = query_compact(api, """
+    area["name"="{0}"]["admin_level"=2]->.c;
+    relation(area.c)["admin_level"={1}]["{2}"~"^({3})$"];
+    out;
+    way(r);
+    out;
+    node(w);
+    out skel;
+    // &contact=https://github.com/stalker314314/osm-admin-boundary-conflation/
+    """.format(country, admin_level, id_key, '|'.join(_escape_overpass_regex(c) for c in cadastre_ids)))
+    relations_by_id = group_relations_by_tag(response, id_key)
+    polygons = {}
+    for cadastre_id in cadastre_ids:
+        relations = relations_by_id.get(str(cadastre_id), [])
+        print('relations found for cadastre id {0}: {1}'.format(cadastre_id, len(relations)))
+        if len(relations) != 1:
+            polygons[cadastre_id] = (None, None, None, None)
+            continue
+        polygon = create_geometry_from_osm_response(relations[0], response)
+        polygons[cadastre_id] = (polygon, relations[0].tags['name'], relations[0].id,
+                                 is_national_border(relations[0], response))
+    return polygons
+
+
+@retry_on_error(timeout_in_seconds=2*60)
+def get_relation_versions(api, admin_level, country, id_key):
+    """
+    Versions of all relations of a given admin level, without their geometry.
+
+    :return: Map of cadastre id => (relation id, relation version), for cadastre ids found in exactly one relation
+    """
+    response = api.query("""
+    area["name"="{0}"]["admin_level"=2]->.c;
+    relation(area.c)["admin_level"={1}]["{2}"];
+    out meta;
+    // &contact=https://github.com/stalker314314/osm-admin-boundary-conflation/
+    """.format(country, admin_level, id_key))
+    relation_versions = {}
+    for cadastre_id, relations in group_relations_by_tag(response, id_key).items():
+        if len(relations) == 1:
+            relation_versions[cadastre_id] = (relations[0].id, relations[0].attributes.get('version'))
+    return relation_versions
+
+
+@retry_on_error(timeout_in_seconds=2*60)
+def get_changed_cadastre_ids(api, admin_level, country, id_key, since):
+    """
+    Cadastre ids of relations of a given admin level, which geometry could have changed after given timestamp, because
+    relation itself, any of its ways or any node of those ways was changed (Overpass needs to keep metadata for this).
+    """
+    response = api.query("""
+    area["name"="{0}"]["admin_level"=2]->.c;
+    relation(area.c)["admin_level"={1}]["{2}"]->.all;
+    way(r.all)->.ways;
+    node(w.ways)(newer:"{3}")->.moved_nodes;
+    (way.ways(newer:"{3}"); way.ways(bn.moved_nodes);)->.changed_ways;
+    (relation.all(newer:"{3}"); relation.all(bw.changed_ways););
+    out tags;
+    // &contact=https://github.com/stalker314314/osm-admin-boundary-conflation/
+    """.format(country, admin_level, id_key, since))
+    return set(group_relations_by_tag(response, id_key).keys())
+
+
+@retry_on_error()
+def get_entities_shared_with_level9_ways(api, level9_ids, country, id_key):
+    """
+    All ways of level9 relations with given ids, all ways sharing nodes with them and all relations having any of those
+    ways or nodes as members
+    """
+    response = query_compact(api, """
+        area["name"="{0}"]["admin_level"=2]->.a;
+        relation(area.a)["boundary"="administrative"]["admin_level"=9]["{1}"~"^({2})$"]->.settlements;
+        way(r.settlements)->.candidates;
+        node(w.candidates)->.candidateNodes;
+        way(bn.candidateNodes)->.sharingWays;
+        (relation(bn.candidateNodes); relation(bw.sharingWays);)->.sharingRelations;
+        (.sharingWays; .sharingRelations;);
+        out;
+        // &contact=https://github.com/stalker314314/osm-admin-boundary-conflation/
+        """.format(country, id_key, '|'.join(_escape_overpass_regex(level9_id) for level9_id in level9_ids)))
+    return response
+
+
+def iter_polygons_by_cadastre_ids(api, admin_level, cadastre_ids, country, id_key, batch_size, controller=None):
+    """
+    Lazily yields (cadastre_id, (polygon, name, relation id, national_border)) for each of given cadastre ids, in same
+    order, fetching them from Overpass in batches of batch_size. If concurrency controller is given, next batches are
+    fetched ahead, as many at once as controller allows.
+    """
+    cadastre_ids = list(cadastre_ids)
+    batches = [cadastre_ids[i:i + batch_size] for i in range(0, len(cadastre_ids), batch_size)]
+    tasks = ((api, admin_level, batch, country, id_key) for batch in batches)
+    if controller is None:
+        for batch, task in zip(batches, tasks):
+            polygons = get_polygons_by_cadastre_ids(*task)
+            for cadastre_id in batch:
+                yield cadastre_id, polygons[cadastre_id]
+        return
+    with ThreadPoolExecutor(max_workers=controller.max_concurrency) as executor:
+        batch_polygons = run_adaptive(executor, controller, get_polygons_by_cadastre_ids, tasks, ordered=True)
+        for batch, polygons in zip(batches, batch_polygons):
+            for cadastre_id in batch:
+                yield cadastre_id, polygons[cadastre_id]
+
+
+LEVEL9_ATTRIBUTES = ('level9_id', 'level9_name', 'level8_id', 'level8_name', 'level7_id', 'level7_name', 'level6_id',
+                     'level6_name')
+
+
+class Level9Feature(dict):
+    """
+    Level9 feature from input file, as dict with its name, id and (level8, level7, level6) names and ids. Geometry is
+    parsed only when geometry property is read. Geometry reference is either (file, offset, length) in WKB sidecar of
+    .csv, or GeoJSON-like geometry read from .fgb.
+    """
+
+    def __init__(self, attributes, geometry_reference, bbox, geometry_hash=None):
+        super(Level9Feature, self).__init__(attributes)
+        self.geometry_reference = geometry_reference
+        self.bbox = bbox
+        self._geometry_hash = geometry_hash
+
+    @property
+    def geometry(self):
+        if isinstance(self.geometry_reference, tuple):
+            return load_geometry(self.geometry_reference)
+        return geometry.shape(self.geometry_reference)
+
+    @property
+    def geometry_hash(self):
+        """
+        SHA-1 of geometry as it is in input file - of WKT for .csv (same as in older measurements), of WKB for .fgb
+        """
+        if self._geometry_hash is None:
+            self._geometry_hash = hashlib.sha1(self.geometry.wkb).hexdigest()
+        return self._geometry_hash
+
+
+def get_level9_sidecar_files(input_csv_file):
+    return input_csv_file + '.wkb', input_csv_file + '.wkb.index'
+
+
+def _load_level9_sidecar_index(input_csv_file):
+    """
+    Loads index of sidecar of a given .csv, or returns None if there is no sidecar, or if .csv changed after it was
+    written
+    """
+    sidecar_file, index_file = get_level9_sidecar_files(input_csv_file)
+    if not os.path.isfile(sidecar_file) or not os.path.isfile(index_file):
+        return None
+    with open(index_file, 'rb') as p:
+        index = pickle.load(p)
+    csv_stat = os.stat(input_csv_file)
+    if index['csv_size'] != csv_stat.st_size or index['csv_mtime'] != csv_stat.st_mtime:
+        return None
+    return index
+
+
+def _write_level9_sidecar(input_csv_file):
+    """
+    Streams .csv once, writing all geometries as WKB to sidecar file, and their attributes, positions in sidecar,
+    bounds and hash of WKT to index file
+    """
+    sidecar_file, index_file = get_level9_sidecar_files(input_csv_file)
+    csv_stat = os.stat(input_csv_file)
+    features = []
+    wkt_hashes = []
+
+    def iter_wkts():
+        with open(input_csv_file) as input_csv:
+            reader = csv.DictReader(input_csv)
+            for row in reader:
+                features.append({key: row[key] for key in LEVEL9_ATTRIBUTES})
+                wkt_hashes.append(hashlib.sha1(row['wkt'].encode('utf-8')).hexdigest())
+                yield row['wkt']
+
+    # Write to temporary file first, so other processes never map half-written sidecar
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(sidecar_file)))
+    os.close(fd)
+    try:
+        references, bounds = write_geometry_store(tmp_file, iter_wkts())
+        os.chmod(tmp_file, 0o644)
+        close_geometry_store(sidecar_file)
+        os.replace(tmp_file, sidecar_file)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    index = {'csv_size': csv_stat.st_size, 'csv_mtime': csv_stat.st_mtime, 'features': features,
+             'references': references, 'bounds': bounds, 'wkt_hashes': wkt_hashes}
+    Path(index_file).touch()  # need to touch file for atomic writes later
+    with atomic_write(index_file, text=False, keep=False) as h:
+        pickle.dump(index, h, protocol=pickle.DEFAULT_PROTOCOL)
+    return index
+
+
+def _iter_level9_features_fgb(input_fgb_file, bbox=None):
+    """
+    Reads level9 features from FlatGeobuf file. Its spatial index is used when reading features within bbox.
+    """
+    import fiona
+
+    with fiona.open(input_fgb_file) as source:
+        for feature in source.filter(bbox=bbox) if bbox is not None else source:
+            properties = feature['properties']
+            attributes = {key: '' if properties.get(key) is None else str(properties[key]) for key in LEVEL9_ATTRIBUTES}
+            # Newer fiona returns geometry objects instead of dicts, keep it as plain GeoJSON-like dict
+            geometry_mapping = getattr(feature['geometry'], '__geo_interface__', feature['geometry'])
+            yield Level9Feature(attributes, geometry_mapping, tuple(fiona.bounds(geometry_mapping)))
+
+
+def iter_level9_features(input_file, bbox=None):
+    """
+    Lazily yields all level9 features (see Level9Feature) from input .csv or .fgb (FlatGeobuf) file. On first read,
+    .csv is converted to WKB sidecar next to it (rewritten whenever .csv changes), so later loads neither read nor
+    parse WKT.
+
+    :param bbox: If given as (minx, miny, maxx, maxy), only features which bounds intersect it are yielded
+    """
+    if input_file.endswith('.fgb'):
+        yield from _iter_level9_features_fgb(input_file, bbox)
+        return
+    input_csv_file = input_file
+    index = _load_level9_sidecar_index(input_csv_file)
+    if index is None:
+        print('Writing geometries from {0} to sidecar'.format(input_csv_file))
+        index = _write_level9_sidecar(input_csv_file)
+    sidecar_file, _ = get_level9_sidecar_files(input_csv_file)
+    bounds = index['bounds']
+    if bbox is None:
+        positions = range(len(index['features']))
+    else:
+        positions = np.flatnonzero((bounds[:, 0] <= bbox[2]) & (bounds[:, 2] >= bbox[0]) &
+                                   (bounds[:, 1] <= bbox[3]) & (bounds[:, 3] >= bbox[1]))
+    for i in positions:
+        offset, length = index['references'][i]
+        yield Level9Feature(index['features'][i], (sidecar_file, offset, length), tuple(bounds[i].tolist()),
+                            index['wkt_hashes'][i])
+
+
+def load_level9_features(input_file):
     """
     List of all level9 features with their name, id and (level8, level7, level6) names and ids
     """
-    level9_features = []
-    with open(input_csv_file) as input_csv:
-        reader = csv.DictReader(input_csv)
-        for row in reader:
-            level9_features.append({
-                'level9_id': row['level9_id'],
-                'level9_name': row['level9_name'],
-                'level8_id': row['level8_id'],
-                'level8_name': row['level8_name'],
-                'level7_id': row['level7_id'],
-                'level7_name': row['level7_name'],
-                'level6_id': row['level6_id'],
-                'level6_name': row['level6_name'],
-                'wkt': row['wkt'],
-            })
-    return level9_features
-
-
-def get_municipality_settlements():
-    """
-    :return: Map of level8_id => list(level8 entities)
-    """
-    municipality_settlements = {}
-    municipality_names = {}
-    with open('input/naselje.csv') as settlement_csv:
-        reader = csv.DictReader(settlement_csv)
-        for row in reader:
-            if row['opstina_maticni_broj'] not in municipality_names:
-                municipality_names[row['opstina_maticni_broj']] = row['opstina_ime']
-            if row['opstina_maticni_broj'] not in municipality_settlements:
-                municipality_settlements[row['opstina_maticni_broj']] = []
-            municipality_settlements[row['opstina_maticni_broj']].append(row['naselje_maticni_broj'])
-    municipality_settlements = OrderedDict(sorted(municipality_settlements.items(), key=lambda x: x))
-    return municipality_settlements
-
-
-def get_settlement_municipality():
+    return list(iter_level9_features(input_file))
+
+
+class AdminHierarchy(object):
+    """
+    Level9 -> level8 -> level7 -> level6 hierarchy of all entities from input file, with their names. All lookups are
+    single dict lookups. Ids are strings, as they are in input file. Level7 is often empty, so level8 is also mapped
+    directly to its level6.
+    """
+
+    def __init__(self):
+        self.names = {6: {}, 7: {}, 8: {}, 9: {}}  # admin level => (id => name)
+        self.level9_level8 = {}  # level9 id => level8 id
+        self.level8_level7 = {}  # level8 id => level7 id
+        self.level8_level6 = {}  # level8 id => level6 id
+        self.level7_level6 = {}  # level7 id => level6 id
+        self.level8_level9s = {}  # level8 id => list(level9 ids), in order from input file
+
+    @classmethod
+    def build(cls, level9_features):
+        hierarchy = cls()
+        for f in level9_features:
+            for admin_level in (6, 7, 8, 9):
+                entity_id = f['level{0}_id'.format(admin_level)]
+                if entity_id not in (None, '') and entity_id not in hierarchy.names[admin_level]:
+                    hierarchy.names[admin_level][entity_id] = f['level{0}_name'.format(admin_level)]
+            hierarchy.level9_level8[f['level9_id']] = f['level8_id']
+            hierarchy.level8_level9s.setdefault(f['level8_id'], []).append(f['level9_id'])
+            hierarchy.level8_level7.setdefault(f['level8_id'], f['level7_id'])
+            hierarchy.level8_level6.setdefault(f['level8_id'], f['level6_id'])
+            if f['level7_id'] not in (None, ''):
+                hierarchy.level7_level6.setdefault(f['level7_id'], f['level6_id'])
+        return hierarchy
+
+    def get_name(self, admin_level, entity_id):
+        return self.names[admin_level].get(entity_id)
+
+    def get_level8_id(self, level9_id):
+        return self.level9_level8.get(level9_id)
+
+    def get_level7_id(self, level8_id):
+        return self.level8_level7.get(level8_id)
+
+    def get_level6_id(self, level8_id):
+        return self.level8_level6.get(level8_id)
+
+    def get_level9_ids(self, level8_id):
+        return self.level8_level9s.get(level8_id, [])
+
+    def get_level8_ids(self):
+        return list(self.level8_level9s.keys())
+
+
+_admin_hierarchies = {}
+
+
+def load_admin_hierarchy(input_file):
+    """
+    Loads hierarchy of entities from input .csv or .fgb. It is built only once and saved next to input file (as
+    <input_file>.hierarchy), until input file changes. In same process, it is loaded only once.
+    """
+    input_stat = os.stat(input_file)
+    source = (input_stat.st_size, input_stat.st_mtime)
+    if input_file in _admin_hierarchies and _admin_hierarchies[input_file][0] == source:
+        return _admin_hierarchies[input_file][1]
+    cache_file = input_file + '.hierarchy'
+    hierarchy = None
+    if os.path.isfile(cache_file):
+        with open(cache_file, 'rb') as p:
+            cached_source, hierarchy = pickle.load(p)
+        if cached_source != source:
+            hierarchy = None
+    if hierarchy is None:
+        print('Building admin hierarchy from {0}'.format(input_file))
+        hierarchy = AdminHierarchy.build(iter_level9_features(input_file))
+        Path(cache_file).touch()  # need to touch file for atomic writes later
+        with atomic_write(cache_file, text=False, keep=False) as h:
+            pickle.dump((source, hierarchy), h, protocol=pickle.DEFAULT_PROTOCOL)
+    _admin_hierarchies[input_file] = (source, hierarchy)
+    return hierarchy
+
+
+def get_municipality_settlements(input_file):
+    """
+    :return: Map of level8_id => list(level9 ids)
+    """
+    hierarchy = load_admin_hierarchy(input_file)
+    return OrderedDict(sorted(hierarchy.level8_level9s.items(), key=lambda x: x))
+
+
+def get_settlement_municipality(input_file):
     """
     :return: Map of level9_id => level8_id
     """
-    settlements_municipality = {}
-    with open('input/naselje.csv') as naselja_csv:
-        reader = csv.DictReader(naselja_csv)
-        for row in reader:
-            settlements_municipality[int(row['naselje_maticni_broj'])] = int(row['opstina_maticni_broj'])
-    return settlements_municipality
+    hierarchy = load_admin_hierarchy(input_file)
+    return {int(level9_id): int(level8_id) for level9_id, level8_id in hierarchy.level9_level8.items()}
 
 
-def get_municipality_district():
+def get_municipality_district(input_file):
     """
     :return: Map of level8_id => level6
     """
-    municipality_district = {}
-    with open('input/opstina.csv') as naselja_csv:
-        reader = csv.DictReader(naselja_csv)
-        for row in reader:
-            municipality_district[int(row['opstina_maticni_broj'])] = int(row['okrug_sifra'])
-    return municipality_district
+    hierarchy = load_admin_hierarchy(input_file)
+    return {int(level8_id): int(level6_id) for level8_id, level6_id in hierarchy.level8_level6.items()}
 
 
-def get_district_name_by_id():
+def get_district_name_by_id(input_file):
     """
     :return: Map of level6_id => level6
     """
-    districts = {}
-    with open('input/opstina.csv') as naselja_csv:
-        reader = csv.DictReader(naselja_csv)
-        for row in reader:
-            districts[int(row['okrug_sifra'])] = row['okrug_ime']
-    return districts
+    hierarchy = load_admin_hierarchy(input_file)
+    return {int(level6_id): name for level6_id, name in hierarchy.names[6].items()}
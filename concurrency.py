@@ -0,0 +1,108 @@
+"""
+Adaptive concurrency for Overpass workers. Number of queries in flight is raised additively while Overpass answers
+fast and without errors, and cut multiplicatively (AIMD) on timeouts, 429s and connection errors, so that scripts
+use as much of Overpass as it can give, but no more.
+"""
+
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from retry_policy import errors_in_current_thread
+
+
+class AIMDController(object):
+    """
+    Keeps current concurrency limit between min_concurrency and max_concurrency. Each healthy task raises the limit by
+    1/limit (so, by one per full window of tasks). Task is healthy if it had no errors and its latency is below
+    latency_factor times the best latency seen so far. Tasks with errors multiply limit by decrease_factor, but only once
+    per window (tasks started before last decrease are ignored, as they saw old limit).
+    """
+
+    def __init__(self, min_concurrency=1, max_concurrency=8, initial_concurrency=None, latency_factor=2.0,
+                 decrease_factor=0.5):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max(min_concurrency, max_concurrency)
+        initial_concurrency = min_concurrency if initial_concurrency is None else initial_concurrency
+        self.window = float(min(self.max_concurrency, max(min_concurrency, initial_concurrency)))
+        self.latency_factor = latency_factor
+        self.decrease_factor = decrease_factor
+        self.best_latency = None
+        self.last_decrease = 0
+        print('Starting with concurrency {0} (min {1}, max {2})'.format(self.limit, min_concurrency,
+                                                                         self.max_concurrency))
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**config.get('concurrency', {}))
+
+    @property
+    def limit(self):
+        return int(self.window)
+
+    def record(self, latency, errors, started_at):
+        old_limit = self.limit
+        if errors > 0:
+            if started_at < self.last_decrease:
+                return
+            self.window = max(float(self.min_concurrency), self.window * self.decrease_factor)
+            self.last_decrease = time.monotonic()
+            reason = '{0} errors'.format(errors)
+        else:
+            if self.best_latency is None or latency < self.best_latency:
+                self.best_latency = latency
+            if latency > self.latency_factor * self.best_latency:
+                return
+            self.window = min(float(self.max_concurrency), self.window + 1 / self.window)
+            reason = 'latency {0:.2f}s'.format(latency)
+        if self.limit != old_limit:
+            print('Concurrency {0} -> {1} ({2})'.format(old_limit, self.limit, reason))
+
+
+def measured_call(func, *args):
+    """
+    Runs func in worker, returning its result together with how long it took and how many retryable errors it hit
+    """
+    errors_before = errors_in_current_thread()
+    start = time.monotonic()
+    result = func(*args)
+    return result, time.monotonic() - start, errors_in_current_thread() - errors_before
+
+
+def run_adaptive(executor, controller, func, tasks, ordered=False):
+    """
+    Runs func(*args) for each args in tasks on executor, keeping at most controller.limit of them in flight. Executor
+    should have at least controller.max_concurrency workers. Tasks are consumed lazily.
+
+    :return: Generator of results, in order of completion (or in order of tasks, if ordered is True)
+    """
+    tasks = enumerate(tasks)
+    in_flight = {}
+    completed = {}
+    next_to_yield = 0
+    no_more_tasks = False
+    try:
+        while True:
+            while not no_more_tasks and len(in_flight) < controller.limit:
+                task = next(tasks, None)
+                if task is None:
+                    no_more_tasks = True
+                    break
+                i, args = task
+                in_flight[executor.submit(measured_call, func, *args)] = (i, time.monotonic())
+            if len(in_flight) == 0:
+                return
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                i, started_at = in_flight.pop(future)
+                result, latency, errors = future.result()
+                controller.record(latency, errors, started_at)
+                if ordered:
+                    completed[i] = result
+                else:
+                    yield result
+            while next_to_yield in completed:
+                yield completed.pop(next_to_yield)
+                next_to_yield = next_to_yield + 1
+    finally:
+        for future in in_flight:
+            future.cancel()
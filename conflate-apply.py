@@ -0,0 +1,175 @@
+"""
+Uploads conflation plan (osmChange file written in dry run of conflate.py, see "conflation_plan_file" in config.yml)
+to OSM. Nodes and ways from plan are first compared with their current versions in OSM, with few bulk calls. Ways
+where anything changed since plan was made are not uploaded, but are returned to "not yet considered" state, so next
+run of conflate.py checks them again. All other ways are uploaded many at once, and marked as conflated in progress
+file. Nothing is asked from Overpass, and ways are not checked one by one again. Ways are packed into changesets by
+where they are (see changeset_scheduler.py), so each changeset covers one compact area.
+"""
+
+import sys
+
+import yaml
+from osmapi import ApiError, OsmApi
+
+from changeset_scheduler import schedule_changesets
+from osm_change import ChangesetUploader, find_conflicts, get_changeset_tags, read_osm_change_plan
+from processing_state import ProcessingState
+from progress_store import ProgressStore
+
+# How many elements (nodes and ways) to upload in one diff
+UPLOAD_SIZE = 1000
+
+
+def drop_applied_nodes(osm_change, applied_nodes):
+    """
+    Neighbouring ways share end nodes, so planned changes of both of them move that node (to same place). Once one of
+    them is uploaded, that node is dropped from the other one.
+
+    :param applied_nodes: Map of node id => (lon, lat) of node as it is uploaded, or None if node is deleted
+    :return: Reason why change can no longer be applied, or None if it can
+    """
+    for node_id, node in list(osm_change.modified_nodes.items()):
+        if node_id not in applied_nodes:
+            continue
+        if applied_nodes[node_id] != (node['lon'], node['lat']):
+            return f'node {node_id} is already changed by other way'
+        del osm_change.modified_nodes[node_id]
+    for node_id in osm_change.deleted_nodes:
+        if node_id in applied_nodes:
+            return f'node {node_id} is already changed by other way'
+    return None
+
+
+def upload(uploader, osm_changes):
+    """
+    Uploads changes as one diff. OSM applies diff whole or not at all, so if it fails, changes are uploaded one by one,
+    to find which ones can't be applied.
+
+    :return: List of changes which could not be uploaded
+    """
+    try:
+        uploader.upload([change for osm_change in osm_changes for change in osm_change.to_changes()])
+        return []
+    except ApiError as e:
+        if len(osm_changes) == 1:
+            print(f'Cannot upload way https://www.openstreetmap.org/way/{osm_changes[0].way_id}: {e}')
+            return osm_changes
+        print(f'Uploading {len(osm_changes)} ways together failed ({e.status} {e.reason}), uploading them one by one')
+        failed = []
+        for osm_change in osm_changes:
+            failed.extend(upload(uploader, [osm_change]))
+        return failed
+
+
+class PlanUploader(object):
+    """
+    Collects changes of ways and uploads them in diffs of up to UPLOAD_SIZE elements. Conflated ways are saved to
+    progress store right after their diff is uploaded, and ways which can't be uploaded are returned to NO state.
+    """
+    def __init__(self, uploader, progress_store, way_states, source_ways):
+        self.uploader = uploader
+        self.progress_store = progress_store
+        self.way_states = way_states
+        self.source_ways = source_ways
+        self.applied_nodes = {}
+        self.pending = []
+        self.pending_nodes = set()
+        self.pending_size = 0
+        self.count_conflated = 0
+        self.count_failed = 0
+
+    def add(self, osm_change):
+        touched_nodes = set(osm_change.modified_nodes) | set(osm_change.deleted_nodes)
+        # Changes touching same node are never uploaded together, so that each of them can fail on its own
+        if self.pending_size + len(osm_change) > UPLOAD_SIZE or len(touched_nodes & self.pending_nodes) > 0:
+            self.flush()
+        reason = drop_applied_nodes(osm_change, self.applied_nodes)
+        if reason is not None:
+            print(f'Cannot upload way https://www.openstreetmap.org/way/{osm_change.way_id}: {reason}')
+            self.save_way(osm_change.way_id, ProcessingState.NO)
+            self.count_failed = self.count_failed + 1
+            return
+        self.pending.append(osm_change)
+        self.pending_nodes.update(osm_change.modified_nodes)
+        self.pending_nodes.update(osm_change.deleted_nodes)
+        self.pending_size = self.pending_size + len(osm_change)
+
+    def flush(self):
+        if len(self.pending) == 0:
+            return
+        failed = upload(self.uploader, self.pending)
+        for osm_change in self.pending:
+            if osm_change in failed:
+                self.save_way(osm_change.way_id, ProcessingState.NO)
+                continue
+            self.applied_nodes.update((node_id, (node['lon'], node['lat']))
+                                      for node_id, node in osm_change.modified_nodes.items())
+            self.applied_nodes.update((node_id, None) for node_id in osm_change.deleted_nodes)
+            self.save_way(osm_change.way_id, ProcessingState.CONFLATED)
+        self.count_conflated = self.count_conflated + len(self.pending) - len(failed)
+        self.count_failed = self.count_failed + len(failed)
+        print(f'Uploaded {self.count_conflated} ways')
+        self.pending, self.pending_nodes, self.pending_size = [], set(), 0
+
+    def save_way(self, osm_way_id, processed):
+        for way_id in self.source_ways[osm_way_id]:
+            self.way_states[way_id]['processed'] = processed
+            self.way_states[way_id]['error_context'] = None
+            self.progress_store.save_way(way_id, self.way_states[way_id])
+
+
+def main(plan_file, progress_file):
+    with open('config.yml', 'r') as config_yml_file:
+        config = yaml.safe_load(config_yml_file)
+
+    progress_store = ProgressStore.open(progress_file)
+    way_states = progress_store.load_way_states()
+    # OSM way id => ids of source ways to conflate it with
+    source_ways = {}
+    for way_id, way_state in way_states.items():
+        if way_state['processed'] == ProcessingState.CHECKED_POSSIBLE and way_state['osm_way'] is not None:
+            source_ways.setdefault(way_state['osm_way'], []).append(way_id)
+    osm_changes = [osm_change for osm_change in read_osm_change_plan(plan_file) if osm_change.way_id in source_ways]
+    print(f'{len(osm_changes)} ways from {plan_file} are still waiting to be conflated')
+    if len(osm_changes) == 0:
+        return
+
+    osmapi = OsmApi(passwordfile='osm-password')
+    plan_uploader = PlanUploader(ChangesetUploader(osmapi, get_changeset_tags(config),
+                                                   max_elements=config['changesets']['max_elements']),
+                                 progress_store, way_states, source_ways)
+    conflicts = find_conflicts(osmapi, osm_changes)
+    for way_id, reason in conflicts.items():
+        print(f'Way https://www.openstreetmap.org/way/{way_id} changed since plan was made ({reason}), '
+              f'it will be checked again in next run of conflate.py')
+        plan_uploader.save_way(way_id, ProcessingState.NO)
+    osm_changes = [osm_change for osm_change in osm_changes if osm_change.way_id not in conflicts]
+    if not config['auto_proceed']:
+        proceed = input(f'Upload {len(osm_changes)} ways (Y/n)?')
+        if not (proceed == '' or proceed.lower() == 'y' or proceed.lower() == u'з'):
+            return
+
+    changesets = schedule_changesets(osm_changes, max_elements=config['changesets']['max_elements'],
+                                     max_extent=config['changesets']['max_extent'])
+    print(f'Uploading {len(osm_changes)} ways in {len(changesets)} changesets')
+    try:
+        for changeset in changesets:
+            for osm_change in changeset:
+                plan_uploader.add(osm_change)
+            plan_uploader.flush()
+            plan_uploader.uploader.close()
+    finally:
+        plan_uploader.uploader.close()
+        progress_store.close()
+    print(f'Conflated {plan_uploader.count_conflated} ways, '
+          f'{len(conflicts) + plan_uploader.count_failed} ways need to be checked again')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print("Usage: ./conflate-apply.py <plan_file> <progress_file>")
+        exit()
+    plan_file = sys.argv[1]
+    progress_file = sys.argv[2]
+    main(plan_file, progress_file)
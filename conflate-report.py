@@ -6,6 +6,7 @@ from collections import OrderedDict
 from jinja2 import Environment, FileSystemLoader
 
 from processing_state import ProcessingState
+from progress_store import ProgressStore, is_progress_store
 
 errors = {
     ProcessingState.NO: 'Not yet considered.',
@@ -37,13 +38,19 @@ def main(progress_file, output_html_file):
     env = Environment(loader=FileSystemLoader(searchpath='./templates'))
     template = env.get_template('index_template.html')
 
-    with open(progress_file, 'rb') as p:
-        source_data = pickle.load(p)
-    total_ways = len(source_data['ways'])
-    processed_ways = len([w for w in source_data['ways'].values() if w['processed'] != ProcessingState.NO])
-    ways_with_osm_ways_found = len([w for w in source_data['ways'].values() if w['osm_way'] is not None])
+    if is_progress_store(progress_file):
+        progress_store = ProgressStore(progress_file)
+        way_states = progress_store.load_way_states()
+        progress_store.close()
+    else:
+        # Progress file from older versions, with whole source data pickled
+        with open(progress_file, 'rb') as p:
+            way_states = {way_id: dict(way) for way_id, way in pickle.load(p)['ways'].items()}
+    total_ways = len(way_states)
+    processed_ways = len([w for w in way_states.values() if w['processed'] != ProcessingState.NO])
+    ways_with_osm_ways_found = len([w for w in way_states.values() if w['osm_way'] is not None])
     count_per_error = {}
-    for w in source_data['ways'].values():
+    for w in way_states.values():
         if w['processed'] not in count_per_error:
             count_per_error[w['processed']] = 0
         count_per_error[w['processed']] += 1
@@ -68,7 +75,7 @@ def main(progress_file, output_html_file):
     print('Count per error:\n{0}'.format(pp.pformat(count_per_error)))
     count_per_error = OrderedDict(sorted(count_per_error.items(), key=lambda x: x[1], reverse=True))
 
-    source_data = {k: source_data['ways'][k] for k in list(source_data['ways'])[0:-1]}
+    source_data = {k: way_states[k] for k in list(way_states)[0:-1]}
     output = template.render(total_ways=total_ways, processed_ways=processed_ways, errors=errors,
                              count_per_error=count_per_error, ways_with_osm_ways_found=ways_with_osm_ways_found,
                              source_data=source_data)
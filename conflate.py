@@ -1,70 +1,93 @@
 import math
 import os
-import pickle
 import sys
 import time
 import xml.etree.ElementTree as ET
-from pathlib import Path
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import matplotlib.pyplot as plt
-import overpy
+import numpy as np
 import pyproj
 import shapely.geometry as geometry
 import yaml
 from osmapi import OsmApi
 from shapely.ops import linemerge
 
-from atomic_write import atomic_write
-from common import retry_on_error
+from boundary_store import BoundaryStore, load_boundary_store
+from common import retry_on_error, configure_retry_policy, query_compact
+from osm_data import NodeStore, WayStore
+from osm_change import ChangesetUploader, ConflationPlan, OsmChange, get_changeset_tags
+from overpass_cache import create_overpass_api
 from processing_state import ProcessingState
+from progress_store import ProgressStore
+from shared_entities import SharedEntityIndex
+
+GEOD = pyproj.Geod(ellps='WGS84')
 
 
 def load_osm(path):
-    nodes = {}
-    ways = {}
+    """
+    Streams .osm file and loads it in compact form (see osm_data.py)
+    """
+    node_ids, lats, lons = array('q'), array('d'), array('d')
+    way_ids, way_offsets, way_refs = array('q'), array('q', [0]), array('q')
     relations = {}
-    root = ET.parse(path).getroot()
-    for node in root.findall('node'):
-        nodes[int(node.attrib['id'])] = {
-            'lat': float(node.attrib['lat']),
-            'lon': float(node.attrib['lon'])
-        }
-
-    for way in root.findall('way'):
-        way_nodes = []
-        for child in way.iter('nd'):
-            way_nodes.append(int(child.attrib['ref']))
-        ways[int(way.attrib['id'])] = {
-            'nodes': way_nodes,
-            'relations': '',
-            'processed': ProcessingState.NO,
-            'error_context': None,
-            'osm_way': None
-        }
-
-    for relation in root.findall('relation'):
-        relation_ways = []
-        for child in relation.iter('member'):
-            relation_ways.append(
-                {
-                    'ref': int(child.attrib['ref']),
-                    'role': child.attrib['role'],
-                    'type': child.attrib['type']
-                })
-        tags = {}
-        for child in relation.iter('tag'):
-            tags[child.attrib['k']] = child.attrib['v']
-        relations[int(relation.attrib['id'])] = {
-            'ways': relation_ways,
-            'tags': tags
-        }
-
-    return {'relations': relations, 'ways': ways, 'nodes': nodes}
+    context = ET.iterparse(path, events=('start', 'end'))
+    _, root = next(context)
+    for event, elem in context:
+        if event != 'end':
+            continue
+        if elem.tag == 'node':
+            node_ids.append(int(elem.attrib['id']))
+            lats.append(float(elem.attrib['lat']))
+            lons.append(float(elem.attrib['lon']))
+        elif elem.tag == 'way':
+            way_ids.append(int(elem.attrib['id']))
+            way_refs.extend(int(child.attrib['ref']) for child in elem.iter('nd'))
+            way_offsets.append(len(way_refs))
+        elif elem.tag == 'relation':
+            relation_ways = []
+            for child in elem.iter('member'):
+                relation_ways.append(
+                    {
+                        'ref': int(child.attrib['ref']),
+                        'role': sys.intern(child.attrib['role']),
+                        'type': sys.intern(child.attrib['type'])
+                    })
+            tags = {}
+            for child in elem.iter('tag'):
+                tags[child.attrib['k']] = child.attrib['v']
+            relations[int(elem.attrib['id'])] = {
+                'ways': relation_ways,
+                'tags': tags
+            }
+        else:
+            continue
+        root.clear()
+
+    return {'relations': relations, 'ways': WayStore(way_ids, way_offsets, way_refs),
+            'nodes': NodeStore(node_ids, lats, lons), 'way_relations': index_way_relations(relations)}
+
+
+def index_way_relations(relations):
+    """
+    :return: Map of way_id => list(ids of relations this way is member of)
+    """
+    way_relations = {}
+    for relation_id, relation in relations.items():
+        for w in relation['ways']:
+            relation_ids = way_relations.setdefault(w['ref'], [])
+            assert relation_id not in relation_ids
+            relation_ids.append(relation_id)
+    return way_relations
 
 
 @retry_on_error()
 def get_osm_shared_ways(api, r1, r2, country, id_key):
-    response = api.query(f"""
+    if isinstance(api, BoundaryStore):
+        return api.get_osm_shared_ways(r1, r2, id_key)
+    response = query_compact(api, f"""
         area["name"="{country}"]["admin_level"=2]->.a;
         relation(area.a)["boundary"="administrative"]["admin_level"=9]["{id_key}"="{r1}"]->.firstRelation;
         relation(area.a)["boundary"="administrative"]["admin_level"=9]["{id_key}"="{r2}"]->.secondRelation;
@@ -82,7 +105,9 @@ def get_osm_shared_ways(api, r1, r2, country, id_key):
 
 @retry_on_error()
 def get_osm_single_way(api, r1, country, id_key):
-    response = api.query(f"""
+    if isinstance(api, BoundaryStore):
+        return api.get_osm_single_way(r1, id_key)
+    response = query_compact(api, f"""
         area["name"="{country}"]["admin_level"=2]->.a;
         relation(area.a)["boundary"="administrative"]["admin_level"=9]["{id_key}"="{r1}"]->.firstRelation;
         relation(area.a)["boundary"="administrative"]["admin_level"=9]["{id_key}"!="{r1}"]->.secondRelation;
@@ -98,8 +123,14 @@ def get_osm_single_way(api, r1, country, id_key):
 
 
 @retry_on_error()
-def get_entities_shared_with_way(api, way_id):
-    response = api.query("""
+def get_entities_shared_with_way(api, way_id, shared_entities=None):
+    if isinstance(api, BoundaryStore):
+        return api.get_entities_shared_with_way(way_id)
+    if shared_entities is not None:
+        response = shared_entities.get_entities_shared_with_way(way_id)
+        if response is not None:
+            return response
+    response = query_compact(api, """
         way({0});
         ._;>;
         ._;<;
@@ -134,16 +165,20 @@ def create_geometry_from_osm_file_data(source_data, way):
     return merged
 
 
-def unglue_ways(config, osmapi, way_boundary_id, way_other_id):
+def unglue_ways(config, osmapi, way_boundary_id, way_other_id, shared_entities=None, uploader=None):
     """
     Given admin boundary way and other way that shares some nodes with it, unglues those shared nodes into separate ones
     It adds new node and changes boundary to remove shared one and adds new one at the same place.
-    It will not unglue endpoints
+    It will not unglue endpoints. In dry run, it only checks if ungluing is possible.
+    Ways and nodes are taken from shared_entities, if they were prefetched there. Edits are uploaded with uploader.
     """
     auto_proceed = config['auto_proceed']
+    dry_run = config['dry_run']
 
-    way_boundary = osmapi.WayGet(way_boundary_id)
-    way_other = osmapi.WayGet(way_other_id)
+    if shared_entities is not None:
+        way_boundary, way_other = shared_entities.get_way(way_boundary_id), shared_entities.get_way(way_other_id)
+    else:
+        way_boundary, way_other = osmapi.WayGet(way_boundary_id), osmapi.WayGet(way_other_id)
     if len(way_other['tag']) == 0 or len(way_boundary['tag']) == 0:
         print('One of glued ways do not have any tag. This might be boundary in disguise, skipping')
         return False
@@ -166,29 +201,30 @@ def unglue_ways(config, osmapi, way_boundary_id, way_other_id):
         if not (proceed == '' or proceed.lower() == 'y' or proceed.lower() == u'з'):
             return False
 
-    done_any = False
-    i = 1
+    # Fetch all shared nodes at once and unglue them all in a single diff
+    osm_change = OsmChange()
+    if shared_entities is not None:
+        nodes = shared_entities.get_nodes(shared_nodes)
+    else:
+        nodes = osmapi.NodesGet(list(shared_nodes))
     for shared_node in shared_nodes:
-        node = osmapi.NodeGet(shared_node)
+        node = nodes[shared_node]
         if len(node['tag']) > 0:
             print('Node to be unglued has tags, skipping')
             continue
-        added_node = {'id': -i, 'lon': node['lon'], 'lat': node['lat'], 'tag': {}}
-        i = i + 1
-        osmapi.NodeCreate(added_node)
+        added_node_id = osm_change.create_node(node['lon'], node['lat'])
         index = way_boundary['nd'].index(shared_node)
-        del way_boundary['nd'][index]
-        way_boundary['nd'].insert(index, added_node['id'])
-        done_any = True
-    if done_any:
-        osmapi.WayUpdate(way_boundary)
-        osmapi.flush()
-        return True
-    else:
+        way_boundary['nd'][index] = added_node_id
+    if len(osm_change) == 0:
         return False
+    osm_change.modify_way(way_boundary)
+    if not dry_run:
+        uploader.upload(osm_change.to_changes())
+    return True
 
 
-def is_conflate_possible(config, osmapi, overpass_api, shapely_source_way, found_osm_way, shapely_found_osm_way):
+def is_conflate_possible(config, osmapi, overpass_api, shapely_source_way, found_osm_way, shapely_found_osm_way,
+                         shared_entities=None, uploader=None):
     # Check if source or targets are not huge (we need this as we want to put conflation of way in a single changeset)
     assert len(shapely_source_way.coords) < 3000
     assert len(shapely_found_osm_way.coords) < 2000
@@ -211,7 +247,8 @@ def is_conflate_possible(config, osmapi, overpass_api, shapely_source_way, found
         return ProcessingState.ERROR_UNEXPECTED_TAG, tag
 
     # Check if nodes in way don't belong to any other way or relation
-    response = get_entities_shared_with_way(overpass_api, found_osm_way.id)
+    response = get_entities_shared_with_way(overpass_api, found_osm_way.id, shared_entities)
+    unglued_ways = []
     for way in response.ways:
         if 'admin_level' in way.tags and int(way.tags['admin_level']) <= 2:
             print(f'Way to conflate contains node which is also part of way https://www.openstreetmap.org/way/{way.id} which is national border, skipping')
@@ -219,21 +256,23 @@ def is_conflate_possible(config, osmapi, overpass_api, shapely_source_way, found
         if 'boundary' not in way.tags:
             print(f'Way to conflate contains node which is also part of way https://www.openstreetmap.org/way/{way.id} which do not have boundary tag, skipping')
             if unglue_ways_as_needed:
-                one_way = unglue_ways(config, osmapi, found_osm_way.id, way.id)
+                one_way = unglue_ways(config, osmapi, found_osm_way.id, way.id, shared_entities, uploader)
                 if not one_way:
-                    other_way = unglue_ways(config, osmapi, way.id, found_osm_way.id)
+                    other_way = unglue_ways(config, osmapi, way.id, found_osm_way.id, shared_entities, uploader)
                     if not other_way:
                         return ProcessingState.ERROR_NODE_IN_OTHER_WAYS, str(way.id)
+                unglued_ways.append(str(way.id))
             else:
                 return ProcessingState.ERROR_NODE_IN_OTHER_WAYS, str(way.id)
         elif way.tags['boundary'] != 'administrative':
             print(f'Way to conflate contains node which is also part of way https://www.openstreetmap.org/way/{way.id} which boundary tag != administrative, skipping')
             if unglue_ways_as_needed:
-                one_way = unglue_ways(config, osmapi, found_osm_way.id, way.id)
+                one_way = unglue_ways(config, osmapi, found_osm_way.id, way.id, shared_entities, uploader)
                 if not one_way:
-                    other_way = unglue_ways(config, osmapi, way.id, found_osm_way.id)
+                    other_way = unglue_ways(config, osmapi, way.id, found_osm_way.id, shared_entities, uploader)
                     if not other_way:
                         return ProcessingState.ERROR_NODE_IN_OTHER_WAYS, str(way.id)
+                unglued_ways.append(str(way.id))
             else:
                 return ProcessingState.ERROR_NODE_IN_OTHER_WAYS, str(way.id)
     for relation in response.relations:
@@ -272,48 +311,63 @@ def is_conflate_possible(config, osmapi, overpass_api, shapely_source_way, found
     if should_reverse:
         shapely_source_way.coords = list(shapely_source_way.coords[::-1])
 
-    return ProcessingState.CHECKED_POSSIBLE, None
+    # When conflation is possible, context lists ways which were unglued (or, in dry run, would be) from this way
+    return ProcessingState.CHECKED_POSSIBLE, ','.join(unglued_ways) if len(unglued_ways) > 0 else None
+
+
+def get_distances(coords1, coords2):
+    """
+    Geodesic distances (in meters) between each pair of points from two equally long sequences of (lon, lat) (like
+    shapely coords), computed in one call over whole arrays
+    """
+    coords1 = np.asarray(coords1, dtype=np.float64).reshape(-1, 2)
+    coords2 = np.asarray(coords2, dtype=np.float64).reshape(-1, 2)
+    _, _, distances = GEOD.inv(coords1[:, 0], coords1[:, 1], coords2[:, 0], coords2[:, 1])
+    return np.asarray(distances)
 
 
 def get_bigger_endpoint_difference(shapely_source_way, shapely_found_osm_way):
-    should_reverse = False
-    geod = pyproj.Geod(ellps='WGS84')
-    _, _, distance11 = geod.inv(shapely_found_osm_way.coords[0][0], shapely_found_osm_way.coords[0][1],
-                              shapely_source_way.coords[0][0], shapely_source_way.coords[0][1])
-    _, _, distance12 = geod.inv(shapely_found_osm_way.coords[0][0], shapely_found_osm_way.coords[0][1],
-                              shapely_source_way.coords[-1][0], shapely_source_way.coords[-1][1])
-    if distance12 < distance11:
-        should_reverse = True
+    osm_first, osm_last = shapely_found_osm_way.coords[0], shapely_found_osm_way.coords[-1]
+    source_first, source_last = shapely_source_way.coords[0], shapely_source_way.coords[-1]
+    # Distances first-first, first-last, last-first and last-last
+    distance11, distance12, distance21, distance22 = get_distances(
+        [osm_first, osm_first, osm_last, osm_last], [source_first, source_last, source_first, source_last])
+    should_reverse = bool(distance12 < distance11)
     distance1 = min(distance11, distance12)
-    if should_reverse:
-        _, _, distance2 = geod.inv(shapely_found_osm_way.coords[-1][0], shapely_found_osm_way.coords[-1][1],
-                                   shapely_source_way.coords[0][0], shapely_source_way.coords[0][1])
-    else:
-        _, _, distance2 = geod.inv(shapely_found_osm_way.coords[-1][0], shapely_found_osm_way.coords[-1][1],
-                                   shapely_source_way.coords[-1][0], shapely_source_way.coords[-1][1])
-    return max(distance1, distance2), should_reverse
+    distance2 = distance21 if should_reverse else distance22
+    return float(max(distance1, distance2)), should_reverse
 
 
-def is_same_geometry(shapely_source_way, shapely_found_osm_way):
-    if shapely_source_way.is_closed != shapely_found_osm_way.is_closed:
-        return False
-    if shapely_source_way.is_ring != shapely_found_osm_way.is_ring:
-        return False
+def get_geometry_deviation(shapely_source_way, shapely_found_osm_way):
+    """
+    Distances between each node of source way and corresponding node of OSM way. Source way is reversed in place if it
+    goes in opposite direction.
+
+    :return: Tuple (max, mean) of distances in meters, or None if ways do not have same number of nodes
+    """
     if len(shapely_source_way.coords) != len(shapely_found_osm_way.coords):
-        return False
-    # Check distance of endpoints and figure out if ways should be reversed
-    distance, should_reverse = get_bigger_endpoint_difference(shapely_source_way, shapely_found_osm_way)
-    if distance > 1:
-        return False
+        return None
+    _, should_reverse = get_bigger_endpoint_difference(shapely_source_way, shapely_found_osm_way)
     if should_reverse:
         shapely_source_way.coords = list(shapely_source_way.coords[::-1])
-    # Go for each node and check distance
-    geod = pyproj.Geod(ellps='WGS84')
-    for p1, p2 in zip(shapely_source_way.coords, shapely_found_osm_way.coords):
-        _, _, distance = geod.inv(p1[0], p1[1], p2[0], p2[1])
-        if distance > 1:
-            return False
-    return True
+    distances = get_distances(shapely_source_way.coords, shapely_found_osm_way.coords)
+    return float(distances.max()), float(distances.mean())
+
+
+def is_same_geometry(shapely_source_way, shapely_found_osm_way, tolerance_in_meters=1):
+    """
+    :return: Tuple (is same, max deviation, mean deviation). Ways are same if each node of one way is within tolerance
+    of corresponding node of other way. Deviations are None if ways cannot be compared node by node.
+    """
+    if shapely_source_way.is_closed != shapely_found_osm_way.is_closed:
+        return False, None, None
+    if shapely_source_way.is_ring != shapely_found_osm_way.is_ring:
+        return False, None, None
+    deviation = get_geometry_deviation(shapely_source_way, shapely_found_osm_way)
+    if deviation is None:
+        return False, None, None
+    max_deviation, mean_deviation = deviation
+    return max_deviation <= tolerance_in_meters, max_deviation, mean_deviation
 
 
 def calculate_initial_compass_bearing(pointA, pointB):
@@ -355,7 +409,94 @@ def calculate_initial_compass_bearing(pointA, pointB):
     return compass_bearing
 
 
-def conflate_way(config, osmapi, overpass_api, source_data, source_way, found_osm_way):
+def align_way_nodes(osm_coords, source_coords):
+    """
+    Pairs nodes of OSM way with nodes of source way, keeping their order along the way, so that total distance nodes
+    are moved is smallest. All nodes of shorter way are paired (so nodes are only added, or only deleted, as few as
+    needed), but pairs can skip nodes of longer way. Node i of shorter way can only be paired with one of nodes
+    i..i+k of longer one (k being difference of their lengths), so dynamic programming runs only over that band.
+
+    :return: List of (index of OSM node, index of source node) pairs
+    """
+    swapped = len(osm_coords) > len(source_coords)
+    shorter, longer = (source_coords, osm_coords) if swapped else (osm_coords, source_coords)
+    if len(shorter) == 0:
+        return []
+    shorter, longer = np.array(shorter, dtype=np.float64), np.array(longer, dtype=np.float64)
+    band = len(longer) - len(shorter) + 1
+    # Degrees of longitude are shorter than degrees of latitude, this is precise enough for comparing distances
+    lon_scale = math.cos(math.radians(shorter[:, 1].mean()))
+
+    def distances(i):
+        difference = longer[i:i + band] - shorter[i]
+        return np.hypot(difference[:, 0] * lon_scale, difference[:, 1])
+
+    # cost[s] is smallest total distance of pairing nodes 0..i of shorter way, where node i is paired with node i + s
+    # of longer one. Offset s can only grow, so best previous cost is the minimum over offsets up to s.
+    cost = distances(0)
+    best_previous_offsets = []
+    offsets = np.arange(band)
+    for i in range(1, len(shorter)):
+        best_previous_cost = np.minimum.accumulate(cost)
+        best_previous_offsets.append(np.maximum.accumulate(np.where(cost == best_previous_cost, offsets, 0)))
+        cost = distances(i) + best_previous_cost
+
+    pairs = []
+    offset = int(np.argmin(cost))
+    for i in range(len(shorter) - 1, -1, -1):
+        pairs.append((i + offset, i) if swapped else (i, i + offset))
+        if i > 0:
+            offset = int(best_previous_offsets[i - 1][offset])
+    return pairs[::-1]
+
+
+def build_conflation_change(osm_way_full, shapely_source_way):
+    """
+    Builds all edits which make OSM way follow source way. End nodes are moved to ends of source way, and other nodes
+    are paired with source nodes with least movement (see align_way_nodes) and moved to them. Source nodes left
+    without pair are added as new nodes, and OSM nodes left without pair are deleted. Nodes which are already where
+    they should be are not touched at all.
+
+    :param osm_way_full: Way with all its nodes, as returned from osmapi's WayFull
+    :return: OsmChange with all edits, or None if OSM way visits same node more than once
+    """
+    osm_way_to_conflate = next(e['data'] for e in osm_way_full if e['type'] == 'way')
+    nodes = {e['data']['id']: e['data'] for e in osm_way_full if e['type'] == 'node'}
+    source_coords = list(shapely_source_way.coords)
+    way_nodes = osm_way_to_conflate['nd']
+    if len(set(way_nodes)) != len(way_nodes):
+        # Nodes are paired, moved and deleted one by one, which cannot be done if they repeat
+        return None
+
+    osm_change = OsmChange()
+    osm_inner_nodes, source_inner_coords = way_nodes[1:-1], source_coords[1:-1]
+    pairs = align_way_nodes([(nodes[node_id]['lon'], nodes[node_id]['lat']) for node_id in osm_inner_nodes],
+                            source_inner_coords)
+    paired_osm_nodes = {source_index: osm_inner_nodes[osm_index] for osm_index, source_index in pairs}
+    new_way_nodes = [way_nodes[0]]
+    for source_index, (lon, lat) in enumerate(source_inner_coords):
+        if source_index in paired_osm_nodes:
+            node_id = paired_osm_nodes[source_index]
+            osm_change.move_node(nodes[node_id], lon, lat)
+        else:
+            node_id = osm_change.create_node(lon, lat)
+        new_way_nodes.append(node_id)
+    new_way_nodes.append(way_nodes[-1])
+    # Nodes left without pair are deleted (only after way stops using them, see OsmChange.to_changes)
+    paired_node_ids = set(paired_osm_nodes.values())
+    for node_id in osm_inner_nodes:
+        if node_id not in paired_node_ids:
+            osm_change.delete_node(nodes[node_id])
+    osm_change.move_node(nodes[way_nodes[0]], source_coords[0][0], source_coords[0][1])
+    osm_change.move_node(nodes[way_nodes[-1]], source_coords[-1][0], source_coords[-1][1])
+
+    osm_way_to_conflate['nd'] = new_way_nodes
+    osm_change.modify_way(osm_way_to_conflate)
+    return osm_change
+
+
+def conflate_way(config, osmapi, overpass_api, source_data, source_way, found_osm_way, plan=None,
+                 shared_entities=None, uploader=None):
     auto_proceed = config['auto_proceed']
     dry_run = config['dry_run']
 
@@ -375,13 +516,17 @@ def conflate_way(config, osmapi, overpass_api, source_data, source_way, found_os
         print('Shape is closed loop, cannot handle it, skipping')
         return ProcessingState.ERROR_CLOSED_SHAPE, None
 
-    if is_same_geometry(shapely_source_way, shapely_found_osm_way):
-        print('Way to conflate seems already conflated, skipping')
+    same_geometry, max_deviation, mean_deviation = is_same_geometry(shapely_source_way, shapely_found_osm_way)
+    if same_geometry:
+        print(f'Way to conflate seems already conflated (max deviation {max_deviation:.2f}m, '
+              f'mean {mean_deviation:.2f}m), skipping')
         return ProcessingState.CONFLATED, None
     is_conflate_possible_error, error_context = is_conflate_possible(config, osmapi, overpass_api, shapely_source_way,
-                                                                     found_osm_way, shapely_found_osm_way)
+                                                                     found_osm_way, shapely_found_osm_way,
+                                                                     shared_entities, uploader)
     if is_conflate_possible_error != ProcessingState.CHECKED_POSSIBLE:
         return is_conflate_possible_error, error_context
+    unglued_ways = error_context
 
     # Do basic check that can cut off lot of already-almost conflated ways
     # Shapes are same if inflated way can fit inside other way and if angle (in degrees) of end points is less than 5 degree
@@ -404,172 +549,234 @@ def conflate_way(config, osmapi, overpass_api, source_data, source_way, found_os
     else:
         print('Detected almost same ways, skipping human check')
 
-    osm_way_nodes_to_conflate = osmapi.WayFull(found_osm_way.id)
-    osm_way_to_conflate = osmapi.WayGet(found_osm_way.id)
-    nodes_to_delete = []
-    assert len(osm_way_nodes_to_conflate) == len(osm_way_to_conflate['nd']) + 1
-    for i in range(len(osm_way_to_conflate['nd'])-1):
-        # since we are in-place modifying this list, we need to offset it by this much,
-        # this is why we substract len of nodes_to_delete
-        node_id_to_conflate = osm_way_to_conflate['nd'][i-len(nodes_to_delete)]
-        node_to_conflate = next(n['data'] for n in osm_way_nodes_to_conflate if n['data']['id'] == node_id_to_conflate)
-        if i < len(shapely_source_way.coords) - 1:
-            geod = pyproj.Geod(ellps='WGS84')
-            _, _, distance = geod.inv(node_to_conflate['lon'], node_to_conflate['lat'],
-                                      shapely_source_way.coords[i][0], shapely_source_way.coords[i][1])
-            node_to_conflate['lon'] = shapely_source_way.coords[i][0]
-            node_to_conflate['lat'] = shapely_source_way.coords[i][1]
-            if not dry_run:
-                osmapi.NodeUpdate(node_to_conflate)
-        else:
-            nodes_to_delete.append(node_to_conflate)
-            osm_way_to_conflate['nd'].remove(node_to_conflate['id'])
-    for i in range(len(osm_way_to_conflate['nd'])-1, len(shapely_source_way.coords) - 1):
-        added_node = {'id': -i, 'lon': shapely_source_way.coords[i][0], 'lat': shapely_source_way.coords[i][1], 'tag': {}}
-        if not dry_run:
-            osmapi.NodeCreate(added_node)
-        osm_way_to_conflate['nd'].insert(-1, added_node['id'])
-    # Fix last node
-    last_node_id = osm_way_to_conflate['nd'][-1]
-    last_node_to_conflate = next(n['data'] for n in osm_way_nodes_to_conflate if n['data']['id'] == last_node_id)
-    _, _, distance = geod.inv(last_node_to_conflate['lon'], last_node_to_conflate['lat'],
-                              shapely_source_way.coords[-1][0], shapely_source_way.coords[-1][1])
-
-    last_node_to_conflate['lon'] = shapely_source_way.coords[-1][0]
-    last_node_to_conflate['lat'] = shapely_source_way.coords[-1][1]
-    if not dry_run:
-        osmapi.NodeUpdate(last_node_to_conflate)
-
+    osm_change = build_conflation_change(osmapi.WayFull(found_osm_way.id), shapely_source_way)
+    if osm_change is None:
+        print('OSM way visits same node more than once, cannot handle it, skipping')
+        return ProcessingState.ERROR_INVALID_SHAPE, None
     if not dry_run:
-        osmapi.WayUpdate(osm_way_to_conflate)
-        # Deleting nodes needs to happen after we update way
-        for node_to_delete in nodes_to_delete:
-            osmapi.NodeDelete(node_to_delete)
-        osmapi.flush()
-        time.sleep(5)
+        uploader.upload(osm_change.to_changes())
         return ProcessingState.CONFLATED, None
-    else:
-        return ProcessingState.CHECKED_POSSIBLE, None
+    if plan is not None:
+        if unglued_ways is not None:
+            # Plan is made against OSM as it is now, it does not know about nodes that ungluing would add
+            print(f'Way needs to be unglued from {unglued_ways} first, not adding it to plan')
+        else:
+            plan.add(osm_change)
+    return ProcessingState.CHECKED_POSSIBLE, None
+
+
+def process_way(config, osmapi, overpass_api, source_data, way_id, way, plan=None, shared_entities=None,
+                uploader=None):
+    """
+    Finds given way from .osm file in OSM and conflates it (or just checks if conflation is possible, in dry run).
+    Result is saved in way itself. If plan is given, edits of ways which can be conflated are added to it. If
+    shared_entities index is given, entities glued to way are taken from it, if they were prefetched. When not in dry
+    run, edits are uploaded with uploader (ChangesetUploader), so many ways share one changeset.
+    """
+    country = config['country']
+    level9_ref_key = config['level9_ref_key']
+
+    # Find relations this way is part of
+    relations = [source_data['relations'][r] for r in source_data['way_relations'].get(way_id, [])]
+    assert len(relations) > 0
+    if len(relations) == 2:
+        relation_text = "{0} (ref: {1}) - {2} (ref: {3})".format(
+            relations[0]['tags']['name'], relations[0]['tags']['level9_id'],
+            relations[1]['tags']['name'], relations[1]['tags']['level9_id'])
+    elif len(relations) == 1:
+        relation_text = "{0} (ref: {1})".format(
+            relations[0]['tags']['name'], relations[0]['tags']['level9_id'])
+    elif len(relations) == 3:
+        relation_text = "{0} (ref: {1}) - {2} (ref: {3}) - {4} (ref: {5})".format(
+            relations[0]['tags']['name'], relations[0]['tags']['level9_id'],
+            relations[1]['tags']['name'], relations[1]['tags']['level9_id'],
+            relations[2]['tags']['name'], relations[2]['tags']['level9_id'])
+    way['relations'] = relation_text
+
+    # If way is shared between two relations, we try to find it in OSM using that information,
+    # Otherwise, if it is part of just one relation, we try to find it in OSM with that.
+    if len(relations) == 2:
+        settlement0_id = relations[0]['tags']['level9_id']
+        settlement1_id = relations[1]['tags']['level9_id']
+        osm_response = get_osm_shared_ways(overpass_api, settlement0_id, settlement1_id, country, level9_ref_key)
+        if len(osm_response.ways) == 0:
+            print('Cannot find shared way in OSM between settlements {0} (ref: {1}) and {2} (ref: {3}), skipping'.
+                  format(relations[0]['tags']['name'], settlement0_id,
+                         relations[1]['tags']['name'], settlement1_id))
+            way['processed'] = ProcessingState.ERROR_SHARED_WAY_NOT_FOUND
+            way['error_context'] = None
+        elif len(osm_response.ways) > 1:
+            print('More than 1 shared way in OSM between settlements {0} (ref: {1}) and {2} (ref: {3}), '
+                  'fix by merging ways manually, skipping'.
+                  format(relations[0]['tags']['name'], settlement0_id,
+                         relations[1]['tags']['name'], settlement1_id))
+            way['processed'] = ProcessingState.ERROR_MULTIPLE_SHARED_WAYS
+            way['error_context'] = ','.join([str(w.id) for w in osm_response.ways])
+        else:
+            print('Processing way https://www.openstreetmap.org/way/{0} shared between {1} and {2}'.format(
+                osm_response.ways[0].id, relations[0]['tags']['name'], relations[1]['tags']['name']))
+            processed, error_context = conflate_way(config, osmapi, overpass_api, source_data, way,
+                                                    osm_response.ways[0], plan, shared_entities, uploader)
+            way['processed'] = processed
+            way['osm_way'] = osm_response.ways[0].id
+            way['error_context'] = error_context
+    elif len(relations) == 1:
+        settlement_id = relations[0]['tags']['level9_id']
+        osm_response = get_osm_single_way(overpass_api, settlement_id, country, level9_ref_key)
+        if len(osm_response.ways) == 0:
+            print('Cannot find way in OSM that belongs only to settlement {0} (ref: {1}), skipping'.
+                  format(relations[0]['tags']['name'], settlement_id))
+            way['processed'] = ProcessingState.ERROR_WAY_NOT_FOUND
+            way['error_context'] = None
+        elif len(osm_response.ways) > 1:
+            print('More than 1 way in OSM that belongs only to settlement {0} (ref: {1}), '
+                  'fix by merging ways manually, skipping'.format(
+                relations[0]['tags']['name'], settlement_id))
+            way['processed'] = ProcessingState.ERROR_MULTIPLE_SINGLE_WAY
+            way['error_context'] = ','.join([str(w.id) for w in osm_response.ways])
+        else:
+            print('Processing way https://www.openstreetmap.org/way/{0} belonging only to {1}'.format(
+                osm_response.ways[0].id, relations[0]['tags']['name']))
+            processed, error_context = conflate_way(config, osmapi, overpass_api, source_data, way,
+                                                    osm_response.ways[0], plan, shared_entities, uploader)
+            way['processed'] = processed
+            way['osm_way'] = osm_response.ways[0].id
+            way['error_context'] = error_context
+    elif len(relations) > 2:
+        way['processed'] = ProcessingState.ERROR_OVERLAPPING_WAYS
+        way['osm_way'] = None
+        way['error_context'] = None
+
+
+def get_level9_ids_of_ways(source_data, way_ids):
+    """
+    :return: Set of ids of level9 entities given ways from .osm file are border of (only for ways process_way looks up)
+    """
+    level9_ids = set()
+    for way_id in way_ids:
+        relation_ids = source_data['way_relations'].get(way_id, [])
+        if len(relation_ids) <= 2:
+            level9_ids.update(source_data['relations'][r]['tags']['level9_id'] for r in relation_ids)
+    return level9_ids
+
+
+def assess_ways_in_parallel(config, osmapi, overpass_api, source_data, progress_store, plan=None,
+                            shared_entities=None):
+    """
+    Dry run assessment of all ways, where ways are checked concurrently. Nothing is written to OSM, so checks of
+    different ways do not depend on each other. Use it with local Overpass (or boundary store) only. With
+    shared_entities index, ways are checked in batches, and entities glued to each batch are prefetched first.
+    """
+    ways_to_process = [(way_id, way) for way_id, way in sorted(source_data['ways'].items(), key=lambda x: x[0],
+                                                               reverse=True) if way['processed'] == ProcessingState.NO]
+    print('Assessing {0} ways using {1} workers'.format(len(ways_to_process), config['dry_run_workers']))
+    batch_size = config['overpass_batch_size'] if shared_entities is not None else max(len(ways_to_process), 1)
+    start_time = time.time()
+    count_processed = 0
+    with ThreadPoolExecutor(max_workers=config['dry_run_workers']) as executor:
+        for start in range(0, len(ways_to_process), batch_size):
+            batch = ways_to_process[start:start + batch_size]
+            if shared_entities is not None:
+                shared_entities.prefetch(get_level9_ids_of_ways(source_data, [way_id for way_id, _ in batch]))
+            futures = {executor.submit(process_way, config, osmapi, overpass_api, source_data, way_id, way, plan,
+                                       shared_entities): way_id
+                       for way_id, way in batch}
+            try:
+                for future in as_completed(futures):
+                    future.result()
+                    way_id = futures[future]
+                    progress_store.save_way(way_id, source_data['ways'][way_id])
+                    count_processed = count_processed + 1
+                    if count_processed % 100 == 0:
+                        print('Processed {0}/{1} ({2:.1f} ways/sec)'.format(
+                            count_processed, len(ways_to_process), count_processed / (time.time() - start_time)))
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+    elapsed = time.time() - start_time
+    print('Assessed {0} ways in {1:.0f}s ({2:.1f} ways/sec)'.format(
+        len(ways_to_process), elapsed, len(ways_to_process) / elapsed if elapsed > 0 else 0))
 
 
 def main(input_osm_file, progress_file):
     with open('config.yml', 'r') as config_yml_file:
         config = yaml.safe_load(config_yml_file)
+    configure_retry_policy(config)
 
-    overpass_api = overpy.Overpass(url=config['overpass_url'])
+    if config.get('boundary_store_extract'):
+        # Answer all boundary topology questions locally, from OSM extract, instead of asking Overpass
+        overpass_api = load_boundary_store(config['boundary_store_extract'])
+    else:
+        overpass_api = create_overpass_api(config)
     auto_proceed = config['auto_proceed']
-    country = config['country']
-    level9_ref_key = config['level9_ref_key']
 
-    osmapi = OsmApi(passwordfile='osm-password',
-                    changesetauto=True,
-                    changesetautosize=10000, changesetautotags=
-                    {
-                        u"comment": config['changeset_comment'],
-                        u"tag": u"mechanical=yes", u"source": config['changeset_source']
-                    })
+    # Edits of each way are uploaded as one diff, and changeset is kept open for many ways, until it would get too many
+    # elements or too big bounding box
+    osmapi = OsmApi(passwordfile='osm-password')
+    uploader = ChangesetUploader(osmapi, get_changeset_tags(config), max_elements=config['changesets']['max_elements'],
+                                 max_extent=config['changesets']['max_extent'])
 
     if not os.path.isfile(progress_file):
         print(f'Cannot find {progress_file}, starting from scratch')
         source_data = load_osm(input_osm_file)
         print(f'Loaded .osm file {input_osm_file}')
-        Path(progress_file).touch()  # need to touch file for atomic writes later
+        progress_store = ProgressStore.create(progress_file, source_data)
     else:
-        with open(progress_file, 'rb') as p:
-            source_data = pickle.load(p)
-
-    # Iterate for each way in .osm
-    count_processed = 0
-    for way_id, way in sorted(source_data['ways'].items(), key=lambda x: x[0], reverse=True):
-        count_processed = count_processed + 1
-        print('Processing {0}/{1}'.format(count_processed, len(source_data['ways'])))
-        if way['processed'] != ProcessingState.NO:
-            continue
-        # Find relations this way is part of
-        relations = []
-        for relation_id, relation in source_data['relations'].items():
-            ways = [w for w in relation['ways'] if w['ref'] == way_id]
-            assert len(ways) <= 1
-            if len(ways) == 1:
-                relations.append(relation)
-        assert len(relations) > 0
-        if len(relations) == 2:
-            relation_text = "{0} (ref: {1}) - {2} (ref: {3})".format(
-                relations[0]['tags']['name'], relations[0]['tags']['level9_id'],
-                relations[1]['tags']['name'], relations[1]['tags']['level9_id'])
-        elif len(relations) == 1:
-            relation_text = "{0} (ref: {1})".format(
-                relations[0]['tags']['name'], relations[0]['tags']['level9_id'])
-        elif len(relations) == 3:
-            relation_text = "{0} (ref: {1}) - {2} (ref: {3}) - {4} (ref: {5})".format(
-                relations[0]['tags']['name'], relations[0]['tags']['level9_id'],
-                relations[1]['tags']['name'], relations[1]['tags']['level9_id'],
-                relations[2]['tags']['name'], relations[2]['tags']['level9_id'])
-        way['relations'] = relation_text
-
-        # If way is shared between two relations, we try to find it in OSM using that information,
-        # Otherwise, if it is part of just one relation, we try to find it in OSM with that.
-        if len(relations) == 2:
-            settlement0_id = relations[0]['tags']['level9_id']
-            settlement1_id = relations[1]['tags']['level9_id']
-            osm_response = get_osm_shared_ways(overpass_api, settlement0_id, settlement1_id, country, level9_ref_key)
-            if len(osm_response.ways) == 0:
-                print('Cannot find shared way in OSM between settlements {0} (ref: {1}) and {2} (ref: {3}), skipping'.
-                      format(relations[0]['tags']['name'], settlement0_id,
-                             relations[1]['tags']['name'], settlement1_id))
-                way['processed'] = ProcessingState.ERROR_SHARED_WAY_NOT_FOUND
-                way['error_context'] = None
-            elif len(osm_response.ways) > 1:
-                print('More than 1 shared way in OSM between settlements {0} (ref: {1}) and {2} (ref: {3}), '
-                      'fix by merging ways manually, skipping'.
-                      format(relations[0]['tags']['name'], settlement0_id,
-                             relations[1]['tags']['name'], settlement1_id))
-                way['processed'] = ProcessingState.ERROR_MULTIPLE_SHARED_WAYS
-                way['error_context'] = ','.join([str(w.id) for w in osm_response.ways])
-            else:
-                print('Processing way https://www.openstreetmap.org/way/{0} shared between {1} and {2}'.format(
-                    osm_response.ways[0].id, relations[0]['tags']['name'], relations[1]['tags']['name']))
-                processed, error_context = conflate_way(config, osmapi, overpass_api, source_data, way, osm_response.ways[0])
-                way['processed'] = processed
-                way['osm_way'] = osm_response.ways[0].id
-                way['error_context'] = error_context
-        elif len(relations) == 1:
-            settlement_id = relations[0]['tags']['level9_id']
-            osm_response = get_osm_single_way(overpass_api, settlement_id, country, level9_ref_key)
-            if len(osm_response.ways) == 0:
-                print('Cannot find way in OSM that belongs only to settlement {0} (ref: {1}), skipping'.
-                      format(relations[0]['tags']['name'], settlement_id))
-                way['processed'] = ProcessingState.ERROR_WAY_NOT_FOUND
-                way['error_context'] = None
-            elif len(osm_response.ways) > 1:
-                print('More than 1 way in OSM that belongs only to settlement {0} (ref: {1}), '
-                      'fix by merging ways manually, skipping'.format(
-                    relations[0]['tags']['name'], settlement_id))
-                way['processed'] = ProcessingState.ERROR_MULTIPLE_SINGLE_WAY
-                way['error_context'] = ','.join([str(w.id) for w in osm_response.ways])
-            else:
-                print('Processing way https://www.openstreetmap.org/way/{0} belonging only to {1}'.format(
-                    osm_response.ways[0].id, relations[0]['tags']['name']))
-                processed, error_context = conflate_way(config, osmapi, overpass_api, source_data, way, osm_response.ways[0])
-                way['processed'] = processed
-                way['osm_way'] = osm_response.ways[0].id
-                way['error_context'] = error_context
-        elif len(relations) > 2:
-            way['processed'] = ProcessingState.ERROR_OVERLAPPING_WAYS
-            way['osm_way'] = None
-            way['error_context'] = None
-
-        # Dump current progress (use atomic_writes to guard for semi-written files as those pickle dumps can be huge)
-        with atomic_write(progress_file, text=False, keep=False) as h:
-            pickle.dump(source_data, h, protocol=pickle.DEFAULT_PROTOCOL)
-
-        if not auto_proceed:
-            proceed = input('Continue with next way? (Y/n)?')
-            if proceed == '' or proceed.lower() == 'y' or proceed.lower() == u'з':
+        progress_store = ProgressStore.open(progress_file)
+        source_data = progress_store.load_source_data()
+        if 'way_relations' not in source_data:
+            # Progress files from before way->relations index existed
+            source_data['way_relations'] = index_way_relations(source_data['relations'])
+
+    # In dry run, edits of ways which can be conflated can be saved as plan, to be uploaded later with conflate-apply.py
+    plan = None
+    if config['dry_run'] and config.get('conflation_plan_file'):
+        plan = ConflationPlan(config['conflation_plan_file'])
+
+    # Entities glued to ways are prefetched for a batch of ways at once (boundary store already has them all). Ways and
+    # nodes to unglue are prefetched only in dry run, when they are just looked at, as they need to be fresh to edit.
+    shared_entities = None
+    if not isinstance(overpass_api, BoundaryStore):
+        shared_entities = SharedEntityIndex(overpass_api, osmapi, config['country'], config['level9_ref_key'],
+                                            config['dry_run'] and config['unglue_ways_as_needed'])
+
+    try:
+        if config['dry_run'] and auto_proceed and config['dry_run_workers'] > 1:
+            assess_ways_in_parallel(config, osmapi, overpass_api, source_data, progress_store, plan, shared_entities)
+            return
+
+        # Iterate for each way in .osm
+        sorted_ways = sorted(source_data['ways'].items(), key=lambda x: x[0], reverse=True)
+        ways_to_process = [way_id for way_id, way in sorted_ways if way['processed'] == ProcessingState.NO]
+        batch_size = config['overpass_batch_size']
+        count_processed = 0
+        count_to_process = 0
+        for way_id, way in sorted_ways:
+            count_processed = count_processed + 1
+            print('Processing {0}/{1}'.format(count_processed, len(source_data['ways'])))
+            if way['processed'] != ProcessingState.NO:
                 continue
-            break
-        else:
-            time.sleep(2)
+            if shared_entities is not None and count_to_process % batch_size == 0:
+                shared_entities.prefetch(get_level9_ids_of_ways(
+                    source_data, ways_to_process[count_to_process:count_to_process + batch_size]))
+            count_to_process = count_to_process + 1
+            process_way(config, osmapi, overpass_api, source_data, way_id, way, plan, shared_entities, uploader)
+
+            # Save progress of this way only (each save is separate transaction, so it is safe from semi-written files)
+            progress_store.save_way(way_id, way)
+
+            if not auto_proceed:
+                proceed = input('Continue with next way? (Y/n)?')
+                if proceed == '' or proceed.lower() == 'y' or proceed.lower() == u'з':
+                    continue
+                break
+            else:
+                time.sleep(2)
+    finally:
+        uploader.close()
+        if plan is not None:
+            plan.save()
 
 
 if __name__ == '__main__':
@@ -7,24 +7,24 @@ import sys
 import time
 
 import osmapi
-import overpy
 import yaml
 
 current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 sys.path.append(parent)
 
-from common import get_polygon_by_cadastre_id, load_level9_features
+from common import iter_polygons_by_cadastre_ids, load_admin_hierarchy, configure_retry_policy
+from concurrency import AIMDController
+from overpass_cache import create_overpass_api
 
 
 def main(config, overpass_api, input_csv_file):
-    level9_features = load_level9_features(input_csv_file)
+    hierarchy = load_admin_hierarchy(input_csv_file)
 
     level8_map = {}  # maps (level6 name, level8 name) -> level8 id
-    for level9_feature in level9_features:
-        level6_name = level9_feature['level6_name']
-        level8_name = level9_feature['level8_name']
-        level8_id = level9_feature['level8_id']
+    for level8_id in hierarchy.get_level8_ids():
+        level6_name = hierarchy.get_name(6, hierarchy.get_level6_id(level8_id))
+        level8_name = hierarchy.get_name(8, level8_id)
         if (level6_name, level8_name) not in level8_map:
             level8_map[(level6_name, level8_name)] = level8_id
 
@@ -32,12 +32,13 @@ def main(config, overpass_api, input_csv_file):
                         changesetauto=True, changesetautosize=20, changesetautotags=
                         {u"comment": u"Serbian lint bot - adding missing {}".format(config['level8_ref_key']),
                          u"tag": u"mechanical=yes", u"source": config['changeset_source']})
-    for i, level6_name_level8_name in enumerate(level8_map.keys()):
+    osm_level8s = iter_polygons_by_cadastre_ids(overpass_api, 8, level8_map.values(), country=config['country'],
+                                                id_key=config['level8_ref_key'], batch_size=config['overpass_batch_size'],
+                                                controller=AIMDController.from_config(config))
+    for i, (level6_name_level8_name, (level8_id, osm_level8)) in enumerate(zip(level8_map.keys(), osm_level8s)):
         level6_name = level6_name_level8_name[0]
         level8_name = level6_name_level8_name[1]
-        level8_id = level8_map[level6_name_level8_name]
-        overpass_level8_polygon, osm_level8_name, osm_relation_id, national_border = \
-            get_polygon_by_cadastre_id(overpass_api, 8, level8_id, country=config['country'], id_key=config['level8_ref_key'])
+        overpass_level8_polygon, osm_level8_name, osm_relation_id, national_border = osm_level8
 
         if overpass_level8_polygon is None:
             print(f'Skipping {level6_name}/{level8_name}')
@@ -80,8 +81,9 @@ def main(config, overpass_api, input_csv_file):
 if __name__ == '__main__':
     with open('config.yml', 'r') as config_yml_file:
         config = yaml.safe_load(config_yml_file)
+    configure_retry_policy(config)
 
-    overpass_api = overpy.Overpass(url=config['overpass_url'])
+    overpass_api = create_overpass_api(config)
 
     if len(sys.argv) != 2:
         print("Usage: ./extras/add_level8_id_to_osm.py <input_csv_file>")
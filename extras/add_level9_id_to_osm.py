@@ -8,23 +8,23 @@ import time
 import yaml
 
 import osmapi
-import overpy
 
 current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 sys.path.append(parent)
 
-from common import get_polygon_by_cadastre_id, load_level9_features
+from common import iter_polygons_by_cadastre_ids, load_admin_hierarchy, configure_retry_policy
+from concurrency import AIMDController
+from overpass_cache import create_overpass_api
 
 
 def main(config, overpass_api, input_csv_file):
-    level9_features = load_level9_features(input_csv_file)
+    hierarchy = load_admin_hierarchy(input_csv_file)
 
     level9_map = {}  # maps (level8 name, level9 name) -> level9 id
-    for level9_feature in level9_features:
-        level8_name = level9_feature['level8_name']
-        level9_name = level9_feature['level9_name']
-        level9_id = level9_feature['level9_id']
+    for level9_id, level8_id in hierarchy.level9_level8.items():
+        level8_name = hierarchy.get_name(8, level8_id)
+        level9_name = hierarchy.get_name(9, level9_id)
         if (level8_name, level9_name) not in level9_map:
             level9_map[(level8_name, level9_name)] = level9_id
 
@@ -33,12 +33,13 @@ def main(config, overpass_api, input_csv_file):
                         {u"comment": f"Bot - adding missing {config['level9_ref_key']}",
                          u"tag": u"mechanical=yes", u"source": config['changeset_source']})
 
-    for i, level8_name_level9_name in enumerate(level9_map.keys()):
+    osm_level9s = iter_polygons_by_cadastre_ids(overpass_api, 9, level9_map.values(), country=config['country'],
+                                                id_key=config['level9_ref_key'], batch_size=config['overpass_batch_size'],
+                                                controller=AIMDController.from_config(config))
+    for i, (level8_name_level9_name, (level9_id, osm_level9)) in enumerate(zip(level9_map.keys(), osm_level9s)):
         level8_name = level8_name_level9_name[0]
         level9_name = level8_name_level9_name[1]
-        level9_id = level9_map[level8_name_level9_name]
-        overpass_level9_polygon, osm_level9_name, osm_relation_id, national_border = \
-            get_polygon_by_cadastre_id(overpass_api, 9, level9_id, country=config['country'], id_key=config['level9_ref_key'])
+        overpass_level9_polygon, osm_level9_name, osm_relation_id, national_border = osm_level9
 
         if overpass_level9_polygon is None:
             print(f'Skipping {level8_name}/{level9_name}')
@@ -81,8 +82,9 @@ def main(config, overpass_api, input_csv_file):
 if __name__ == '__main__':
     with open('config.yml', 'r') as config_yml_file:
         config = yaml.safe_load(config_yml_file)
+    configure_retry_policy(config)
 
-    overpass_api = overpy.Overpass(url=config['overpass_url'])
+    overpass_api = create_overpass_api(config)
 
     if len(sys.argv) != 2:
         print("Usage: ./extras/add_level9_id_to_osm.py <input_csv_file>")
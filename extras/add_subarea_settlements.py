@@ -5,27 +5,28 @@ import os
 import sys
 
 import osmapi
-import overpy
 import yaml
 
 current = os.path.dirname(os.path.realpath(__file__))
 parent = os.path.dirname(current)
 sys.path.append(parent)
 
-from common import get_polygon_by_cadastre_id, load_level9_features
+from common import iter_polygons_by_cadastre_ids, load_admin_hierarchy, configure_retry_policy
+from concurrency import AIMDController
+from overpass_cache import create_overpass_api
 
 # Simple optimization not to get relation id for all settlements
 # if number of subareas == number of settlements in municipality
 ASSUME_SUBAREA_EQUAL_IF_EQUAL_NUMBER = True
 
 
-def get_level9_from_osm(config, overpass_api, level9_ids):
+def get_level9_from_osm(config, overpass_api, level9_ids, controller):
     level9_features = {}
-    i = 0
-    for level9_id in level9_ids:
-        i = i + 1
+    osm_level9s = iter_polygons_by_cadastre_ids(overpass_api, 9, level9_ids, country=config['country'],
+                                                id_key=config['level9_ref_key'], batch_size=config['overpass_batch_size'],
+                                                controller=controller)
+    for i, (level9_id, (_, osm_relation_name, osm_relation_id, _)) in enumerate(osm_level9s, start=1):
         print(f'Fetching level9 id: {level9_id}')
-        _, osm_relation_name, osm_relation_id, _ = get_polygon_by_cadastre_id(overpass_api, admin_level=9, cadastre_id=level9_id, country=config['country'], id_key=config['level9_ref_key'])
         print('    ({}/{}) Found level 9: {}'.format(i, len(level9_ids), osm_relation_name))
         level9_features[osm_relation_id] = osm_relation_name
     return level9_features
@@ -37,14 +38,18 @@ def main(config, overpass_api, input_csv_file):
                         {u"comment": u"OSM admin boundary conflation - adding missing subarea",
                          u"tag": u"mechanical=yes", u"source": config['changeset_source']})
 
-    level9_features = load_level9_features(input_csv_file)
-    level8_ids = set([level9_feature['level8_id'] for level9_feature in level9_features])
+    hierarchy = load_admin_hierarchy(input_csv_file)
+    level8_ids = set(hierarchy.get_level8_ids())
 
     counter = 0
-    for level8_id in level8_ids:
-        level9_ids = set([level9_feature['level9_id'] for level9_feature in level9_features if level9_feature['level8_id'] == level8_id])
+    # Same controller is used for all queries, so concurrency learned on one level8 is kept for next ones
+    controller = AIMDController.from_config(config)
+    osm_level8s = iter_polygons_by_cadastre_ids(overpass_api, 8, level8_ids, country=config['country'],
+                                                id_key=config['level8_ref_key'], batch_size=config['overpass_batch_size'],
+                                                controller=controller)
+    for level8_id, (_, _, osm_relation_id, _) in osm_level8s:
+        level9_ids = set(hierarchy.get_level9_ids(level8_id))
         counter = counter + 1
-        _, _, osm_relation_id, _ = get_polygon_by_cadastre_id(overpass_api, 8, level8_id, country=config['country'], id_key=config['level8_ref_key'])
         if osm_relation_id is None:
             print(f'Skipping level8 with id {level8_id}, not found in OSM')
             continue
@@ -55,7 +60,7 @@ def main(config, overpass_api, input_csv_file):
             print(f'({counter}/{len(level8_ids)}) Skipping {level8_feature["tag"]["name"]} '
                   f'object as it seems it already have all ({len(subarea_refs)}) subareas')
             continue
-        level9_osm_features_in_this_level8 = get_level9_from_osm(overpass_api, level9_ids)
+        level9_osm_features_in_this_level8 = get_level9_from_osm(config, overpass_api, level9_ids, controller)
         anything_changed = False
         # Delete those that do not exist anymore
         for subarea_ref in subarea_refs:
@@ -95,8 +100,9 @@ def main(config, overpass_api, input_csv_file):
 if __name__ == '__main__':
     with open('config.yml', 'r') as config_yml_file:
         config = yaml.safe_load(config_yml_file)
+    configure_retry_policy(config)
 
-    overpass_api = overpy.Overpass(url=config['overpass_url'])
+    overpass_api = create_overpass_api(config)
 
     if len(sys.argv) != 2:
         print("Usage: ./extras/add_subarea_level9_to_osm.py <input_csv_file>")
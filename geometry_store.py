@@ -0,0 +1,95 @@
+"""
+Read-only store of geometries in WKB, kept in a single file which worker processes memory-map. Geometries are parsed
+(from WKT) only once, and tasks sent to workers carry just (store file, offset, length) references instead of whole
+geometries, so nothing big is pickled and copied per task.
+"""
+
+import itertools
+import mmap
+import os
+
+import numpy as np
+from shapely import wkb, wkt
+
+try:
+    import pygeos
+except ImportError:
+    pygeos = None
+
+# Stores opened in this process, by path
+_open_stores = {}
+
+
+def write_geometry_store(store_file, wkts, chunk_size=1000):
+    """
+    Parses given WKT geometries and writes them, as WKB, one after another to store file. WKTs are consumed chunk by
+    chunk, so they can be streamed from a generator.
+
+    :return: Tuple of list of (offset, length) of each geometry in store file, in same order, and numpy array with
+    bounds (minx, miny, maxx, maxy) of each geometry
+    """
+    wkts = iter(wkts)
+    references = []
+    bounds = []
+    offset = 0
+    with open(store_file, 'wb') as f:
+        while True:
+            chunk = list(itertools.islice(wkts, chunk_size))
+            if len(chunk) == 0:
+                break
+            if pygeos is not None:
+                geometries = pygeos.from_wkt(chunk)
+                wkbs = pygeos.to_wkb(geometries)
+                bounds.append(pygeos.bounds(geometries))
+            else:
+                geometries = [wkt.loads(w) for w in chunk]
+                wkbs = [g.wkb for g in geometries]
+                bounds.append(np.array([g.bounds for g in geometries], dtype=np.float64))
+            for geometry_wkb in wkbs:
+                f.write(geometry_wkb)
+                references.append((offset, len(geometry_wkb)))
+                offset = offset + len(geometry_wkb)
+    bounds = np.concatenate(bounds) if len(bounds) > 0 else np.empty((0, 4), dtype=np.float64)
+    return references, bounds
+
+
+class GeometryStore(object):
+    def __init__(self, store_file):
+        self.store_file = store_file
+        self.mmap = None
+        if os.path.getsize(store_file) > 0:
+            with open(store_file, 'rb') as f:
+                self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, offset, length):
+        return wkb.loads(self.mmap[offset:offset + length])
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+
+
+def get_geometry_store(store_file):
+    """
+    Opens store file, only once per process
+    """
+    if store_file not in _open_stores:
+        _open_stores[store_file] = GeometryStore(store_file)
+    return _open_stores[store_file]
+
+
+def close_geometry_store(store_file):
+    """
+    Closes store file if it was opened in this process, so it is mapped again (e.g. after it was rewritten)
+    """
+    store = _open_stores.pop(store_file, None)
+    if store is not None:
+        store.close()
+
+
+def load_geometry(reference):
+    """
+    Loads geometry from (store file, offset, length) reference
+    """
+    store_file, offset, length = reference
+    return get_geometry_store(store_file).get(offset, length)
@@ -1,14 +1,10 @@
-import csv
 import sys
 
 import fiona
 from fiona.crs import from_epsg
 from shapely.geometry import mapping
-from shapely.wkt import loads
 
-from common import load_level9_features
-
-csv.field_size_limit(sys.maxsize)
+from common import iter_level9_features
 
 schema = {
     'geometry': ['Polygon', 'MultiPolygon'],
@@ -25,14 +21,14 @@ schema = {
 }
 
 
-def main(input_csv_file: str, output_shp_file: str):
-    print(f'Loading level9 data from {input_csv_file}')
-    level9_features = load_level9_features(input_csv_file)
+def main(input_file: str, output_shp_file: str, bbox=None):
+    print(f'Loading level9 data from {input_file}')
+    level9_features = iter_level9_features(input_file, bbox=bbox)
 
     print(f'Writing level9 data to {output_shp_file}')
     with fiona.collection(output_shp_file, "w", "ESRI Shapefile", schema, crs=from_epsg(4326), encoding='utf-8') as output:
         for level9_feature in level9_features:
-            geometry = loads(level9_feature['wkt'])
+            geometry = level9_feature.geometry
             output.write({
                 'properties': {
                     'level9id': level9_feature['level9_id'],
@@ -49,9 +45,10 @@ def main(input_csv_file: str, output_shp_file: str):
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
-        print("Usage: ./inputcsv2shp.py <input_csv_file> <output_shp_file>")
+    if len(sys.argv) not in (3, 4):
+        print("Usage: ./inputcsv2shp.py <input_csv_or_fgb_file> <output_shp_file> [<minx,miny,maxx,maxy>]")
         exit()
-    input_csv_file = sys.argv[1]
+    input_file = sys.argv[1]
     output_shp_file = sys.argv[2]
-    main(input_csv_file, output_shp_file)
+    bbox = tuple(float(c) for c in sys.argv[3].split(',')) if len(sys.argv) == 4 else None
+    main(input_file, output_shp_file, bbox)
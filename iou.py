@@ -0,0 +1,160 @@
+"""
+IoU (intersection over union) of many cadastre/OSM polygon pairs at once. If pygeos is installed, intersections and
+areas of whole chunk of pairs are computed with vectorized GEOS calls. Otherwise, it falls back to computing pair by pair
+with shapely. Union is never overlaid, as its area is simply area(A) + area(B) - area(A ∩ B).
+
+IoU can also be screened first: intersection is computed on simplified polygons, with a proven bound of its error, and
+exact intersection is computed only for pairs where that is not precise enough to tell on which side of alert
+thresholds IoU is.
+"""
+
+import math
+
+import numpy as np
+import shapely.geometry as geometry
+
+try:
+    import pygeos
+except ImportError:
+    pygeos = None
+
+
+def _areas_per_pair(cadastre_polygons, osm_polygons):
+    cadastre_areas = np.array([p.area for p in cadastre_polygons], dtype=np.float64)
+    osm_areas = np.array([p.area for p in osm_polygons], dtype=np.float64)
+    intersection_areas = np.array([c.intersection(o).area for c, o in zip(cadastre_polygons, osm_polygons)],
+                                  dtype=np.float64)
+    return cadastre_areas, osm_areas, intersection_areas
+
+
+def _areas_vectorized(cadastre_polygons, osm_polygons):
+    cadastre = pygeos.from_shapely(cadastre_polygons)
+    osm = pygeos.from_shapely(osm_polygons)
+    return pygeos.area(cadastre), pygeos.area(osm), pygeos.area(pygeos.intersection(cadastre, osm))
+
+
+def compute_iou_batch(cadastre_polygons, osm_polygons, chunk_size=2000, vectorized=True):
+    """
+    Computes IoU and area_diff (part of cadastre area covered by OSM) of each pair of polygons.
+
+    :param vectorized: Use pygeos if it is installed. If False, polygons are always processed pair by pair.
+    :return: Tuple of numpy arrays (area_diff, i_o_u)
+    """
+    cadastre_polygons, osm_polygons = list(cadastre_polygons), list(osm_polygons)
+    assert len(cadastre_polygons) == len(osm_polygons)
+    compute_areas = _areas_vectorized if vectorized and pygeos is not None else _areas_per_pair
+    area_diff = np.empty(len(cadastre_polygons), dtype=np.float64)
+    i_o_u = np.empty(len(cadastre_polygons), dtype=np.float64)
+    for start in range(0, len(cadastre_polygons), chunk_size):
+        end = start + chunk_size
+        cadastre_areas, osm_areas, intersection_areas = compute_areas(cadastre_polygons[start:end],
+                                                                      osm_polygons[start:end])
+        union_areas = cadastre_areas + osm_areas - intersection_areas
+        area_diff[start:end] = intersection_areas / cadastre_areas
+        i_o_u[start:end] = intersection_areas / union_areas
+    return area_diff, i_o_u
+
+
+EXACT_TIER = 'exact'
+SCREENED_TIER = 'screened'
+
+
+def _ring_count(polygon):
+    if polygon.geom_type == 'MultiPolygon':
+        return sum(_ring_count(p) for p in polygon.geoms)
+    return 1 + len(polygon.interiors)
+
+
+def simplification_error_bound(polygon, tolerance):
+    """
+    Upper bound of area of symmetric difference between polygon and polygon with each ring simplified with given
+    tolerance (see simplify_rings).
+
+    Douglas-Peucker simplification only keeps original vertices, and every removed part of a ring stays within
+    tolerance of the segment which replaced it (and the other way around), so each simplified ring can be moved to its
+    original within tolerance-wide band around original ring. Points out of that band can't change from being inside
+    to outside (or back), so polygons can only differ inside the band, and area of band around ring of length L is at
+    most 2 * tolerance * L + pi * tolerance^2.
+    """
+    return 2 * tolerance * polygon.length + _ring_count(polygon) * math.pi * tolerance ** 2
+
+
+def simplify_rings(polygon, tolerance):
+    """
+    Simplifies each ring of polygon separately (as a line), with Douglas-Peucker. Unlike polygon simplification in
+    GEOS, result is not "fixed" with buffer(0) if it became invalid (which could change it a lot more than tolerance).
+
+    :return: Simplified polygon, or None if simplified polygon is not valid
+    """
+    if polygon.geom_type == 'MultiPolygon':
+        parts = [simplify_rings(p, tolerance) for p in polygon.geoms]
+        if any(p is None for p in parts):
+            return None
+        simplified = geometry.MultiPolygon(parts)
+    else:
+        rings = [geometry.LineString(polygon.exterior.coords).simplify(tolerance, preserve_topology=False)]
+        rings.extend(geometry.LineString(interior.coords).simplify(tolerance, preserve_topology=False)
+                     for interior in polygon.interiors)
+        if any(len(ring.coords) < 4 for ring in rings):
+            return None
+        simplified = geometry.Polygon(rings[0].coords, [ring.coords for ring in rings[1:]])
+    return simplified if simplified.is_valid else None
+
+
+def _iou_from_intersection(intersection_areas, cadastre_areas, osm_areas):
+    return intersection_areas / (cadastre_areas + osm_areas - intersection_areas)
+
+
+def _simplified_intersection_areas(cadastre_polygons, osm_polygons, tolerance):
+    """
+    :return: Intersection areas of simplified polygons, NaN where polygon could not be simplified
+    """
+    cadastre = [simplify_rings(p, tolerance) for p in cadastre_polygons]
+    osm = [simplify_rings(p, tolerance) for p in osm_polygons]
+    valid = [i for i, (c, o) in enumerate(zip(cadastre, osm)) if c is not None and o is not None]
+    intersection_areas = np.full(len(cadastre_polygons), np.nan, dtype=np.float64)
+    if len(valid) > 0:
+        _, _, intersection_areas[valid] = _areas_vectorized([cadastre[i] for i in valid], [osm[i] for i in valid]) \
+            if pygeos is not None else _areas_per_pair([cadastre[i] for i in valid], [osm[i] for i in valid])
+    return intersection_areas
+
+
+def screen_iou_batch(cadastre_polygons, osm_polygons, tolerance, thresholds, band, max_error, chunk_size=2000):
+    """
+    Two-tier IoU. First, IoU is estimated from simplified polygons (areas of polygons themselves are always exact, as
+    they are cheap). Intersection of simplified polygons differs from real intersection at most by sum of
+    simplification error bounds of both polygons, which gives lowest and highest possible IoU. If that range is closer
+    than band to any of thresholds, or if estimate could be off more than max_error, exact IoU is computed.
+
+    :return: Tuple of numpy arrays (area_diff, i_o_u, tier), where tier is EXACT_TIER or SCREENED_TIER for each pair
+    """
+    cadastre_polygons, osm_polygons = list(cadastre_polygons), list(osm_polygons)
+    cadastre_areas = np.array([p.area for p in cadastre_polygons], dtype=np.float64)
+    osm_areas = np.array([p.area for p in osm_polygons], dtype=np.float64)
+    error_bounds = np.array([simplification_error_bound(c, tolerance) + simplification_error_bound(o, tolerance)
+                             for c, o in zip(cadastre_polygons, osm_polygons)], dtype=np.float64)
+
+    intersection_areas = np.empty(len(cadastre_polygons), dtype=np.float64)
+    for start in range(0, len(cadastre_polygons), chunk_size):
+        end = start + chunk_size
+        intersection_areas[start:end] = _simplified_intersection_areas(cadastre_polygons[start:end],
+                                                                       osm_polygons[start:end], tolerance)
+    not_simplified = np.isnan(intersection_areas)
+    max_intersection = np.minimum(cadastre_areas, osm_areas)
+    intersection_areas = np.clip(np.nan_to_num(intersection_areas), 0, max_intersection)
+    lowest = _iou_from_intersection(np.maximum(intersection_areas - error_bounds, 0), cadastre_areas, osm_areas)
+    highest = _iou_from_intersection(np.minimum(intersection_areas + error_bounds, max_intersection),
+                                     cadastre_areas, osm_areas)
+    area_diff = intersection_areas / cadastre_areas
+    i_o_u = _iou_from_intersection(intersection_areas, cadastre_areas, osm_areas)
+
+    needs_exact = not_simplified | (np.maximum(highest - i_o_u, i_o_u - lowest) > max_error)
+    for threshold in thresholds:
+        needs_exact |= (lowest <= threshold + band) & (highest >= threshold - band)
+    tier = np.full(len(cadastre_polygons), SCREENED_TIER, dtype=object)
+    exact = np.flatnonzero(needs_exact)
+    if len(exact) > 0:
+        area_diff[exact], i_o_u[exact] = compute_iou_batch([cadastre_polygons[i] for i in exact],
+                                                           [osm_polygons[i] for i in exact], chunk_size=chunk_size)
+        tier[exact] = EXACT_TIER
+    return area_diff, i_o_u, tier
@@ -1,16 +1,22 @@
 import csv
+import math
 import multiprocessing
 import os
 import sys
 import time
+from collections import Counter
 from concurrent.futures import ProcessPoolExecutor, as_completed
 from threading import Lock
 
-import overpy
 import yaml
-from shapely.wkt import loads
 
-from common import retry_on_error, create_geometry_from_osm_response, get_polygon_by_cadastre_id, load_level9_features
+from common import retry_on_error, create_geometry_from_osm_response, get_polygon_by_cadastre_id, \
+    get_polygons_by_cadastre_ids, load_level9_features, configure_retry_policy, get_retry_policy, get_relation_versions, \
+    get_changed_cadastre_ids, is_national_border, query_compact
+from concurrency import AIMDController, run_adaptive
+from iou import EXACT_TIER, compute_iou_batch, screen_iou_batch
+from overpass_cache import CachedOverpass, create_overpass_api, get_osm_base_timestamp
+from snapshot import download_snapshot, load_snapshot_polygons
 
 csv.field_size_limit(sys.maxsize)
 csv_write_mutex = Lock()
@@ -20,7 +26,7 @@ results = []
 @retry_on_error()
 def get_level9_polygon_by_name(api, country, level6_name, level8_name):
     for admin_level in (8, 7):
-        response = api.query("""
+        response = query_compact(api, """
 area["name"="{0}"]["admin_level"=2]->.country;
 (
 	area(area.country)["name"~"{1}$", i]["admin_level"={2}]->.district;
@@ -28,8 +34,11 @@ area["name"="{0}"]["admin_level"=2]->.country;
   		relation(area.district)["boundary"="administrative"]["admin_level"=9]["name"~"^{3}$", i];
     );
 );
-(._;>;);
 out;
+way(r);
+out;
+node(w);
+out skel;
 // &contact=https://github.com/stalker314314/osm-admin-boundary-conflation/
     """.format(country, level6_name, admin_level, level8_name))
         time.sleep(10)
@@ -38,8 +47,9 @@ out;
         if len(response.relations) != 1:
             continue
         polygon = create_geometry_from_osm_response(response.relations[0], response)
-        return polygon, response.relations[0].tags['name'], response.relations[0].id
-    return None, None, None
+        return polygon, response.relations[0].tags['name'], response.relations[0].id, \
+            is_national_border(response.relations[0], response)
+    return None, None, None, None
 
 
 def get_current_results(output_file):
@@ -53,99 +63,275 @@ def get_current_results(output_file):
                     {'level6_name': row['level6_name'], 'level8_name': row['level8_name'],
                      'level9_name': row['level9_name'], 'osm_settlement_name': row['osm_settlement_name'],
                      'relation_id': row['relation_id'], 'area_diff': row['area_diff'],
-                     'i_o_u': row['i_o_u'], 'national_border': row['national_border']})
+                     'i_o_u': row['i_o_u'], 'national_border': row['national_border'],
+                     'iou_tier': row.get('iou_tier', ''),
+                     'relation_version': row.get('relation_version', ''),
+                     'cadastre_hash': row.get('cadastre_hash', '')})
     return results
 
 
+def get_results_osm_timestamp(output_file):
+    """
+    Timestamp of OSM data (Overpass "osm_base") against which results in output file are up to date, if known
+    """
+    timestamp_file = output_file + '.osm_timestamp'
+    if not os.path.isfile(timestamp_file):
+        return None
+    with open(timestamp_file) as f:
+        timestamp = f.read().strip()
+    return timestamp if timestamp != '' else None
+
+
+def write_results_osm_timestamp(output_file, osm_timestamp):
+    timestamp_file = output_file + '.osm_timestamp'
+    if osm_timestamp is None:
+        if os.path.isfile(timestamp_file):
+            os.remove(timestamp_file)
+        return
+    with open(timestamp_file, 'w') as f:
+        f.write(osm_timestamp + '\n')
+
+
 def write_results(current_results, output_file):
     with csv_write_mutex:
         with open(output_file, 'w') as out_csv:
             writer = csv.DictWriter(out_csv, fieldnames=[
                 'level6_name', 'level8_name', 'level9_name', 'osm_settlement_name',
-                'relation_id', 'area_diff', 'i_o_u', 'national_border'])
+                'relation_id', 'area_diff', 'i_o_u', 'national_border', 'iou_tier', 'relation_version',
+                'cadastre_hash'])
             writer.writeheader()
             for data in current_results:
                 writer.writerow(data)
 
 
-def process_level9(config, overpass_api, level9_entity, count_processed, total_to_process):
-    global results
+def find_osm_level9(config, overpass_api, level9_entity, count_processed, total_to_process, osm_level9=None):
+    """
+    Finds OSM polygon of a single level9 entity. If osm_level9 is given (polygon, name, relation id, national border
+    taken from snapshot or from batched query), Overpass is not queried by cadastre id. If entity cannot be found by
+    cadastre id, it is looked up by name.
+    """
     print('Processed {0}/{1}'.format(count_processed, total_to_process))
 
     country = config['country']
     level9_ref_key = config['level9_ref_key']
 
-    cadastre_level9_polygon = loads(level9_entity['wkt'])
-    level6_name = level9_entity['level6_name']
     level8_name = level9_entity['level8_name']
     level9_name = level9_entity['level9_name']
     level9_id = level9_entity['level9_id']
 
     print('Processing {0} {1}'.format(level8_name, level9_name))
 
-    overpass_level9_polygon, osm_settlement_name, osm_relation_id, national_border = \
-        get_polygon_by_cadastre_id(overpass_api, admin_level=9, cadastre_id=level9_id, country=country, id_key=level9_ref_key)
-    if overpass_level9_polygon is None:
+    if osm_level9 is None:
+        osm_level9 = get_polygon_by_cadastre_id(overpass_api, admin_level=9, cadastre_id=level9_id, country=country,
+                                                id_key=level9_ref_key)
+    if osm_level9[0] is None:
         print(f'Level 8 {level8_name} and level 9 {level9_name} not found using {level9_ref_key}')
-        overpass_level9_polygon, osm_settlement_name, osm_relation_id, national_border = \
-            get_level9_polygon_by_name(overpass_api, country, level8_name, level9_name)
-        if overpass_level9_polygon is None:
+        osm_level9 = get_level9_polygon_by_name(overpass_api, country, level8_name, level9_name)
+        if osm_level9[0] is None:
             print(f'Level8 {level8_name} and level9 {level9_name} not found at all')
-            result = {'level6_name': level6_name, 'level8_name': level8_name, 'level9_name': level9_name,
-                      'osm_settlement_name': '', 'relation_id': -1, 'area_diff': -1, 'i_o_u': -1,
-                      'national_border': national_border}
-            results.append(result)
-            return result
-
-    intersection = cadastre_level9_polygon.intersection(overpass_level9_polygon)
-    union = cadastre_level9_polygon.union(overpass_level9_polygon)
-    i_o_u = intersection.area / union.area
-
-    print(level8_name, level9_name, osm_settlement_name, 100 * intersection.area/cadastre_level9_polygon.area, i_o_u)
-    result = {'level6_name': level6_name, 'level8_name': level8_name, 'level9_name': level9_name,
-              'osm_settlement_name': osm_settlement_name, 'relation_id': osm_relation_id,
-              'area_diff': round(intersection.area/cadastre_level9_polygon.area, 5),
-              'i_o_u': round(i_o_u, 5),
-              'national_border': national_border}
-    results.append(result)
-    return result
-
-
-def measure_quality(config, overpass_api, input_csv_file, output_file):
+    return osm_level9
+
+
+def create_result(level9_entity, osm_settlement_name, relation_id, area_diff, i_o_u, national_border, iou_tier):
+    return {'level6_name': level9_entity['level6_name'], 'level8_name': level9_entity['level8_name'],
+            'level9_name': level9_entity['level9_name'], 'osm_settlement_name': osm_settlement_name,
+            'relation_id': relation_id, 'area_diff': area_diff, 'i_o_u': i_o_u, 'national_border': national_border,
+            'iou_tier': iou_tier,
+            'relation_version': level9_entity.get('relation_version', ''),
+            'cadastre_hash': level9_entity['cadastre_hash']}
+
+
+def load_cadastre_polygon(level9_entity):
+    return level9_entity.geometry
+
+
+def process_level9_batch(config, overpass_api, level9_entities, count_processed, total_to_process, osm_level9s=None):
+    """
+    Measures IoU of a batch of level9 entities. If osm_level9s are not given, they are all fetched from Overpass
+    in a single query. IoU of all found entities is computed at once.
+    """
+    if osm_level9s is None:
+        polygons = get_polygons_by_cadastre_ids(overpass_api, admin_level=9,
+                                                cadastre_ids=[e['level9_id'] for e in level9_entities],
+                                                country=config['country'], id_key=config['level9_ref_key'])
+        osm_level9s = [polygons[e['level9_id']] for e in level9_entities]
+    osm_level9s = [find_osm_level9(config, overpass_api, level9_entity, count_processed + i, total_to_process,
+                                   osm_level9)
+                   for i, (level9_entity, osm_level9) in enumerate(zip(level9_entities, osm_level9s))]
+
+    found = [i for i, osm_level9 in enumerate(osm_level9s) if osm_level9[0] is not None]
+    cadastre_polygons = [load_cadastre_polygon(level9_entities[i]) for i in found]
+    osm_polygons = [osm_level9s[i][0] for i in found]
+    screening = config.get('iou_screening')
+    if screening:
+        area_diffs, i_o_us, tiers = screen_iou_batch(cadastre_polygons, osm_polygons, screening['tolerance'],
+                                                     screening['thresholds'], screening['band'],
+                                                     screening['max_error'], chunk_size=config['iou_chunk_size'])
+    else:
+        area_diffs, i_o_us = compute_iou_batch(cadastre_polygons, osm_polygons, chunk_size=config['iou_chunk_size'])
+        tiers = [EXACT_TIER] * len(found)
+    measured = {i: (float(area_diff), float(i_o_u), tier)
+                for i, area_diff, i_o_u, tier in zip(found, area_diffs, i_o_us, tiers)}
+
+    batch_results = []
+    for i, (level9_entity, osm_level9) in enumerate(zip(level9_entities, osm_level9s)):
+        _, osm_settlement_name, osm_relation_id, national_border = osm_level9
+        if i not in measured:
+            batch_results.append(create_result(level9_entity, '', -1, -1, -1, national_border, ''))
+            continue
+        area_diff, i_o_u, tier = measured[i]
+        print(level9_entity['level8_name'], level9_entity['level9_name'], osm_settlement_name, 100 * area_diff, i_o_u,
+              tier)
+        batch_results.append(create_result(level9_entity, osm_settlement_name, osm_relation_id, round(area_diff, 5),
+                                           round(i_o_u, 5), national_border, tier))
+    return batch_results
+
+
+def process_level9_batch_with_stats(config, overpass_api, level9_entities, count_processed, total_to_process,
+                                    osm_level9s=None):
+    """
+    Same as process_level9_batch, but also returns Overpass cache stats and retry stats of this batch (workers are
+    separate processes, so their stats are not seen by main process otherwise)
+    """
+    retry_stats_before = Counter(get_retry_policy().stats())
+    batch_results = process_level9_batch(config, overpass_api, level9_entities, count_processed, total_to_process,
+                                         osm_level9s)
+    retry_stats = Counter(get_retry_policy().stats())
+    retry_stats.subtract(retry_stats_before)
+    return batch_results, overpass_api.stats() if isinstance(overpass_api, CachedOverpass) else {}, dict(retry_stats)
+
+
+def measure_features(config, overpass_api, features_to_process, total_to_process, snapshot_polygons=None):
+    """
+    Measures all given features in worker processes.
+
+    :return: Tuple of (list of results, Overpass cache stats of all workers, Overpass retry stats of all workers)
+    """
+    results = []
+    cache_stats = Counter()
+    retry_stats = Counter()
+    if snapshot_polygons is not None:
+        # With snapshot, there are no queries to Overpass (except for fallback by name), so all work is CPU-bound
+        thread_count = multiprocessing.cpu_count()
+        print('Using {0} threads'.format(thread_count))
+        # Entities are sent in chunks, so IoU of whole chunk is computed at once, but there are still enough chunks
+        # to keep all workers busy
+        chunk_size = max(1, min(config['iou_chunk_size'], math.ceil(len(features_to_process) / (4 * thread_count))))
+        all_futures = []
+        with ProcessPoolExecutor(max_workers=thread_count) as executor:
+            for i in range(0, len(features_to_process), chunk_size):
+                level9_chunk = features_to_process[i:i + chunk_size]
+                osm_level9s = [snapshot_polygons.get(f['level9_id'], (None, None, None, None)) for f in level9_chunk]
+                future = executor.submit(process_level9_batch_with_stats, config, overpass_api, level9_chunk,
+                                         i + 1, total_to_process, osm_level9s)
+                all_futures.append(future)
+            for future in as_completed(all_futures):
+                batch_results, batch_cache_stats, batch_retry_stats = future.result()
+                results.extend(batch_results)
+                cache_stats.update(batch_cache_stats)
+                retry_stats.update(batch_retry_stats)
+    else:
+        # Without snapshot, entities are sent to workers in batches, so each worker fetches whole batch in single
+        # query. Number of batches in flight follows how well Overpass keeps up.
+        batch_size = config['overpass_batch_size']
+        controller = AIMDController.from_config(config)
+        tasks = ((config, overpass_api, features_to_process[i:i + batch_size], i + 1, total_to_process)
+                 for i in range(0, len(features_to_process), batch_size))
+        with ProcessPoolExecutor(max_workers=controller.max_concurrency) as executor:
+            for batch_results, batch_cache_stats, batch_retry_stats in run_adaptive(
+                    executor, controller, process_level9_batch_with_stats, tasks):
+                results.extend(batch_results)
+                cache_stats.update(batch_cache_stats)
+                retry_stats.update(batch_retry_stats)
+    return results, cache_stats, retry_stats
+
+
+def is_result_up_to_date(previous_result, level9_feature, changed_level9_ids):
+    """
+    Result from previous run is still valid if cadastre geometry is same and OSM relation (found by its id) is same
+    version and none of its ways or nodes changed since previous run
+    """
+    if previous_result['cadastre_hash'] != level9_feature['cadastre_hash']:
+        return False
+    if previous_result['relation_version'] == '' or \
+            previous_result['relation_version'] != str(level9_feature['relation_version']):
+        return False
+    return level9_feature['level9_id'] not in changed_level9_ids
+
+
+def measure_quality(config, overpass_api, input_csv_file, output_file, snapshot_file=None):
     global results
-    results = get_current_results(output_file)
+    previous_results = get_current_results(output_file)
+    previous_osm_timestamp = get_results_osm_timestamp(output_file)
     level9_features = load_level9_features(input_csv_file)
 
-    count_processed = 1
-    all_futures = []
-    thread_count = 1 if 'localhost' not in overpass_api.url else multiprocessing.cpu_count()
-    print('Using {0} threads'.format(thread_count))
-    with ProcessPoolExecutor(max_workers=thread_count) as executor:
-        for level9_feature in level9_features:
-            # Skip if already processed
-            level8_name = level9_feature['level8_name']
-            level9_name = level9_feature['level9_name']
-            if any((r for r in results if r['level8'] == level8_name and r['level9'] == level9_name)):
-                print('Level8 {0} and level9 {1} already processed'.format(level8_name, level9_name))
-                continue
-
-            future = executor.submit(process_level9, config, overpass_api, level9_feature, count_processed, len(level9_features))
-            all_futures.append(future)
-            count_processed = count_processed + 1
-        for future in as_completed(all_futures):
-            results.append(future.result())
+    # Take timestamp before measuring, so that changes made during measurement are picked up next time
+    osm_timestamp = get_osm_base_timestamp(overpass_api.url)
+    relation_versions = get_relation_versions(overpass_api, admin_level=9, country=config['country'],
+                                              id_key=config['level9_ref_key'])
+    for level9_feature in level9_features:
+        level9_feature['relation_version'] = relation_versions.get(level9_feature['level9_id'], (None, ''))[1]
+        level9_feature['cadastre_hash'] = level9_feature.geometry_hash
+
+    changed_level9_ids = None
+    if osm_timestamp is None:
+        print('Cannot get timestamp of OSM data from Overpass, measuring everything')
+    elif previous_osm_timestamp is not None and osm_timestamp < previous_osm_timestamp:
+        print('OSM data in Overpass ({0}) is older than previous measurement ({1}), measuring everything'.format(
+            osm_timestamp, previous_osm_timestamp))
+    elif previous_osm_timestamp is not None and len(previous_results) > 0:
+        changed_level9_ids = get_changed_cadastre_ids(overpass_api, admin_level=9, country=config['country'],
+                                                      id_key=config['level9_ref_key'], since=previous_osm_timestamp)
+        print('Found {0} level9 entities changed in OSM since {1}'.format(len(changed_level9_ids),
+                                                                         previous_osm_timestamp))
+
+    # Carry forward results which are still valid, and measure only the rest
+    results = []
+    previous_results_by_name = {(r['level8_name'], r['level9_name']): r for r in previous_results}
+    features_to_process = []
+    for level9_feature in level9_features:
+        level8_name = level9_feature['level8_name']
+        level9_name = level9_feature['level9_name']
+        previous_result = previous_results_by_name.get((level8_name, level9_name))
+        if previous_result is not None and changed_level9_ids is not None and \
+                is_result_up_to_date(previous_result, level9_feature, changed_level9_ids):
+            results.append(previous_result)
+            continue
+        features_to_process.append(level9_feature)
+    print('Measuring {0} level9 entities, {1} are unchanged since last measurement'.format(
+        len(features_to_process), len(results)))
+
+    snapshot_polygons = None
+    if snapshot_file is not None and len(features_to_process) > 0:
+        if not os.path.isfile(snapshot_file):
+            print('Downloading snapshot of all level9 entities to {0}'.format(snapshot_file))
+            download_snapshot(overpass_api.url, config['country'], 9, snapshot_file)
+        snapshot_polygons = load_snapshot_polygons(snapshot_file, config['level9_ref_key'])
+
+    # Cadastre geometries are read by workers from WKB sidecar of input .csv, which they memory-map
+    measured_results, cache_stats, retry_stats = measure_features(config, overpass_api, features_to_process,
+                                                                  len(level9_features), snapshot_polygons)
+    results.extend(measured_results)
     write_results(results, output_file)
+    write_results_osm_timestamp(output_file, osm_timestamp)
+    # Queries made here (versions, changed entities) are added to those made in workers
+    retry_stats.update(get_retry_policy().stats())
+    print('Overpass retry stats: {0}'.format(dict(retry_stats)))
+    if isinstance(overpass_api, CachedOverpass):
+        print('Overpass cache stats: {0}'.format(dict(cache_stats)))
 
 
 if __name__ == '__main__':
     with open('config.yml', 'r') as config_yml_file:
         config = yaml.safe_load(config_yml_file)
+    configure_retry_policy(config)
 
-    overpass_api = overpy.Overpass(url=config['overpass_url'])
+    overpass_api = create_overpass_api(config)
 
-    if len(sys.argv) != 3:
-        print("Usage: ./measure_quality.py <input_csv_file> <output_csv_file>")
+    if len(sys.argv) not in (3, 4):
+        print("Usage: ./measure_quality.py <input_csv_file> <output_csv_file> [<snapshot_file>]")
         exit()
     input_csv_file = sys.argv[1]
     output_csv_file = sys.argv[2]
-    measure_quality(config, overpass_api, input_csv_file, output_csv_file)
+    snapshot_file = sys.argv[3] if len(sys.argv) == 4 else None
+    measure_quality(config, overpass_api, input_csv_file, output_csv_file, snapshot_file)
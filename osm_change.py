@@ -0,0 +1,289 @@
+"""
+Edits of OSM nodes and ways, collected in memory and uploaded together, as one osmChange diff. Before, each node was
+sent with its own osmapi call (NodeUpdate, NodeCreate...), which had to be buffered and flushed. Here, whole edit of
+a way (or of a batch of ways) is built first, and then uploaded with a single changeset upload call.
+
+Edits can also be saved to osmChange file (a plan) and uploaded later, in bulk, after checking that nothing they touch
+was changed in OSM in the meantime.
+"""
+
+import os
+import threading
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+from atomic_write import atomic_write
+
+# OSM API does not allow more elements in one changeset
+MAX_CHANGESET_ELEMENTS = 10000
+
+
+def get_changeset_tags(config):
+    return {
+        u"comment": config['changeset_comment'],
+        u"tag": u"mechanical=yes", u"source": config['changeset_source']
+    }
+
+
+class OsmChange(object):
+    """
+    Created, modified and deleted nodes and modified ways. Elements are in osmapi format (dicts with 'id', 'version',
+    'lat', 'lon', 'tag', 'nd'...). New nodes get negative placeholder ids, which can be used in ways right away, OSM
+    replaces them with real ids on upload.
+    """
+    def __init__(self):
+        self.created_nodes = []
+        self.modified_nodes = {}  # node id => node
+        self.modified_ways = {}  # way id => way
+        self.deleted_nodes = {}  # node id => node
+        self._last_placeholder_id = 0
+
+    def __len__(self):
+        return len(self.created_nodes) + len(self.modified_nodes) + len(self.modified_ways) + len(self.deleted_nodes)
+
+    def create_node(self, lon, lat, tags=None):
+        """
+        :return: Placeholder (negative) id of new node
+        """
+        self._last_placeholder_id = self._last_placeholder_id - 1
+        self.created_nodes.append({'id': self._last_placeholder_id, 'lon': lon, 'lat': lat, 'tag': tags or {}})
+        return self._last_placeholder_id
+
+    @property
+    def way_id(self):
+        """
+        Id of modified way, for changes which modify only one way (as conflation of a way does)
+        """
+        assert len(self.modified_ways) == 1
+        return next(iter(self.modified_ways))
+
+    def move_node(self, node, lon, lat):
+        """
+        Moves node, unless it is already there (at precision of 7 decimals, which OSM keeps)
+        """
+        if round(node['lon'], 7) == round(lon, 7) and round(node['lat'], 7) == round(lat, 7):
+            return
+        node['lon'] = lon
+        node['lat'] = lat
+        self.modified_nodes[node['id']] = node
+
+    def modify_way(self, way):
+        self.modified_ways[way['id']] = way
+
+    def delete_node(self, node):
+        self.modified_nodes.pop(node['id'], None)
+        self.deleted_nodes[node['id']] = node
+
+    def to_changes(self):
+        """
+        :return: List of changes in format of osmapi's ChangesetUpload. New nodes go first, so ways can reference
+        them, and deleted nodes go last, after ways stopped using them.
+        """
+        changes = [{'type': 'node', 'action': 'create', 'data': node} for node in self.created_nodes]
+        changes.extend({'type': 'node', 'action': 'modify', 'data': node} for node in self.modified_nodes.values())
+        changes.extend({'type': 'way', 'action': 'modify', 'data': way} for way in self.modified_ways.values())
+        changes.extend({'type': 'node', 'action': 'delete', 'data': node} for node in self.deleted_nodes.values())
+        return changes
+
+
+def get_changes_bounds(changes):
+    """
+    :param changes: List of changes in format of osmapi's ChangesetUpload
+    :return: Bounding box (min_lon, min_lat, max_lon, max_lat) of all nodes in changes, or None if there are no nodes
+    """
+    nodes = [change['data'] for change in changes if change['type'] == 'node']
+    if len(nodes) == 0:
+        return None
+    lons = [node['lon'] for node in nodes]
+    lats = [node['lat'] for node in nodes]
+    return min(lons), min(lats), max(lons), max(lats)
+
+
+class ChangesetUploader(object):
+    """
+    Uploads diffs to changeset which is kept open until it would get more than max_elements, or until its bounding box
+    would get wider or higher than max_extent degrees (if given), so many diffs (e.g. one for each conflated way) share
+    one changeset. Diff is applied in OSM as soon as it is uploaded, changeset only groups them. Call close when done.
+    """
+    def __init__(self, osmapi, changeset_tags, max_elements=MAX_CHANGESET_ELEMENTS, max_extent=None):
+        self.osmapi = osmapi
+        self.changeset_tags = changeset_tags
+        self.max_elements = max_elements
+        self.max_extent = max_extent
+        self.changeset_id = None
+        self.element_count = 0
+        self.bounds = None
+
+    def _merge_bounds(self, bounds):
+        if self.bounds is None or bounds is None:
+            return self.bounds or bounds
+        return (min(self.bounds[0], bounds[0]), min(self.bounds[1], bounds[1]),
+                max(self.bounds[2], bounds[2]), max(self.bounds[3], bounds[3]))
+
+    def upload(self, changes):
+        """
+        :param changes: List of changes in format of osmapi's ChangesetUpload
+        """
+        bounds = get_changes_bounds(changes)
+        merged_bounds = self._merge_bounds(bounds)
+        too_wide = self.max_extent is not None and merged_bounds is not None and \
+            max(merged_bounds[2] - merged_bounds[0], merged_bounds[3] - merged_bounds[1]) > self.max_extent
+        if self.changeset_id is not None and (self.element_count + len(changes) > self.max_elements or too_wide):
+            self.close()
+            merged_bounds = bounds
+        if self.changeset_id is None:
+            self.changeset_id = self.osmapi.ChangesetCreate(dict(self.changeset_tags))
+            self.element_count = 0
+            print(f'Opened changeset https://www.openstreetmap.org/changeset/{self.changeset_id}')
+        self.osmapi.ChangesetUpload(changes)
+        self.element_count = self.element_count + len(changes)
+        self.bounds = merged_bounds
+
+    def close(self):
+        if self.changeset_id is not None:
+            self.osmapi.ChangesetClose()
+            self.changeset_id = None
+            self.bounds = None
+
+
+def _element_to_xml(parent, element_type, data):
+    attributes = {'id': str(data['id'])}
+    if 'version' in data:
+        attributes['version'] = str(data['version'])
+    if element_type == 'node':
+        attributes['lat'] = str(data['lat'])
+        attributes['lon'] = str(data['lon'])
+    xml_element = ET.SubElement(parent, element_type, attributes)
+    for node_id in data.get('nd', []):
+        ET.SubElement(xml_element, 'nd', {'ref': str(node_id)})
+    for k, v in data.get('tag', {}).items():
+        ET.SubElement(xml_element, 'tag', {'k': k, 'v': v})
+
+
+def _element_from_xml(xml_element):
+    data = {'id': int(xml_element.attrib['id']),
+            'tag': {tag.attrib['k']: tag.attrib['v'] for tag in xml_element.iter('tag')}}
+    if 'version' in xml_element.attrib:
+        data['version'] = int(xml_element.attrib['version'])
+    if xml_element.tag == 'node':
+        data['lat'] = float(xml_element.attrib['lat'])
+        data['lon'] = float(xml_element.attrib['lon'])
+    else:
+        data['nd'] = [int(nd.attrib['ref']) for nd in xml_element.iter('nd')]
+    return data
+
+
+def write_osm_change_plan(plan_file, osm_changes):
+    """
+    Writes changes to osmChange file. Each change gets its own create, modify and delete block (even if empty), in
+    that order, so that file is valid osmChange (which can be opened in JOSM), but it can also be split back to same
+    changes. Placeholder ids of new nodes are renumbered, so they are unique in whole file.
+    """
+    root = ET.Element('osmChange', {'version': '0.6', 'generator': 'conflate.py'})
+    last_placeholder_id = 0
+    for osm_change in osm_changes:
+        placeholder_ids = {}
+        create = ET.SubElement(root, 'create')
+        for node in osm_change.created_nodes:
+            last_placeholder_id = last_placeholder_id - 1
+            placeholder_ids[node['id']] = last_placeholder_id
+            _element_to_xml(create, 'node', dict(node, id=last_placeholder_id))
+        modify = ET.SubElement(root, 'modify')
+        for node in osm_change.modified_nodes.values():
+            _element_to_xml(modify, 'node', node)
+        for way in osm_change.modified_ways.values():
+            _element_to_xml(modify, 'way', dict(way, nd=[placeholder_ids.get(n, n) for n in way['nd']]))
+        delete = ET.SubElement(root, 'delete')
+        for node in osm_change.deleted_nodes.values():
+            _element_to_xml(delete, 'node', node)
+    Path(plan_file).touch()
+    with atomic_write(plan_file, keep=False) as f:
+        ET.ElementTree(root).write(f, encoding='unicode', xml_declaration=True)
+
+
+def read_osm_change_plan(plan_file):
+    """
+    Reads changes written with write_osm_change_plan
+    :return: List of OsmChange
+    """
+    blocks = list(ET.parse(plan_file).getroot())
+    expected_tags = ('create', 'modify', 'delete')
+    if len(blocks) % 3 != 0 or any(block.tag != expected_tags[i % 3] for i, block in enumerate(blocks)):
+        raise ValueError(f'{plan_file} is not a conflation plan, expected create, modify and delete block for each way')
+    osm_changes = []
+    for i in range(0, len(blocks), 3):
+        create, modify, delete = blocks[i:i + 3]
+        osm_change = OsmChange()
+        osm_change.created_nodes = [_element_from_xml(node) for node in create]
+        if len(osm_change.created_nodes) > 0:
+            osm_change._last_placeholder_id = min(node['id'] for node in osm_change.created_nodes)
+        for xml_element in modify:
+            data = _element_from_xml(xml_element)
+            if xml_element.tag == 'node':
+                osm_change.modified_nodes[data['id']] = data
+            else:
+                osm_change.modified_ways[data['id']] = data
+        for node in delete:
+            data = _element_from_xml(node)
+            osm_change.deleted_nodes[data['id']] = data
+        osm_changes.append(osm_change)
+    return osm_changes
+
+
+class ConflationPlan(object):
+    """
+    Planned changes of each way which can be conflated, by OSM way id. If plan file already exists (e.g. from
+    interrupted dry run), planned ways from it are kept, and new ones are added (or replace them).
+    """
+    def __init__(self, plan_file):
+        self.plan_file = plan_file
+        self.changes = {}
+        self._lock = threading.Lock()
+        if os.path.isfile(plan_file):
+            for osm_change in read_osm_change_plan(plan_file):
+                self.changes[osm_change.way_id] = osm_change
+            print(f'Loaded {len(self.changes)} planned ways from {plan_file}')
+
+    def add(self, osm_change):
+        with self._lock:
+            self.changes[osm_change.way_id] = osm_change
+
+    def save(self):
+        with self._lock:
+            write_osm_change_plan(self.plan_file, self.changes.values())
+        print(f'Saved {len(self.changes)} planned ways to {self.plan_file}')
+
+
+def find_conflicts(osmapi, osm_changes, chunk_size=500):
+    """
+    Compares versions of nodes and ways which changes modify or delete with their current versions in OSM. Current
+    versions are fetched in bulk (NodesGet/WaysGet), chunk_size elements per call.
+
+    :return: Map of way id => reason, for each change that touches anything that was changed (or deleted) in OSM
+    """
+    base_nodes, base_ways = {}, {}
+    for osm_change in osm_changes:
+        base_nodes.update(osm_change.modified_nodes)
+        base_nodes.update(osm_change.deleted_nodes)
+        base_ways.update(osm_change.modified_ways)
+    current_nodes, current_ways = {}, {}
+    node_ids, way_ids = list(base_nodes), list(base_ways)
+    for start in range(0, len(node_ids), chunk_size):
+        current_nodes.update(osmapi.NodesGet(node_ids[start:start + chunk_size]))
+    for start in range(0, len(way_ids), chunk_size):
+        current_ways.update(osmapi.WaysGet(way_ids[start:start + chunk_size]))
+
+    conflicts = {}
+    for osm_change in osm_changes:
+        touched = [('node', node, current_nodes.get(node['id']))
+                   for node in list(osm_change.modified_nodes.values()) + list(osm_change.deleted_nodes.values())]
+        touched.extend(('way', way, current_ways.get(way['id'])) for way in osm_change.modified_ways.values())
+        for element_type, base, current in touched:
+            if current is None or not current.get('visible', True):
+                conflicts[osm_change.way_id] = f'{element_type} {base["id"]} is deleted'
+                break
+            if current['version'] != base['version']:
+                conflicts[osm_change.way_id] = f'{element_type} {base["id"]} changed from version {base["version"]} ' \
+                                               f'to {current["version"]}'
+                break
+    return conflicts
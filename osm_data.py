@@ -0,0 +1,141 @@
+"""
+Compact, array-backed storage for .osm files produced by ogr2osm. Node coordinates and way node refs are kept in
+numpy arrays instead of per-element dicts and lists, which keeps national-scale cadastre files in reasonable memory,
+while still being accessed like plain dicts (source_data['nodes'][node_id]['lat'], way['nodes'], way['processed']...).
+"""
+
+from collections.abc import Mapping, MutableMapping
+
+import numpy as np
+
+from processing_state import ProcessingState
+
+
+def _sorted_ids(ids):
+    ids = np.asarray(ids, dtype=np.int64)
+    order = np.argsort(ids, kind='stable')
+    return ids[order], order
+
+
+class NodeStore(Mapping):
+    """
+    Map of node id => {'lat', 'lon'}, backed by sorted id array and coordinate arrays
+    """
+
+    def __init__(self, ids, lats, lons):
+        self.ids, order = _sorted_ids(ids)
+        self.lats = np.asarray(lats, dtype=np.float64)[order]
+        self.lons = np.asarray(lons, dtype=np.float64)[order]
+
+    def index_of(self, node_id):
+        i = int(np.searchsorted(self.ids, node_id))
+        if i == len(self.ids) or self.ids[i] != node_id:
+            raise KeyError(node_id)
+        return i
+
+    def __getitem__(self, node_id):
+        i = self.index_of(node_id)
+        return {'lat': float(self.lats[i]), 'lon': float(self.lons[i])}
+
+    def __iter__(self):
+        return (int(node_id) for node_id in self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class WayView(MutableMapping):
+    """
+    Dict-like view of a single way in WayStore. Node refs are read-only, processing state can be changed.
+    """
+    __slots__ = ('_store', '_index')
+
+    _state_keys = ('relations', 'processed', 'error_context', 'osm_way')
+
+    def __init__(self, store, index):
+        self._store = store
+        self._index = index
+
+    def __getitem__(self, key):
+        store, i = self._store, self._index
+        if key == 'nodes':
+            return store.refs[store.offsets[i]:store.offsets[i + 1]]
+        if key == 'processed':
+            return ProcessingState(int(store.processed[i]))
+        if key == 'relations':
+            return store.relations.get(i, '')
+        if key == 'error_context':
+            return store.error_contexts.get(i)
+        if key == 'osm_way':
+            return store.osm_ways.get(i)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        store, i = self._store, self._index
+        if key == 'processed':
+            store.processed[i] = value.value
+            return
+        if key == 'relations':
+            attribute = store.relations
+        elif key == 'error_context':
+            attribute = store.error_contexts
+        elif key == 'osm_way':
+            attribute = store.osm_ways
+        else:
+            raise KeyError(key)
+        if value is None:
+            attribute.pop(i, None)
+        else:
+            attribute[i] = value
+
+    def __delitem__(self, key):
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(('nodes',) + self._state_keys)
+
+    def __len__(self):
+        return 1 + len(self._state_keys)
+
+
+class WayStore(Mapping):
+    """
+    Map of way id => WayView. Node refs of all ways are in a single flat int64 buffer, with offsets per way.
+    Processing state is kept in a byte array, other (sparse) state in dicts keyed by way index.
+    """
+
+    def __init__(self, ids, offsets, refs):
+        self.ids, order = _sorted_ids(ids)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        refs = np.asarray(refs, dtype=np.int64)
+        # Reorder refs to follow sorted way ids
+        starts, ends = offsets[:-1][order], offsets[1:][order]
+        lengths = ends - starts
+        self.offsets = np.zeros(len(self.ids) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=self.offsets[1:])
+        self.refs = refs[np.arange(self.offsets[-1]) + np.repeat(starts - self.offsets[:-1], lengths)]
+        self.processed = np.full(len(self.ids), ProcessingState.NO.value, dtype=np.uint8)
+        self.relations = {}
+        self.error_contexts = {}
+        self.osm_ways = {}
+
+    def index_of(self, way_id):
+        i = int(np.searchsorted(self.ids, way_id))
+        if i == len(self.ids) or self.ids[i] != way_id:
+            raise KeyError(way_id)
+        return i
+
+    def __getitem__(self, way_id):
+        return WayView(self, self.index_of(way_id))
+
+    def __iter__(self):
+        return (int(way_id) for way_id in self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def items(self):
+        return ((int(way_id), WayView(self, i)) for i, way_id in enumerate(self.ids))
+
+    def values(self):
+        return (WayView(self, i) for i in range(len(self.ids)))
@@ -0,0 +1,183 @@
+"""
+Persistent, on-disk cache of Overpass responses. Responses are stored under a hash of normalized query text and of
+Overpass "osm_base" timestamp, so answer is reused only while Overpass serves the very same OSM data. Once Overpass
+is updated, all keys change and old entries are simply evicted (least recently used first) when cache grows too big.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import time
+import urllib.request
+from collections import Counter
+
+import overpy
+
+from common import fetch_overpass_raw
+
+_WHITESPACE_RE = re.compile(r'\s+')
+
+
+def normalize_query(query):
+    """
+    Query text without comments and with all whitespace collapsed, so formatting differences do not matter
+    """
+    lines = [line for line in query.splitlines() if not line.strip().startswith('//')]
+    return _WHITESPACE_RE.sub(' ', '\n'.join(lines)).strip()
+
+
+def get_osm_base_timestamp(url, timeout=10):
+    """
+    Timestamp of OSM data Overpass currently serves (from /api/timestamp), or None if it cannot be read
+    """
+    timestamp_url = url.rsplit('/', 1)[0] + '/timestamp'
+    try:
+        with urllib.request.urlopen(timestamp_url, timeout=timeout) as f:
+            timestamp = f.read().decode('utf-8').strip()
+    except Exception:
+        return None
+    return timestamp if timestamp != '' else None
+
+
+class CachedOverpass(overpy.Overpass):
+    """
+    Drop-in replacement for overpy.Overpass, which answers queries from on-disk cache when it can
+    """
+
+    def __init__(self, url, cache_directory, max_size_mb=1024, timestamp_ttl=60, **kwargs):
+        super(CachedOverpass, self).__init__(url=url, **kwargs)
+        self.cache_directory = cache_directory
+        self.max_size = max_size_mb * 1024 * 1024
+        self.timestamp_ttl = timestamp_ttl
+        self._timestamp = None
+        self._timestamp_checked_at = None
+        self._counters = Counter()
+        self._lock = threading.Lock()
+        self._size = None  # approximate size of cache, computed on first write
+        os.makedirs(cache_directory, exist_ok=True)
+
+    def __getstate__(self):
+        # Instances are sent to worker processes, which start with their own (empty) stats
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_counters'] = Counter()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def osm_base_timestamp(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._timestamp_checked_at is None or now - self._timestamp_checked_at > self.timestamp_ttl:
+                self._timestamp = get_osm_base_timestamp(self.url)
+                self._timestamp_checked_at = now
+            return self._timestamp
+
+    def cache_key(self, query):
+        timestamp = self.osm_base_timestamp()
+        if timestamp is None:
+            return None
+        return hashlib.sha256((timestamp + '\n' + normalize_query(query)).encode('utf-8')).hexdigest()
+
+    def _cache_file(self, key):
+        return os.path.join(self.cache_directory, key[0:2], key)
+
+    def _count(self, counter, value=1):
+        with self._lock:
+            self._counters[counter] = self._counters[counter] + value
+
+    def _get(self, key):
+        cache_file = self._cache_file(key)
+        try:
+            with open(cache_file, 'rb') as f:
+                response = f.read()
+            os.utime(cache_file)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        return response
+
+    def _put(self, key, response):
+        cache_file = self._cache_file(key)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # Write to temporary file first, so other processes never read half-written entry
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(response)
+        os.replace(tmp_file, cache_file)
+        if self._size is None:
+            self.evict()
+        else:
+            self._size = self._size + len(response)
+            if self._size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until cache is smaller than max size
+        """
+        entries = []
+        total_size = 0
+        for root, _, files in os.walk(self.cache_directory):
+            for file in files:
+                try:
+                    stat = os.stat(os.path.join(root, file))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, file)))
+                total_size = total_size + stat.st_size
+        self._size = total_size
+        if total_size <= self.max_size:
+            return
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._count('evictions')
+            total_size = total_size - size
+            self._size = total_size
+            if total_size <= self.max_size:
+                break
+
+    def fetch_raw(self, query):
+        """
+        Returns raw response body of a query, from cache if possible
+        """
+        key = self.cache_key(query)
+        if key is not None:
+            response = self._get(key)
+            if response is not None:
+                self._count('hits')
+                self._count('bytes_from_cache', len(response))
+                return response
+        self._count('misses')
+        response = fetch_overpass_raw(self.url, query)
+        if key is not None:
+            self._put(key, response)
+        return response
+
+    def query(self, query):
+        if isinstance(query, bytes):
+            query = query.decode('utf-8')
+        response = self.fetch_raw(query)
+        if response.lstrip()[0:1] == b'{':
+            return self.parse_json(response)
+        return self.parse_xml(response)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+def create_overpass_api(config):
+    """
+    Creates Overpass API client as configured in config.yml, with on-disk cache in front of it if "overpass_cache" is set
+    """
+    cache_config = config.get('overpass_cache')
+    if not cache_config:
+        return overpy.Overpass(url=config['overpass_url'])
+    return CachedOverpass(url=config['overpass_url'], **cache_config)
@@ -0,0 +1,171 @@
+"""
+Compact decoding of Overpass JSON responses. overpy parses each response into graph of Node/Way/Relation objects, which
+is slow and takes a lot of memory for large boundary relations, while we mostly need just coordinates, member ids and
+few tags. Here, response is decoded straight into arrays: coordinates of nodes (with map of node id => index), node
+indexes of each way (as range in one flat array) and members of each relation. Light views over those arrays look like
+overpy elements (id, tags, nodes, members...), so code reading responses works with both.
+"""
+
+import json
+
+import numpy as np
+from overpy.exception import DataIncomplete, OverpassGatewayTimeout
+
+
+class CompactNode(object):
+    __slots__ = ('id', 'lon', 'lat', 'tags')
+
+    def __init__(self, node_id, lon, lat, tags):
+        self.id = node_id
+        self.lon = lon
+        self.lat = lat
+        self.tags = tags
+
+
+class CompactMember(object):
+    """
+    Member of a relation. Type is 'node', 'way' or 'relation'.
+    """
+    __slots__ = ('type', 'ref', 'role')
+
+    def __init__(self, member_type, ref, role):
+        self.type = member_type
+        self.ref = ref
+        self.role = role
+
+
+class CompactWay(object):
+    __slots__ = ('_result', '_index', 'id', 'tags')
+
+    def __init__(self, result, index):
+        self._result = result
+        self._index = index
+        self.id = result.way_ids[index]
+        self.tags = result.way_tags[index]
+
+    @property
+    def node_ids(self):
+        return self._result.way_node_ids[self._index]
+
+    @property
+    def nodes(self):
+        return [self._result.get_node(node_id) for node_id in self.node_ids]
+
+    def coords(self):
+        """
+        :return: List of (lon, lat) of way nodes
+        """
+        return self._result.way_coords(self._index)
+
+
+class CompactRelation(object):
+    __slots__ = ('id', 'tags', 'attributes', 'members')
+
+    def __init__(self, relation_id, tags, attributes, members):
+        self.id = relation_id
+        self.tags = tags
+        self.attributes = attributes
+        self.members = members
+
+
+class CompactResult(object):
+    def __init__(self):
+        self.node_index = {}  # node id => index in lons/lats
+        self.lons = np.empty(0, dtype=np.float64)
+        self.lats = np.empty(0, dtype=np.float64)
+        self.node_ids = []
+        self.node_tags = {}  # node index => tags, only for nodes having tags
+        self.way_index = {}  # way id => index in way_ids/way_tags/way_offsets
+        self.way_ids = []
+        self.way_tags = []
+        self.way_node_ids = []  # node ids of each way, as they were in response
+        self.way_offsets = None  # way i has node indexes way_node_indexes[way_offsets[i]:way_offsets[i + 1]]
+        self.way_node_indexes = None
+        self.relations = []
+
+    @classmethod
+    def from_json(cls, data):
+        result = cls()
+        lons, lats = [], []
+        for element in data.get('elements', []):
+            element_type = element.get('type')
+            if element_type == 'node':
+                if element['id'] in result.node_index:
+                    continue
+                result.node_index[element['id']] = len(result.node_ids)
+                result.node_ids.append(element['id'])
+                lons.append(element['lon'])
+                lats.append(element['lat'])
+                if element.get('tags'):
+                    result.node_tags[len(result.node_ids) - 1] = element['tags']
+            elif element_type == 'way':
+                if element['id'] in result.way_index:
+                    continue
+                result.way_index[element['id']] = len(result.way_ids)
+                result.way_ids.append(element['id'])
+                result.way_tags.append(element.get('tags', {}))
+                result.way_node_ids.append(element.get('nodes', []))
+            elif element_type == 'relation':
+                members = [CompactMember(m['type'], m['ref'], m['role']) for m in element.get('members', [])]
+                attributes = {k: v for k, v in element.items() if k not in ('type', 'id', 'tags', 'members')}
+                result.relations.append(CompactRelation(element['id'], element.get('tags', {}), attributes, members))
+        result.lons = np.array(lons, dtype=np.float64)
+        result.lats = np.array(lats, dtype=np.float64)
+        # Nodes of ways which are not in response get index -1, and fail only if their coordinates are needed
+        result.way_offsets = np.zeros(len(result.way_ids) + 1, dtype=np.int64)
+        result.way_offsets[1:] = np.cumsum([len(node_ids) for node_ids in result.way_node_ids])
+        result.way_node_indexes = np.array([result.node_index.get(node_id, -1)
+                                            for node_ids in result.way_node_ids for node_id in node_ids],
+                                           dtype=np.int64)
+        return result
+
+    @property
+    def nodes(self):
+        return [self._node(i) for i in range(len(self.node_ids))]
+
+    @property
+    def ways(self):
+        return [CompactWay(self, i) for i in range(len(self.way_ids))]
+
+    def _node(self, index):
+        return CompactNode(self.node_ids[index], float(self.lons[index]), float(self.lats[index]),
+                           self.node_tags.get(index, {}))
+
+    def get_node(self, node_id):
+        if node_id not in self.node_index:
+            raise DataIncomplete('Node {0} is not in response'.format(node_id))
+        return self._node(self.node_index[node_id])
+
+    def get_ways(self, way_id=None):
+        """
+        Same as overpy.Result.get_ways - list of all ways, or list with way having given id (empty if there is none)
+        """
+        if way_id is None:
+            return self.ways
+        if way_id not in self.way_index:
+            return []
+        return [CompactWay(self, self.way_index[way_id])]
+
+    def get_relations(self, relation_id=None):
+        if relation_id is None:
+            return list(self.relations)
+        return [r for r in self.relations if r.id == relation_id]
+
+    def way_coords(self, index):
+        node_indexes = self.way_node_indexes[self.way_offsets[index]:self.way_offsets[index + 1]]
+        if len(node_indexes) > 0 and node_indexes.min() < 0:
+            raise DataIncomplete('Some nodes of way {0} are not in response'.format(self.way_ids[index]))
+        return list(zip(self.lons[node_indexes].tolist(), self.lats[node_indexes].tolist()))
+
+
+def parse_compact_json(response):
+    """
+    Decodes raw Overpass JSON response (bytes or str) into CompactResult. Overpass reports queries which failed midway
+    (timeout, out of memory) only as a remark, next to partial data, so those are raised as errors to be retried.
+    """
+    data = json.loads(response)
+    remark = data.get('remark', '')
+    if 'runtime error' in remark:
+        print('Overpass query failed: {0}'.format(remark))
+        raise OverpassGatewayTimeout
+    return CompactResult.from_json(data)
@@ -0,0 +1,112 @@
+"""
+Progress of conflation, kept in SQLite database. Source data (nodes, ways and relations from .osm file) is written
+only once, when progress is created, and after that only state of each processed way is written, in its own
+transaction. This is as crash-safe as rewriting whole pickle with atomic_write, but cost of saving one way does not
+grow with the size of input file.
+"""
+
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+
+from processing_state import ProcessingState
+
+_SQLITE_HEADER = b'SQLite format 3\x00'
+
+
+def is_progress_store(progress_file):
+    with open(progress_file, 'rb') as f:
+        return f.read(len(_SQLITE_HEADER)) == _SQLITE_HEADER
+
+
+class ProgressStore(object):
+    def __init__(self, progress_file):
+        self.connection = sqlite3.connect(progress_file)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')
+
+    @classmethod
+    def create(cls, progress_file, source_data, way_states=None):
+        """
+        Creates new progress store from loaded .osm data. Store is built in temporary file, which replaces progress file
+        only once it is complete, so interrupted creation never leaves empty store behind.
+
+        :param way_states: Processing state of each way, if not given, state from source_data is used (all ways are
+        expected to be in ProcessingState.NO state then)
+        """
+        if way_states is None:
+            way_states = source_data['ways']
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(progress_file)),
+                                        prefix=os.path.basename(progress_file), suffix='.tmp')
+        os.close(fd)
+        try:
+            store = cls(tmp_file)
+            with store.connection:
+                store.connection.execute('CREATE TABLE source (id INTEGER PRIMARY KEY, data BLOB NOT NULL)')
+                store.connection.execute('CREATE TABLE ways (way_id INTEGER PRIMARY KEY, processed INTEGER NOT NULL, '
+                                         'relations TEXT NOT NULL, error_context TEXT, osm_way INTEGER)')
+                store.connection.execute('INSERT INTO source (id, data) VALUES (0, ?)',
+                                         (pickle.dumps(source_data, protocol=pickle.DEFAULT_PROTOCOL),))
+                store.connection.executemany(
+                    'INSERT INTO ways (way_id, processed, relations, error_context, osm_way) VALUES (?, ?, ?, ?, ?)',
+                    ((way_id, way['processed'].value, way['relations'], way['error_context'], way['osm_way'])
+                     for way_id, way in way_states.items()))
+            store.close()
+            os.replace(tmp_file, progress_file)
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        return cls(progress_file)
+
+    @classmethod
+    def open(cls, progress_file):
+        """
+        Opens existing progress store. Progress files from older versions (pickled source data) are converted to
+        progress store, old file is kept with .bak extension.
+        """
+        if is_progress_store(progress_file):
+            return cls(progress_file)
+        print(f'Converting {progress_file} to new progress format')
+        with open(progress_file, 'rb') as p:
+            source_data = pickle.load(p)
+        shutil.copyfile(progress_file, progress_file + '.bak')
+        states = {way_id: dict(way) for way_id, way in source_data['ways'].items()}
+        for way in source_data['ways'].values():
+            way['processed'] = ProcessingState.NO
+        return cls.create(progress_file, source_data, states)
+
+    def load_source_data(self):
+        """
+        Loads source data, with processing state of each way as it is saved
+        """
+        data, = self.connection.execute('SELECT data FROM source WHERE id = 0').fetchone()
+        source_data = pickle.loads(data)
+        for way_id, way_state in self.load_way_states().items():
+            way = source_data['ways'][way_id]
+            for key, value in way_state.items():
+                way[key] = value
+        return source_data
+
+    def load_way_states(self):
+        """
+        Loads only processing state of each way, without source data
+        :return: Map of way_id => {'relations', 'processed', 'error_context', 'osm_way'}
+        """
+        way_states = {}
+        for way_id, processed, relations, error_context, osm_way in self.connection.execute(
+                'SELECT way_id, processed, relations, error_context, osm_way FROM ways ORDER BY way_id'):
+            way_states[way_id] = {'relations': relations, 'processed': ProcessingState(processed),
+                                  'error_context': error_context, 'osm_way': osm_way}
+        return way_states
+
+    def save_way(self, way_id, way):
+        with self.connection:
+            self.connection.execute(
+                'UPDATE ways SET processed = ?, relations = ?, error_context = ?, osm_way = ? WHERE way_id = ?',
+                (way['processed'].value, way['relations'], way['error_context'], way['osm_way'], way_id))
+
+    def close(self):
+        self.connection.close()
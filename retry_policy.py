@@ -0,0 +1,222 @@
+"""
+Retry policy for Overpass (and other HTTP) calls. Delays grow exponentially with jitter, rate limiting (429) waits for
+Overpass to free a slot (using Retry-After or /api/status), server errors (5xx) and connection errors are backed off
+separately, and each endpoint has a circuit breaker, so that many workers do not hammer an endpoint that is down.
+"""
+
+import http.client
+import random
+import re
+import socket
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+
+from overpy.exception import OverpassTooManyRequests, OverpassGatewayTimeout, OverpassUnknownContentType, \
+    OverpassUnknownHTTPStatusCode
+
+RATE_LIMITED = 'rate_limited'
+SERVER_ERROR = 'server_error'
+CONNECTION_ERROR = 'connection_error'
+
+_SLOT_WAIT_RE = re.compile(r'in (-?\d+) seconds')
+
+# Retryable errors seen by each thread, so that caller can tell how healthy its own calls were
+_thread_state = threading.local()
+
+
+def errors_in_current_thread():
+    return getattr(_thread_state, 'errors', 0)
+
+
+def classify_error(error):
+    """
+    Returns kind of error (RATE_LIMITED, SERVER_ERROR or CONNECTION_ERROR), or None if error should not be retried
+    """
+    if isinstance(error, OverpassTooManyRequests):
+        return RATE_LIMITED
+    if isinstance(error, urllib.error.HTTPError):
+        if error.code == 429:
+            return RATE_LIMITED
+        return SERVER_ERROR if error.code >= 500 else None
+    if isinstance(error, (OverpassGatewayTimeout, OverpassUnknownContentType)):
+        return SERVER_ERROR
+    if isinstance(error, OverpassUnknownHTTPStatusCode):
+        return SERVER_ERROR if error.code >= 500 else None
+    if isinstance(error, (ConnectionError, socket.timeout, urllib.error.URLError, http.client.RemoteDisconnected)):
+        return CONNECTION_ERROR
+    return None
+
+
+def get_retry_after(error):
+    """
+    Seconds to wait as told by server in Retry-After header, if any
+    """
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is None and isinstance(error, urllib.error.HTTPError) and error.headers is not None:
+        retry_after = error.headers.get('Retry-After')
+    try:
+        return max(0.0, float(retry_after)) if retry_after is not None else None
+    except ValueError:
+        return None
+
+
+def get_overpass_slot_wait(url, timeout=10):
+    """
+    Asks Overpass /api/status when next slot will be available.
+
+    :return: Seconds until next slot is available (0 if slot is available now), or None if status cannot be read
+    """
+    status_url = url.rsplit('/', 1)[0] + '/status'
+    try:
+        with urllib.request.urlopen(status_url, timeout=timeout) as f:
+            status = f.read().decode('utf-8', errors='replace')
+    except Exception:
+        return None
+    if 'slots available now' in status:
+        return 0
+    waits = [int(m.group(1)) for m in _SLOT_WAIT_RE.finditer(status)]
+    return max(0, min(waits)) if len(waits) > 0 else None
+
+
+class CircuitBreaker(object):
+    """
+    Opens after `threshold` consecutive failures of an endpoint. While open, callers wait for cooldown to pass, after
+    which one call is let through to probe endpoint (half-open). Success closes the breaker, failure opens it again.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def wait_time(self):
+        with self.lock:
+            if self.opened_at is None:
+                return 0
+            return max(0.0, self.opened_at + self.cooldown - time.monotonic())
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        """
+        :return: True if this failure opened the breaker
+        """
+        with self.lock:
+            self.consecutive_failures = self.consecutive_failures + 1
+            if self.consecutive_failures >= self.threshold:
+                was_closed = self.opened_at is None or time.monotonic() >= self.opened_at + self.cooldown
+                self.opened_at = time.monotonic()
+                return was_closed
+            return False
+
+
+class RetryPolicy(object):
+    def __init__(self, max_retries=5, base_delay=1, max_delay=120, jitter=0.5,
+                 circuit_breaker_threshold=5, circuit_breaker_cooldown=60, use_overpass_status=True):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.circuit_breaker_threshold = circuit_breaker_threshold
+        self.circuit_breaker_cooldown = circuit_breaker_cooldown
+        self.use_overpass_status = use_overpass_status
+        self.counters = Counter()
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(**config.get('retry', {}))
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] = self.counters[counter] + 1
+
+    def breaker(self, endpoint):
+        with self.lock:
+            if endpoint not in self.breakers:
+                self.breakers[endpoint] = CircuitBreaker(self.circuit_breaker_threshold, self.circuit_breaker_cooldown)
+            return self.breakers[endpoint]
+
+    def backoff_delay(self, attempt, max_delay):
+        """
+        Exponential backoff with jitter. Attempt is 0-based.
+        """
+        delay = min(max_delay, self.base_delay * (2 ** attempt))
+        return delay * (1 - self.jitter * random.random())
+
+    def delay_for(self, error, kind, attempt, endpoint, max_delay):
+        if kind == RATE_LIMITED:
+            # Server knows best when we can come back
+            retry_after = get_retry_after(error)
+            if retry_after is None and self.use_overpass_status and endpoint is not None:
+                retry_after = get_overpass_slot_wait(endpoint)
+            if retry_after is not None:
+                # Small jitter, so that all workers do not come back in the same moment
+                return min(max_delay, retry_after) + random.uniform(0, self.base_delay)
+            # Rate limiting is not an error of the endpoint, so back off from one step later than other errors
+            return self.backoff_delay(attempt + 1, max_delay)
+        return self.backoff_delay(attempt, max_delay)
+
+    def call(self, func, args, kwargs, endpoint=None, max_delay=None):
+        max_delay = self.max_delay if max_delay is None else min(self.max_delay, max_delay)
+        breaker = self.breaker(endpoint) if endpoint is not None else None
+        attempt = 0
+        while True:
+            if breaker is not None:
+                wait_time = breaker.wait_time()
+                if wait_time > 0:
+                    self.count('circuit_waits')
+                    time.sleep(wait_time)
+            self.count('calls')
+            try:
+                result = func(*args, **kwargs)
+            except BaseException as e:  # overpy exceptions are not derived from Exception
+                kind = classify_error(e)
+                if kind is None:
+                    raise
+                self.count(kind)
+                _thread_state.errors = errors_in_current_thread() + 1
+                # Rate limiting means endpoint is alive, do not trip breaker because of it
+                if breaker is not None and kind != RATE_LIMITED and breaker.record_failure():
+                    self.count('circuit_opened')
+                    print('Too many failures of {0}, pausing calls to it for {1}s'.format(
+                        endpoint, self.circuit_breaker_cooldown))
+                if attempt >= self.max_retries:
+                    self.count('exhausted')
+                    raise Exception('Exhausted retries ({0}) for {1}, quitting'.format(self.max_retries, kind)) from e
+                delay = self.delay_for(e, kind, attempt, endpoint, max_delay)
+                attempt = attempt + 1
+                self.count('retries')
+                print('{0} ({1}), retrying in {2:.1f}s ({3}/{4})'.format(
+                    kind, type(e).__name__, delay, attempt, self.max_retries))
+                time.sleep(delay)
+                continue
+            if breaker is not None:
+                breaker.record_success()
+            return result
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters)
+
+
+def get_endpoint(args, kwargs):
+    """
+    Finds URL of endpoint that is called, either from Overpass API object (its url) or from URL given as argument
+    """
+    for arg in list(args) + list(kwargs.values()):
+        url = getattr(arg, 'url', None)
+        if isinstance(url, str):
+            return url
+        if isinstance(arg, str) and arg.startswith(('http://', 'https://')):
+            return arg
+    return None
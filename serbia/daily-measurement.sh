@@ -23,6 +23,15 @@ else
   echo "Overpass is not working"
 fi
 
+# Copies results of previous measurement (and timestamp of OSM data they are valid for), so that measure_quality.py
+# re-measures only entities that changed in cadastre or in OSM since then
+function seed_results {
+  cp $1 $2
+  if [ -f $1.osm_timestamp ]; then
+    cp $1.osm_timestamp $2.osm_timestamp
+  fi
+}
+
 function refresh_cadastre_data {
   python3 serbia2input.py input/all.csv
   python3 ../inputcsv2shp.py input/all.csv output/shp/all.shp
@@ -49,7 +58,7 @@ echo "Setting up yesterday data"
 ../refresh-osm-data.sh europe serbia yesterday ../overpass_db
 
 # Do baseline measurement
-python3 ../measure_quality.py input/all.csv output/level9-baseline-$yesterday.csv
+python3 ../measure_quality.py input/all.csv output/level9-baseline-$yesterday.csv output/snapshot-$yesterday.osm
 sort -o output/level9-baseline-$yesterday.csv output/level9-baseline-$yesterday.csv
 
 # Refresh cadastre and do measurements now
@@ -58,7 +67,8 @@ refresh_cadastre_data
 sleep 10
 
 echo "Measuring settlements after cadastre is refreshed"
-python3 ../measure_quality.py input/all.csv output/level9-cadastre-$currentdate.csv
+seed_results output/level9-baseline-$yesterday.csv output/level9-cadastre-$currentdate.csv
+python3 ../measure_quality.py input/all.csv output/level9-cadastre-$currentdate.csv output/snapshot-$yesterday.osm
 sort -o output/level9-cadastre-$currentdate.csv output/level9-cadastre-$currentdate.csv
 diff -u output/level9-baseline-$yesterday.csv output/level9-cadastre-$currentdate.csv > output/level9-cadastre-$currentdate.diff || true
 python3 send_notification.py cadastre level9 output/level9-baseline-$yesterday.csv output/level9-cadastre-$currentdate.csv
@@ -69,11 +79,14 @@ echo "Refreshing OSM data"
 sleep 10
 
 echo "Measuring settlements after OSM is refreshed"
-python3 ../measure_quality.py input/all.csv output/level9-osm-$currentdate.csv
+seed_results output/level9-cadastre-$currentdate.csv output/level9-osm-$currentdate.csv
+python3 ../measure_quality.py input/all.csv output/level9-osm-$currentdate.csv output/snapshot-$currentdate.osm
 sort -o output/level9-osm-$currentdate.csv output/level9-osm-$currentdate.csv
 diff -u output/level9-baseline-$yesterday.csv output/level9-osm-$currentdate.csv > output/level9-osm-$currentdate.diff || true
 python3 send_notification.py osm level9 output/level9-baseline-$yesterday.csv output/level9-osm-$currentdate.csv
-cp output/level9-osm-$currentdate.csv output/level9-baseline-$currentdate.csv
+seed_results output/level9-osm-$currentdate.csv output/level9-baseline-$currentdate.csv
+
+rm -f output/snapshot-$yesterday.osm output/snapshot-$currentdate.osm
 
 echo "Measurement done for $currentdate"
 sleep 10
@@ -13,6 +13,7 @@ import pyproj
 import requests
 from bs4 import BeautifulSoup
 from shapely import wkt
+from shapely.geometry import MultiPolygon, mapping
 from shapely.ops import transform
 
 csv.field_size_limit(sys.maxsize)
@@ -118,6 +119,24 @@ def write_level9_features(level9, output_csv_filename):
             writer.writerow(data)
 
 
+def write_level9_features_fgb(level9, output_fgb_filename):
+    """
+    Writes level9 features to FlatGeobuf file (with spatial index), with same columns as .csv
+    """
+    import fiona
+    from fiona.crs import from_epsg
+
+    properties = ['level9_id', 'level9_name', 'level8_id', 'level8_name', 'level7_id', 'level7_name', 'level6_id', 'level6_name']
+    schema = {'geometry': 'MultiPolygon', 'properties': {p: 'str' for p in properties}}
+    with fiona.open(output_fgb_filename, 'w', driver='FlatGeobuf', schema=schema, crs=from_epsg(4326)) as output:
+        for data in level9:
+            # FlatGeobuf layer has single geometry type
+            geometry = data['wkt'] if data['wkt'].geom_type == 'MultiPolygon' else MultiPolygon([data['wkt']])
+            output.write({
+                'properties': {p: None if data[p] is None else str(data[p]) for p in properties},
+                'geometry': mapping(geometry)})
+
+
 # Map of level8_id => (level8_name, level6_id)
 def load_level8_features() -> dict:
     level8_features = {}
@@ -143,7 +162,7 @@ def load_level6_features() -> dict:
     return level6_features
 
 
-def main(output_csv_file: str):
+def main(output_file: str):
     if not os.path.exists('rgz-password'):
         print('Please create file rgz-password with RGZ credentials in the form of <username>:<password> in it')
         exit()
@@ -163,14 +182,17 @@ def main(output_csv_file: str):
         level9_feature['level7_name'] = None
         level9_feature['level6_id'] = level8_features[level9_feature['level8_id']][1]
         level9_feature['level6_name'] = level6_features[level9_feature['level6_id']]
-    print(f'Writing level9 data to {output_csv_file}')
-    write_level9_features(level9_features, output_csv_file)
+    print(f'Writing level9 data to {output_file}')
+    if output_file.endswith('.fgb'):
+        write_level9_features_fgb(level9_features, output_file)
+    else:
+        write_level9_features(level9_features, output_file)
     print('Done')
 
 
 if __name__ == '__main__':
     if len(sys.argv) != 2:
-        print("Usage: ./serbia2input.py <output_csv_file>")
+        print("Usage: ./serbia2input.py <output_csv_or_fgb_file>")
         exit()
-    output_csv_file = sys.argv[1]
-    main(output_csv_file)
+    output_file = sys.argv[1]
+    main(output_file)
@@ -0,0 +1,92 @@
+"""
+Prefetching of everything is_conflate_possible and unglue_ways look at, for a batch of ways at once. Before, each
+candidate way cost one Overpass query for entities glued to it ("way(id);>;<;"), and each ungluing cost separate
+OSM API calls for both ways and all shared nodes. Here, one Overpass query fetches ways of all level9 relations of the
+batch, with all ways and relations glued to them, and that is kept in an index which answers same question for each
+way locally. Ways and nodes which would be unglued are fetched from OSM API with few multi-fetch calls.
+"""
+
+import copy
+
+from boundary_store import BoundaryStore
+from common import get_entities_shared_with_level9_ways
+
+# How many ids to ask OSM API for in one multi-fetch call (they all go to URL)
+OSM_API_CHUNK_SIZE = 500
+
+
+def is_glued_way(tags):
+    """
+    Checks if way sharing nodes with boundary is something is_conflate_possible would try to unglue
+    """
+    return tags.get('boundary') != 'administrative' and not ('admin_level' in tags and int(tags['admin_level']) <= 2)
+
+
+class SharedEntityIndex(object):
+    """
+    Index of entities glued to ways of a batch of level9 relations. Each prefetch replaces previous batch. Ways which
+    are not in current batch (and ways and nodes from OSM API which were not prefetched) are fetched as before.
+    """
+    def __init__(self, overpass_api, osmapi, country, id_key, prefetch_osm_elements):
+        self.overpass_api = overpass_api
+        self.osmapi = osmapi
+        self.country = country
+        self.id_key = id_key
+        self.prefetch_osm_elements = prefetch_osm_elements
+        self.store = None
+        self.osm_ways = {}  # way id => way from OSM API
+        self.osm_nodes = {}  # node id => node from OSM API
+
+    def prefetch(self, level9_ids):
+        level9_ids = sorted(set(str(level9_id) for level9_id in level9_ids))
+        self.store, self.osm_ways, self.osm_nodes = None, {}, {}
+        if len(level9_ids) == 0:
+            return
+        response = get_entities_shared_with_level9_ways(self.overpass_api, level9_ids, self.country, self.id_key)
+        candidate_way_ids = set()
+        for relation in response.relations:
+            if relation.tags.get('admin_level') == '9' and relation.tags.get(self.id_key) in level9_ids:
+                candidate_way_ids.update(member.ref for member in relation.members if member.type == 'way')
+        self.store = BoundaryStore.from_overpass_result(response, candidate_way_ids)
+        print('Prefetched {0} ways of {1} level9 entities, with {2} glued ways and {3} relations'.format(
+            len(self.store.ways), len(level9_ids), len(self.store.glued_ways), len(self.store.relations)))
+        if not self.prefetch_osm_elements:
+            return
+
+        # Fetch everything ungluing would need - both ways and their shared nodes
+        way_ids, node_ids = set(), set()
+        for glued_way_id, (glued_node_ids, tags) in self.store.glued_ways.items():
+            if not is_glued_way(tags):
+                continue
+            for node_id in glued_node_ids:
+                boundary_way_ids = [w for w in self.store.node_ways.get(node_id, []) if w in self.store.ways]
+                if len(boundary_way_ids) > 0:
+                    way_ids.add(glued_way_id)
+                    way_ids.update(boundary_way_ids)
+                    node_ids.add(node_id)
+        way_ids, node_ids = sorted(way_ids), sorted(node_ids)
+        for start in range(0, len(way_ids), OSM_API_CHUNK_SIZE):
+            self.osm_ways.update(self.osmapi.WaysGet(way_ids[start:start + OSM_API_CHUNK_SIZE]))
+        for start in range(0, len(node_ids), OSM_API_CHUNK_SIZE):
+            self.osm_nodes.update(self.osmapi.NodesGet(node_ids[start:start + OSM_API_CHUNK_SIZE]))
+        if len(way_ids) > 0:
+            print(f'Prefetched {len(way_ids)} ways and {len(node_ids)} nodes which could be unglued')
+
+    def get_entities_shared_with_way(self, way_id):
+        """
+        :return: Same as conflate.get_entities_shared_with_way, or None if way is not in prefetched batch
+        """
+        if self.store is None or way_id not in self.store.ways:
+            return None
+        return self.store.get_entities_shared_with_way(way_id)
+
+    def get_way(self, way_id):
+        if way_id in self.osm_ways:
+            # Callers modify ways they get
+            return copy.deepcopy(self.osm_ways[way_id])
+        return self.osmapi.WayGet(way_id)
+
+    def get_nodes(self, node_ids):
+        if all(node_id in self.osm_nodes for node_id in node_ids):
+            return {node_id: copy.deepcopy(self.osm_nodes[node_id]) for node_id in node_ids}
+        return self.osmapi.NodesGet(list(node_ids))
@@ -0,0 +1,70 @@
+"""
+Country-wide snapshot of admin boundaries. Instead of asking Overpass for each entity separately, all relations of
+a given admin level (with their ways and nodes) are fetched in one bulk query, saved to disk and all polygons are
+built locally.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import overpy
+
+from atomic_write import atomic_write
+from common import retry_on_error, fetch_overpass_raw, get_relation_way_coords, create_geometry_from_way_coords, \
+    is_national_border, group_relations_by_tag
+
+
+@retry_on_error(timeout_in_seconds=2*60)
+def download_snapshot(overpass_url, country, admin_level, snapshot_file):
+    response = fetch_overpass_raw(overpass_url, """
+    [timeout:900][maxsize:4000000000];
+    area["name"="{0}"]["admin_level"=2]->.c;
+    relation(area.c)["boundary"="administrative"]["admin_level"={1}];
+    (._;>;);
+    out;
+    // &contact=https://github.com/stalker314314/osm-admin-boundary-conflation/
+    """.format(country, admin_level))
+    if not os.path.isfile(snapshot_file):
+        Path(snapshot_file).touch()  # need to touch file for atomic writes
+    with atomic_write(snapshot_file, text=False, keep=False) as h:
+        h.write(response)
+
+
+def load_snapshot_polygons(snapshot_file, id_key, max_workers=None):
+    """
+    Builds polygons of all relations from snapshot file, in parallel.
+
+    :return: Map of cadastre id => (polygon, relation name, relation id, national_border). Cadastre ids found in more
+    than one relation are mapped to (None, None, None, None), same as when they are queried one by one.
+    """
+    with open(snapshot_file, 'rb') as f:
+        response = overpy.Overpass().parse_xml(f.read())
+    print('Loaded {0} relations from snapshot {1}'.format(len(response.relations), snapshot_file))
+
+    relations_by_id = group_relations_by_tag(response, id_key)
+
+    snapshot_polygons = {}
+    futures = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for cadastre_id, relations in relations_by_id.items():
+            if len(relations) != 1:
+                print('relations found for cadastre id {0}: {1}'.format(cadastre_id, len(relations)))
+                snapshot_polygons[cadastre_id] = (None, None, None, None)
+                continue
+            relation = relations[0]
+            outer_coords, inner_coords = get_relation_way_coords(relation, response)
+            future = executor.submit(create_geometry_from_way_coords, outer_coords, inner_coords)
+            futures[cadastre_id] = (future, relation.tags.get('name'), relation.id,
+                                    is_national_border(relation, response))
+        for cadastre_id, (future, name, relation_id, national_border) in futures.items():
+            try:
+                polygon = future.result()
+            except Exception as e:
+                print('Failed to build polygon for cadastre id {0} (relation {1}): {2}'.format(cadastre_id, relation_id, e))
+                polygon = None
+            if polygon is None:
+                snapshot_polygons[cadastre_id] = (None, None, None, None)
+            else:
+                snapshot_polygons[cadastre_id] = (polygon, name, relation_id, national_border)
+    return snapshot_polygons